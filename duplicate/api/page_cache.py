@@ -0,0 +1,36 @@
+import frappe
+
+# Data of the www pages, shared by all visitors
+PAGE_DATA_CACHE_KEY = "duplicate_page_data"
+PAGE_DATA_TTL = 10 * 60
+
+# Counts that change with every User Permission write are only kept briefly
+# instead of being invalidated on each write
+PAGE_STATISTICS_TTL = 60
+
+MANAGER_PAGE_SECTIONS = ("managers", "active_managers")
+
+
+def get_page_key(section):
+	"""Get the Redis key of a cached page data section"""
+	return f"{PAGE_DATA_CACHE_KEY}:{section}"
+
+
+def get_page_data(section, builder, ttl=PAGE_DATA_TTL):
+	"""Get a page data section from Redis, building and caching it on a miss"""
+	data = frappe.cache().get_value(get_page_key(section))
+	if data is None:
+		data = builder()
+		frappe.cache().set_value(get_page_key(section), data, expires_in_sec=ttl)
+	return data
+
+
+def clear_page_data(sections):
+	"""Drop cached page data sections"""
+	for section in sections:
+		frappe.cache().delete_value(get_page_key(section))
+
+
+def clear_manager_page_data(doc=None, method=None):
+	"""Doc event dropping the cached permission managers"""
+	clear_page_data(MANAGER_PAGE_SECTIONS)
@@ -0,0 +1,37 @@
+import frappe
+from frappe.utils import cint
+
+# Results returned per page of a selector search
+SEARCH_PAGE_LENGTH = 20
+SEARCH_MAX_PAGE_LENGTH = 100
+
+
+def search_by_name_prefix(doctype, txt=None, after=None, page_length=None, filters=None, fields=None):
+	"""Get one page of documents whose name starts with `txt`, after the `after` cursor
+
+	Both the prefix match and the keyset use the primary key index, so a page
+	costs the same whatever the number of documents. Returns the results and
+	the cursor of the next page, if any. `filters` are a dict of equalities or
+	a list of `[doctype, field, operator, value]` filters.
+	"""
+	page_length = min(cint(page_length) or SEARCH_PAGE_LENGTH, SEARCH_MAX_PAGE_LENGTH)
+	if isinstance(filters, dict):
+		filters = [[doctype, key, "=", value] for key, value in filters.items()]
+	filters = list(filters or [])
+	if txt:
+		prefix = txt.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+		filters.append([doctype, "name", "like", f"{prefix}%"])
+	if after:
+		filters.append([doctype, "name", ">", after])
+
+	results = frappe.get_all(
+		doctype,
+		filters=filters,
+		fields=["name", *(fields or [])],
+		order_by="name asc",
+		limit_page_length=page_length,
+	)
+	return {
+		"results": results,
+		"next_after": results[-1].name if len(results) == page_length else None,
+	}
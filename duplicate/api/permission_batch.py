@@ -0,0 +1,151 @@
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cint
+
+from duplicate.api.permission_locks import lock_users, retry_on_lock_conflict, without_lock_conflict_retry
+from duplicate.api.permission_statistics import get_statistic_savepoint, rollback_statistic_deltas
+from duplicate.api.role_utils import create_role_copy
+
+# Operations accepted by one batch
+BATCH_OPERATION_LIMIT = 500
+
+# Operations writing User Permissions, whose users are locked up front
+USER_OPERATIONS = ("apply_manager", "remove_manager")
+
+
+def run_duplicate_role(operation):
+	"""Copy `source_role` as `new_role_name`"""
+	if not frappe.has_permission("Role", "create"):
+		frappe.throw(_("Insufficient permissions"))
+	return create_role_copy(
+		operation.source_role, operation.new_role_name, cint(operation.get("copy_permissions", 1))
+	)
+
+
+def run_apply_manager(operation):
+	"""Bind `user_email` to an active manager and grant its permissions"""
+	if not frappe.has_permission("User Permission Manager", "write"):
+		frappe.throw(_("Insufficient permissions"))
+	manager = frappe.get_doc("User Permission Manager", operation.manager_name)
+	if not manager.is_active:
+		frappe.throw(_("User Permission Manager is not active"))
+	return manager.add_user(operation.user_email)
+
+
+def run_remove_manager(operation):
+	"""Unbind `user_email` from a manager and release its permissions"""
+	if not frappe.has_permission("User Permission Manager", "write"):
+		frappe.throw(_("Insufficient permissions"))
+	manager = frappe.get_doc("User Permission Manager", operation.manager_name)
+	return {"deleted_count": manager.remove_existing_managed_permissions(operation.user_email)}
+
+
+def run_preview_manager(operation):
+	"""Get one page of a manager's preview"""
+	# The endpoints module imports this one
+	from duplicate.api.user_permission_utils import build_permission_manager_preview
+
+	if not frappe.has_permission("User Permission Manager", "read"):
+		frappe.throw(_("Insufficient permissions"))
+	return build_permission_manager_preview(
+		operation.manager_name, operation.get("after"), operation.get("page_length") or 20
+	)
+
+
+# Operation type -> function running it without committing
+BATCH_OPERATIONS = {
+	"duplicate_role": run_duplicate_role,
+	"apply_manager": run_apply_manager,
+	"remove_manager": run_remove_manager,
+	"preview_manager": run_preview_manager,
+}
+
+
+def parse_operations(operations):
+	"""Check a list of `{"type": ..., **arguments}` operations"""
+	operations = [frappe._dict(operation) for operation in operations or []]
+	if not operations:
+		frappe.throw(_("Please add at least one operation"))
+	if len(operations) > BATCH_OPERATION_LIMIT:
+		frappe.throw(_("A batch can hold at most {0} operations").format(BATCH_OPERATION_LIMIT))
+
+	for index, operation in enumerate(operations):
+		if operation.get("type") not in BATCH_OPERATIONS:
+			frappe.throw(
+				_("Operation {0} has an unknown type {1}").format(index, frappe.bold(operation.get("type")))
+			)
+	return operations
+
+
+def run_operation(index, operation):
+	"""Run one operation inside its own savepoint
+
+	A failed operation is rolled back to its savepoint, leaving the operations
+	before it in the transaction.
+	"""
+	savepoint = f"permission_batch_{index}"
+	statistics = get_statistic_savepoint()
+	started = time.monotonic()
+	frappe.db.savepoint(savepoint)
+	try:
+		result = {"status": "Success", "result": BATCH_OPERATIONS[operation.type](operation)}
+		frappe.db.release_savepoint(savepoint)
+	except (frappe.QueryDeadlockError, frappe.QueryTimeoutError):
+		# The database may have rolled back the whole transaction, so the batch is retried
+		raise
+	except Exception as e:
+		frappe.db.rollback(save_point=savepoint)
+		rollback_statistic_deltas(statistics)
+		frappe.clear_messages()
+		result = {"status": "Failed", "message": str(e)}
+
+	return {
+		"index": index,
+		"type": operation.type,
+		**result,
+		"duration_ms": round((time.monotonic() - started) * 1000, 3),
+	}
+
+
+def run_permission_batch(operations, atomic=False):
+	"""Run typed operations in one transaction and commit once
+
+	Each operation gets a savepoint, so a failed one is undone on its own and
+	the others are kept. With `atomic`, the first failure rolls back the whole
+	batch instead and the remaining operations are not run. On deadlocks and
+	lock waits the whole batch is rolled back and retried.
+	"""
+	operations = parse_operations(operations)
+	started = time.monotonic()
+
+	if any(operation.type in USER_OPERATIONS for operation in operations):
+		# Adding the custom field commits, which must not happen mid-batch
+		frappe.new_doc("User Permission Manager").ensure_user_permission_custom_field()
+
+	def run():
+		with without_lock_conflict_retry():
+			# Taking every user lock up front, in order, keeps concurrent batches from deadlocking
+			lock_users({
+				operation.user_email for operation in operations
+				if operation.type in USER_OPERATIONS and operation.get("user_email")
+			})
+
+			results = []
+			for index, operation in enumerate(operations):
+				results.append(run_operation(index, operation))
+				if atomic and results[-1]["status"] == "Failed":
+					frappe.db.rollback()
+					return results, False
+
+			frappe.db.commit()
+			return results, True
+
+	results, committed = retry_on_lock_conflict(run)
+	return {
+		"committed": committed,
+		"results": results,
+		"failed": sum(result["status"] == "Failed" for result in results),
+		"duration_ms": round((time.monotonic() - started) * 1000, 3),
+	}
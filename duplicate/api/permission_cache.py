@@ -0,0 +1,58 @@
+import frappe
+from frappe.utils import cint
+
+# Redis hash of User Permission Manager name -> is_active flag
+MANAGER_ACTIVE_CACHE_KEY = "user_permission_manager_active"
+
+# Managers and permission counts shown on the User form, per user
+USER_SIDEBAR_CACHE_KEY = "user_permission_sidebar"
+USER_SIDEBAR_CACHE_TTL = 60 * 60
+
+
+def is_manager_active(manager_name):
+	"""Return the `is_active` flag of a User Permission Manager without loading the document
+
+	The flag is read from a Redis hash; `frappe.cache().hget` also memoises it in
+	`frappe.local.cache`, so repeated lookups within one request stay in memory.
+	"""
+	if not manager_name:
+		return False
+
+	return bool(
+		frappe.cache().hget(
+			MANAGER_ACTIVE_CACHE_KEY,
+			manager_name,
+			generator=lambda: cint(frappe.db.get_value("User Permission Manager", manager_name, "is_active")),
+		)
+	)
+
+
+def clear_manager_active_cache(manager_name):
+	"""Drop the cached `is_active` flag of a User Permission Manager"""
+	frappe.cache().hdel(MANAGER_ACTIVE_CACHE_KEY, manager_name)
+
+
+def get_user_sidebar(user, builder):
+	"""Get the User form sidebar data of a user from Redis, building it on a miss"""
+	key = f"{USER_SIDEBAR_CACHE_KEY}:{user}"
+	sidebar = frappe.cache().get_value(key)
+	if sidebar is None:
+		sidebar = builder(user)
+		frappe.cache().set_value(key, sidebar, expires_in_sec=USER_SIDEBAR_CACHE_TTL)
+	return sidebar
+
+
+def clear_user_sidebar_cache(users):
+	"""Drop the cached User form sidebar data of `users`"""
+	for user in users:
+		frappe.cache().delete_value(f"{USER_SIDEBAR_CACHE_KEY}:{user}")
+
+
+def clear_permission_user_sidebar_cache(doc, method=None):
+	"""User Permission doc event dropping the sidebar data of its user"""
+	clear_user_sidebar_cache([doc.user])
+
+
+def clear_all_user_sidebar_caches(doc=None, method=None):
+	"""User Permission Manager doc event dropping all sidebar data, which shows manager names"""
+	frappe.cache().delete_keys(f"{USER_SIDEBAR_CACHE_KEY}:")
@@ -0,0 +1,161 @@
+import frappe
+from frappe import _
+from frappe.utils import now
+
+from duplicate.api.permission_locks import lock_users, retry_on_lock_conflict
+from duplicate.api.permission_statistics import count_permission_changes
+from duplicate.api.permission_targets import bind_users
+from duplicate.api.permission_writer import (
+	PERMISSION_VALUE_FIELDS,
+	WRITE_CHUNK_SIZE,
+	apply_manager_to_users,
+	clear_user_permission_cache,
+	get_permission_key,
+)
+
+SOURCE_PERMISSION_FIELDS = ["allow", "for_value", "applicable_for", *PERMISSION_VALUE_FIELDS]
+
+
+def get_source_permissions(source_user):
+	"""Read the User Permissions of the user to clone, once"""
+	permissions = frappe.get_all(
+		"User Permission",
+		filters={"user": source_user},
+		fields=SOURCE_PERMISSION_FIELDS,
+		order_by="creation asc",
+	)
+
+	# Duplicated rows of the source are copied once
+	unique = {}
+	for permission in permissions:
+		unique.setdefault(
+			get_permission_key(permission.allow, permission.for_value, permission.applicable_for), permission
+		)
+	return list(unique.values())
+
+
+def get_existing_keys(users, permissions):
+	"""Get the (user, permission key) pairs the target users already have"""
+	existing = set()
+	for start in range(0, len(users), WRITE_CHUNK_SIZE):
+		rows = frappe.db.sql(
+			"""
+			SELECT user, allow, for_value, applicable_for
+			FROM `tabUser Permission`
+			WHERE user IN %(users)s AND allow IN %(allows)s
+		""",
+			{
+				"users": tuple(users[start : start + WRITE_CHUNK_SIZE]),
+				"allows": tuple({permission.allow for permission in permissions}),
+			},
+			as_dict=True,
+		)
+		existing.update(
+			(row.user, get_permission_key(row.allow, row.for_value, row.applicable_for)) for row in rows
+		)
+	return existing
+
+
+def copy_permissions(permissions, users):
+	"""Insert the permissions into all users with multi-row inserts, skipping the ones they have
+
+	Returns the number of inserted rows.
+	"""
+	existing = get_existing_keys(users, permissions)
+	timestamp = now()
+	session_user = frappe.session.user
+
+	values = [
+		(
+			frappe.generate_hash(length=10),
+			timestamp,
+			timestamp,
+			session_user,
+			session_user,
+			0,
+			user,
+			permission.allow,
+			permission.for_value,
+			permission.applicable_for,
+			*(permission.get(field) or 0 for field in PERMISSION_VALUE_FIELDS),
+		)
+		for user in users
+		for permission in permissions
+		if (user, get_permission_key(permission.allow, permission.for_value, permission.applicable_for))
+		not in existing
+	]
+
+	frappe.db.bulk_insert(
+		"User Permission",
+		fields=[
+			"name",
+			"creation",
+			"modified",
+			"modified_by",
+			"owner",
+			"docstatus",
+			"user",
+			"allow",
+			"for_value",
+			"applicable_for",
+			*PERMISSION_VALUE_FIELDS,
+		],
+		values=values,
+		chunk_size=WRITE_CHUNK_SIZE,
+	)
+	count_permission_changes(frappe._dict(user=row[6], allow=row[7]) for row in values)
+	clear_user_permission_cache(users)
+	return len(values)
+
+
+def create_clone_manager(source_user, permissions, manager_name=None):
+	"""Create an active template manager owning the copies made for all target users"""
+	manager = frappe.new_doc("User Permission Manager")
+	manager.manager_name = manager_name or _("Permissions of {0}").format(source_user)
+	manager.description = _("Cloned from the User Permissions of {0}").format(source_user)
+	manager.is_template = 1
+	manager.is_active = 1
+	for permission in permissions:
+		manager.append(
+			"user_permission_details",
+			{field: permission.get(field) for field in SOURCE_PERMISSION_FIELDS},
+		)
+
+	# The copies are written right below, not by the background sync
+	manager.flags.skip_sync = True
+	manager.insert(ignore_permissions=True)
+	return manager
+
+
+def clone_permissions(source_user, target_users, create_manager=False, manager_name=None):
+	"""Copy all User Permissions of `source_user` to each of `target_users`
+
+	Without a manager the copies are plain User Permissions. With
+	`create_manager`, one template manager bound to all target users owns the
+	copies, so they are kept in sync and can be removed together later.
+	"""
+	target_users = sorted({user for user in target_users if user and user != source_user})
+	permissions = get_source_permissions(source_user)
+	if not permissions or not target_users:
+		return {"source_permissions": len(permissions), "target_users": len(target_users), "inserted": 0}
+
+	if create_manager:
+		manager = create_clone_manager(source_user, permissions, manager_name)
+		manager.ensure_user_permission_custom_field()
+		bind_users(manager.name, target_users)
+		inserted = apply_manager_to_users(manager, target_users)["inserted"]
+		frappe.db.commit()
+		return {
+			"source_permissions": len(permissions),
+			"target_users": len(target_users),
+			"inserted": inserted,
+			"manager": manager.name,
+		}
+
+	def copy():
+		lock_users(target_users)
+		return copy_permissions(permissions, target_users)
+
+	inserted = retry_on_lock_conflict(copy)
+	frappe.db.commit()
+	return {"source_permissions": len(permissions), "target_users": len(target_users), "inserted": inserted}
@@ -0,0 +1,308 @@
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import now_datetime, today
+
+from duplicate.api.permission_jobs import get_manager_lock_name, mark_sync_log_failed, record_shard_results
+from duplicate.api.permission_locks import advisory_lock, lock_users
+from duplicate.api.permission_targets import TARGET_USER_BATCH_SIZE, get_untargeted_users
+from duplicate.api.permission_writer import (
+	apply_manager_to_users,
+	clear_user_permission_cache,
+	execute_permission_changes,
+	get_permission_changes,
+	release_permissions,
+)
+
+DRIFT_REPAIR_LOCK = "user_permission_drift_repair"
+
+# (manager, user) pairs every active manager targets, including users a manager
+# was bound to explicitly. Managers targeting a saved User filter are left out,
+# since their filters cannot be joined in SQL; they are reconciled through the
+# writer instead.
+TARGET_PAIRS_QUERY = """
+	SELECT m.name AS manager, m.user_field AS user
+	FROM `tabUser Permission Manager` m
+	WHERE m.is_active = 1 AND COALESCE(m.user_field, '') != ''
+		AND COALESCE(m.target_user_filter, '') = ''
+	UNION
+	SELECT m.name, hr.parent
+	FROM `tabUser Permission Manager` m
+	INNER JOIN `tabHas Role` hr ON hr.role = m.target_role AND hr.parenttype = 'User'
+	INNER JOIN `tabUser` u ON u.name = hr.parent AND u.enabled = 1 AND u.user_type = 'System User'
+	WHERE m.is_active = 1 AND m.apply_to_all_users = 0 AND COALESCE(m.target_user_filter, '') = ''
+	UNION
+	SELECT m.name, u.name
+	FROM `tabUser Permission Manager` m
+	INNER JOIN `tabUser` u ON u.enabled = 1 AND u.user_type = 'System User'
+	WHERE m.is_active = 1 AND m.apply_to_all_users = 1
+	UNION
+	SELECT m.name, b.user
+	FROM `tabUser Permission Manager` m
+	INNER JOIN `tabUser Permission Manager Binding` b ON b.user_permission_manager = m.name
+	WHERE m.is_active = 1 AND COALESCE(m.target_user_filter, '') = ''
+"""
+
+# Only details within their validity window grant permissions
+DETAIL_VALIDITY = """
+	(d.valid_from IS NULL OR d.valid_from <= %(today)s) AND (d.valid_until IS NULL OR d.valid_until >= %(today)s)
+"""
+
+DETAIL_JOIN = f"""
+	{DETAIL_VALIDITY}
+	AND d.parenttype = 'User Permission Manager' AND d.parentfield = 'user_permission_details'
+	AND d.allow = up.allow AND d.for_value = up.for_value
+	AND COALESCE(d.applicable_for, '') = COALESCE(up.applicable_for, '')
+"""
+
+
+def find_missing_permissions():
+	"""Get the target pairs lacking a permission, or this manager's ownership of it"""
+	return frappe.db.sql(
+		f"""
+		SELECT t.manager, t.user, up.name AS user_permission
+		FROM ({TARGET_PAIRS_QUERY}) t
+		INNER JOIN `tabUser Permission Details` d ON d.parent = t.manager
+			AND d.parenttype = 'User Permission Manager' AND d.parentfield = 'user_permission_details'
+			AND {DETAIL_VALIDITY}
+		LEFT JOIN `tabUser Permission` up ON up.user = t.user AND up.allow = d.allow
+			AND up.for_value = d.for_value AND COALESCE(up.applicable_for, '') = COALESCE(d.applicable_for, '')
+		LEFT JOIN `tabUser Permission Ownership` o ON o.user_permission = up.name
+			AND o.user_permission_manager = t.manager
+		WHERE o.name IS NULL
+	""",
+		{"today": today()},
+		as_dict=True,
+	)
+
+
+def find_mismatched_permissions():
+	"""Get permissions whose flags differ from the details of their primary manager"""
+	return frappe.db.sql(
+		f"""
+		SELECT up.user_permission_manager AS manager, up.user, up.name AS user_permission
+		FROM `tabUser Permission` up
+		INNER JOIN `tabUser Permission Manager` m ON m.name = up.user_permission_manager
+			AND m.is_active = 1 AND COALESCE(m.target_user_filter, '') = ''
+		INNER JOIN `tabUser Permission Details` d ON d.parent = m.name AND {DETAIL_JOIN}
+		WHERE up.apply_to_all_doctypes != (
+				CASE WHEN d.apply_to_all_doctypes = 1 OR COALESCE(d.applicable_for, '') = '' THEN 1 ELSE 0 END
+			)
+			OR up.is_default != d.is_default OR up.hide_descendants != d.hide_descendants
+	""",
+		{"today": today()},
+		as_dict=True,
+	)
+
+
+def find_extra_permissions():
+	"""Get permissions owned by a manager that no longer grants them to the user
+
+	`targeted` is 0 when the user is not a target of the manager anymore, 1 when
+	the manager just stopped granting that permission.
+	"""
+	return frappe.db.sql(
+		f"""
+		SELECT o.user_permission_manager AS manager, o.user, up.name AS user_permission,
+			CASE WHEN t.user IS NULL THEN 0 ELSE 1 END AS targeted
+		FROM `tabUser Permission Ownership` o
+		INNER JOIN `tabUser Permission` up ON up.name = o.user_permission
+		INNER JOIN `tabUser Permission Manager` m ON m.name = o.user_permission_manager
+			AND m.is_active = 1 AND COALESCE(m.target_user_filter, '') = ''
+		LEFT JOIN `tabUser Permission Details` d ON d.parent = m.name AND {DETAIL_JOIN}
+		LEFT JOIN ({TARGET_PAIRS_QUERY}) t ON t.manager = o.user_permission_manager AND t.user = o.user
+		WHERE d.name IS NULL OR t.user IS NULL
+	""",
+		{"today": today()},
+		as_dict=True,
+	)
+
+
+def repair_permission_drift():
+	"""Scheduled job finding and repairing drifted managed User Permissions
+
+	Drift is detected with a few set-based queries over all active managers.
+	Users of a manager with missing, mismatched or stale permissions are
+	reconciled again in bulk; permissions of users the manager does not target
+	anymore are released. Counts and timings are recorded in a User Permission
+	Sync Log, which is marked as Failed if detection or repair raises.
+	"""
+	with advisory_lock(DRIFT_REPAIR_LOCK) as acquired:
+		if not acquired:
+			return
+
+		sync_log = frappe.get_doc(
+			{
+				"doctype": "User Permission Sync Log",
+				"operation": "Drift Repair",
+				"status": "Running",
+				"started_on": now_datetime(),
+				"total_shards": 1,
+			}
+		).insert(ignore_permissions=True)
+		frappe.db.commit()
+
+		try:
+			detection_start = time.monotonic()
+			missing = find_missing_permissions()
+			mismatched = find_mismatched_permissions()
+			extra = find_extra_permissions()
+			detection_duration = time.monotonic() - detection_start
+
+			release = {}
+			for row in extra:
+				if not row.targeted:
+					release.setdefault(row.manager, []).append(frappe._dict(name=row.user_permission, user=row.user))
+
+			# Users the manager does not target anymore are only released, never reapplied
+			untargeted = {(row.manager, row.user) for row in extra if not row.targeted}
+			reapply = {}
+			for row in [*missing, *mismatched, *[row for row in extra if row.targeted]]:
+				if (row.manager, row.user) not in untargeted:
+					reapply.setdefault(row.manager, set()).add(row.user)
+
+			repair_start = time.monotonic()
+			results = [
+				repair_manager_drift(manager_name, reapply.get(manager_name, set()), release.get(manager_name, []))
+				for manager_name in sorted(set(reapply) | set(release))
+			]
+
+			counts = {"missing": 0, "mismatched": 0, "extra": 0}
+			for manager_name in frappe.get_all(
+				"User Permission Manager",
+				filters={"is_active": 1, "target_user_filter": ["is", "set"]},
+				pluck="name",
+			):
+				result = reconcile_filtered_manager(manager_name)
+				drifted = {key: result.pop(key) for key in counts}
+				for key, count in drifted.items():
+					counts[key] += count
+				if result["status"] != "Success" or any(drifted.values()):
+					results.append(result)
+			repair_duration = time.monotonic() - repair_start
+
+			frappe.db.set_value(
+				"User Permission Sync Log",
+				sync_log.name,
+				{
+					"total_managers": len(results),
+					"missing_count": len([row for row in missing if not row.user_permission]) + counts["missing"],
+					"mismatched_count": len(mismatched) + counts["mismatched"],
+					"extra_count": len(extra) + counts["extra"],
+					"affected_users": len({row.user for row in [*missing, *mismatched, *extra]}),
+					"detection_duration": detection_duration,
+					"repair_duration": repair_duration,
+				},
+				update_modified=False,
+			)
+			record_shard_results(sync_log.name, results)
+			return sync_log.name
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(title="User Permission Drift Repair Failed", message=frappe.get_traceback())
+			mark_sync_log_failed(sync_log.name, frappe.get_traceback())
+			return sync_log.name
+
+
+def repair_manager_drift(manager_name, users, released):
+	"""Reconcile the drifted users of one manager under its sync lock"""
+	with advisory_lock(get_manager_lock_name(manager_name)) as acquired:
+		if not acquired:
+			return {
+				"manager": manager_name,
+				"status": "Skipped",
+				"message": _("Another sync of this manager is running"),
+			}
+
+		try:
+			manager = frappe.get_doc("User Permission Manager", manager_name)
+			users = sorted(users)
+			for start in range(0, len(users), TARGET_USER_BATCH_SIZE):
+				apply_manager_to_users(manager, users[start : start + TARGET_USER_BATCH_SIZE])
+				frappe.db.commit()
+
+			if released:
+				clear_user_permission_cache(release_permissions(manager_name, released))
+				frappe.db.commit()
+
+			return {
+				"manager": manager_name,
+				"status": "Success",
+				"message": _("Repaired {0} users").format(len(users) + len({row.user for row in released})),
+			}
+		except Exception as e:
+			frappe.db.rollback()
+			frappe.log_error(title="User Permission Drift Repair Failed", message=frappe.get_traceback())
+			return {"manager": manager_name, "status": "Failed", "message": str(e)}
+
+
+def reconcile_filtered_manager(manager_name):
+	"""Reconcile a manager targeting a saved User filter through the writer
+
+	Only chunks of users with drift are written, and the permissions of users
+	who left the filter are released. Returns a result dict with the
+	number of missing, mismatched and extra permissions found.
+	"""
+	result = {"manager": manager_name, "missing": 0, "mismatched": 0, "extra": 0}
+
+	with advisory_lock(get_manager_lock_name(manager_name)) as acquired:
+		if not acquired:
+			return {**result, "status": "Skipped", "message": _("Another sync of this manager is running")}
+
+		try:
+			manager = frappe.get_doc("User Permission Manager", manager_name)
+			for users in manager.iter_target_user_batches():
+				changes = get_permission_changes(manager, users, for_update=False)
+				if changes["insert"] or changes["update"] or changes["own"] or changes["release"]:
+					lock_users(users)
+					changes = get_permission_changes(manager, users)
+					execute_permission_changes(manager_name, changes)
+					frappe.db.commit()
+
+				result["missing"] += len(changes["insert"])
+				result["mismatched"] += len(changes["update"])
+				result["extra"] += len(changes["release"])
+
+			result["extra"] += release_untargeted_permissions(manager)
+			return {**result, "status": "Success", "message": _("Reconciled")}
+		except Exception as e:
+			frappe.db.rollback()
+			frappe.log_error(title="User Permission Drift Repair Failed", message=frappe.get_traceback())
+			return {**result, "status": "Failed", "message": str(e)}
+
+
+def release_untargeted_permissions(manager):
+	"""Release the permissions a manager owns for users it does not target anymore
+
+	Owning users are paged with a keyset and checked against the manager's
+	targets one page at a time. Returns the number of released rows.
+	"""
+	released = 0
+	after = None
+	while True:
+		users = frappe.get_all(
+			"User Permission Ownership",
+			filters={"user_permission_manager": manager.name, "user": [">", after or ""]},
+			order_by="user asc",
+			limit_page_length=TARGET_USER_BATCH_SIZE,
+			pluck="user",
+			distinct=True,
+		)
+
+		untargeted = sorted(get_untargeted_users(manager, users))
+		if untargeted:
+			lock_users(untargeted)
+			rows = frappe.get_all(
+				"User Permission Ownership",
+				filters={"user_permission_manager": manager.name, "user": ["in", untargeted]},
+				fields=["user_permission as name", "user"],
+			)
+			clear_user_permission_cache(release_permissions(manager.name, rows))
+			frappe.db.commit()
+			released += len(rows)
+
+		if len(users) < TARGET_USER_BATCH_SIZE:
+			return released
+
+		after = users[-1]
@@ -0,0 +1,540 @@
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cint, now, now_datetime, time_diff_in_seconds
+from frappe.utils.background_jobs import is_job_enqueued
+
+from duplicate.api.permission_locks import advisory_lock
+from duplicate.api.permission_targets import bind_users
+
+# Users applied per background job of a bulk apply
+BULK_APPLY_CHUNK_SIZE = 500
+
+# Bulk apply job state is kept in Redis for a day
+BULK_APPLY_JOB_KEY = "user_permission_bulk_apply"
+BULK_APPLY_JOB_TTL = 24 * 60 * 60
+
+BULK_APPLY_PROGRESS_EVENT = "user_permission_bulk_apply_progress"
+BULK_APPLY_RESULTS_EVENT = "user_permission_bulk_apply_results"
+
+# Default number of shards a sync of all managers is split into
+SYNC_ALL_DEFAULT_JOBS = 4
+SYNC_SHARD_TIMEOUT = 4 * 60 * 60
+
+# Saves of a manager within this many seconds are collapsed into one sync
+MANAGER_SYNC_DEBOUNCE = 10
+MANAGER_SYNC_REQUEST_KEY = "user_permission_manager_sync_requested"
+
+# Drops the sync request of a manager only if no newer request replaced it
+SERVE_MANAGER_SYNC_REQUEST = """
+if redis.call("HGET", KEYS[1], ARGV[1]) == ARGV[2] then
+	return redis.call("HDEL", KEYS[1], ARGV[1])
+end
+return 0
+"""
+MANAGER_SYNC_EVENT = "user_permission_manager_sync"
+
+SYNC_ALL_RESULT_EVENT = "user_permission_sync_all_result"
+SYNC_ALL_PROGRESS_EVENT = "user_permission_sync_all_progress"
+
+
+def apply_manager_to_user_chunk(manager, users):
+	"""Apply a manager to a chunk of users and commit, returning one result per user
+
+	The chunk is written with bulk statements in one transaction. If that fails,
+	users are retried one by one so a single bad user does not fail the chunk.
+	Applied users are bound to the manager, so they stay its targets.
+	"""
+	try:
+		bind_users(manager.name, users)
+		manager.apply_to_users(users)
+		frappe.db.commit()
+		return [
+			{"user": user, "success": True, "message": _("Permissions applied successfully")}
+			for user in users
+		]
+	except Exception:
+		frappe.db.rollback()
+
+	results = []
+	for user in users:
+		try:
+			bind_users(manager.name, [user])
+			manager.apply_to_users([user])
+			frappe.db.commit()
+			results.append({"user": user, "success": True, "message": _("Permissions applied successfully")})
+		except Exception as e:
+			frappe.db.rollback()
+			results.append({"user": user, "success": False, "message": str(e)})
+
+	return results
+
+
+def publish_bulk_apply_results(job_handle, chunk_index, results, user, status="Completed"):
+	"""Stream the per-user results of one chunk of a bulk apply to `user`
+
+	Applied users are sent as a plain list; only failures carry a message.
+	"""
+	frappe.publish_realtime(
+		BULK_APPLY_RESULTS_EVENT,
+		{
+			"job_handle": job_handle,
+			"chunk_index": chunk_index,
+			"status": status,
+			"applied": [r["user"] for r in results if r["success"]],
+			"failed": [r for r in results if not r["success"] and status != "Cancelled"],
+			"cancelled": [r["user"] for r in results if status == "Cancelled"],
+		},
+		user=user,
+	)
+
+
+def get_job_key(job_handle, suffix=None):
+	"""Get the Redis key of a bulk apply job"""
+	key = f"{BULK_APPLY_JOB_KEY}:{job_handle}"
+	return f"{key}:{suffix}" if suffix else key
+
+
+def enqueue_bulk_apply(manager_name, users, chunk_size=None):
+	"""Split users into chunks and apply the manager to each chunk in a background job
+
+	Returns the handle to poll or cancel the job with.
+	"""
+	chunk_size = cint(chunk_size) or BULK_APPLY_CHUNK_SIZE
+	chunks = [users[start : start + chunk_size] for start in range(0, len(users), chunk_size)]
+	job_handle = frappe.generate_hash(length=12)
+
+	frappe.cache().set_value(
+		get_job_key(job_handle),
+		{
+			"manager": manager_name,
+			"owner": frappe.session.user,
+			"total_users": len(users),
+			"total_chunks": len(chunks),
+			"created": now(),
+		},
+		expires_in_sec=BULK_APPLY_JOB_TTL,
+	)
+
+	for index, chunk in enumerate(chunks):
+		frappe.enqueue(
+			"duplicate.api.permission_jobs.run_bulk_apply_chunk",
+			queue="long",
+			job_id=get_job_key(job_handle, index),
+			enqueue_after_commit=True,
+			job_handle=job_handle,
+			manager_name=manager_name,
+			users=chunk,
+			chunk_index=index,
+		)
+
+	return job_handle
+
+
+def run_bulk_apply_chunk(job_handle, manager_name, users, chunk_index):
+	"""Background job applying a manager to one chunk of a bulk apply"""
+	if is_bulk_apply_cancelled(job_handle):
+		results = [{"user": user, "success": False, "message": _("Cancelled")} for user in users]
+		status = "Cancelled"
+	else:
+		manager = frappe.get_doc("User Permission Manager", manager_name)
+		manager.ensure_user_permission_custom_field()
+		results = apply_manager_to_user_chunk(manager, users)
+		status = "Completed"
+
+	chunk_result = {
+		"status": status,
+		"success_count": len([r for r in results if r["success"]]),
+		"failed": [r for r in results if not r["success"] and status != "Cancelled"],
+		"user_count": len(users),
+	}
+	chunks_key = get_job_key(job_handle, "chunks")
+	frappe.cache().hset(chunks_key, str(chunk_index), chunk_result)
+	frappe.cache().expire(frappe.cache().make_key(chunks_key), BULK_APPLY_JOB_TTL)
+
+	job_status = get_bulk_apply_job_status(job_handle)
+	publish_bulk_apply_results(job_handle, chunk_index, results, job_status["owner"], status)
+
+	# Failures were streamed with the chunk's results, so progress only carries counts
+	frappe.publish_realtime(
+		BULK_APPLY_PROGRESS_EVENT,
+		{
+			**{key: value for key, value in job_status.items() if key != "failed"},
+			"chunk_index": chunk_index,
+			"chunk_status": status,
+		},
+		user=job_status["owner"],
+	)
+
+
+def get_bulk_apply_job_status(job_handle):
+	"""Aggregate the chunk results of a bulk apply job"""
+	meta = frappe.cache().get_value(get_job_key(job_handle))
+	if not meta:
+		frappe.throw(_("Bulk apply job {0} not found or expired").format(job_handle))
+
+	chunks = list(frappe.cache().hgetall(get_job_key(job_handle, "chunks")).values())
+	cancelled = is_bulk_apply_cancelled(job_handle)
+	finished = len(chunks) >= meta["total_chunks"]
+
+	if finished:
+		status = "Cancelled" if cancelled else "Completed"
+	else:
+		status = "Cancelling" if cancelled else ("Running" if chunks else "Queued")
+
+	return {
+		"job_handle": job_handle,
+		"status": status,
+		"manager": meta["manager"],
+		"owner": meta["owner"],
+		"total_users": meta["total_users"],
+		"total_chunks": meta["total_chunks"],
+		"finished_chunks": len(chunks),
+		"processed_users": sum(chunk["user_count"] for chunk in chunks if chunk["status"] != "Cancelled"),
+		"success_count": sum(chunk["success_count"] for chunk in chunks),
+		"failed_count": sum(len(chunk["failed"]) for chunk in chunks),
+		"failed": [failure for chunk in chunks for failure in chunk["failed"]],
+	}
+
+
+def cancel_bulk_apply_job(job_handle):
+	"""Flag a bulk apply job as cancelled; chunks not started yet are skipped"""
+	frappe.cache().set_value(get_job_key(job_handle, "cancelled"), 1, expires_in_sec=BULK_APPLY_JOB_TTL)
+
+
+def is_bulk_apply_cancelled(job_handle):
+	"""Check if a bulk apply job was cancelled"""
+	return bool(frappe.cache().get_value(get_job_key(job_handle, "cancelled")))
+
+
+def check_job_access(job_status):
+	"""Only the user who started a job, or a System Manager, may see or cancel it"""
+	if job_status["owner"] != frappe.session.user and "System Manager" not in frappe.get_roles():
+		frappe.throw(_("Not permitted"), frappe.PermissionError)
+
+
+def get_manager_lock_name(manager_name):
+	"""Get the advisory lock name guarding syncs of a manager"""
+	return f"user_permission_manager_sync:{manager_name}"
+
+
+def get_manager_sync_job_id(manager_name):
+	"""Get the background job id of the debounced sync of a manager"""
+	return f"user_permission_manager_sync:{manager_name}"
+
+
+def request_manager_sync(manager_name):
+	"""Ask for a debounced background sync of a manager once the transaction commits
+
+	Each request stores its time in Redis and the job is deduplicated by
+	manager. A job finding the last save not settled for `MANAGER_SYNC_DEBOUNCE`
+	seconds yet leaves the request to `enqueue_due_manager_syncs`, so a burst of
+	saves results in a single sync without a worker waiting on it.
+	"""
+	frappe.db.set_value(
+		"User Permission Manager", manager_name, "sync_status", "Pending", update_modified=False
+	)
+	frappe.cache().execute_command("HSET", get_manager_sync_request_key(), manager_name, repr(time.time()))
+	enqueue_manager_sync(manager_name)
+
+
+def get_manager_sync_request_key():
+	"""Get the Redis key of the hash of pending sync requests, by manager
+
+	Requests are read and written with plain Redis commands rather than the
+	cache helpers, which memoise hash fields for the whole request or job.
+	"""
+	return frappe.cache().make_key(MANAGER_SYNC_REQUEST_KEY)
+
+
+def get_manager_sync_request(manager_name):
+	"""Get the stored time of the last sync request of a manager, as sent to Redis, or None"""
+	return frappe.cache().execute_command("HGET", get_manager_sync_request_key(), manager_name)
+
+
+def enqueue_manager_sync(manager_name):
+	"""Enqueue the sync job of a manager once the transaction commits, unless one is queued already"""
+	frappe.enqueue(
+		"duplicate.api.permission_jobs.run_manager_sync",
+		queue="long",
+		timeout=SYNC_SHARD_TIMEOUT,
+		job_id=get_manager_sync_job_id(manager_name),
+		deduplicate=True,
+		enqueue_after_commit=True,
+		manager_name=manager_name,
+	)
+
+
+def is_manager_sync_due(requested_at):
+	"""Check if the last sync request of a manager has settled for the debounce window"""
+	return requested_at + MANAGER_SYNC_DEBOUNCE <= time.time()
+
+
+def enqueue_due_manager_syncs():
+	"""Scheduled job enqueueing the syncs whose requests have settled
+
+	Picks up requests left by jobs that ran within the debounce window or found
+	the manager locked, and requests made while a sync was running.
+	"""
+	requests = frappe.cache().execute_command("HGETALL", get_manager_sync_request_key()) or {}
+	for manager_name, requested_at in requests.items():
+		if is_manager_sync_due(float(requested_at)):
+			enqueue_manager_sync(frappe.safe_decode(manager_name))
+
+
+def run_manager_sync(manager_name):
+	"""Background job running the requested sync of a manager once saves have settled
+
+	Returns without syncing while the last request is within the debounce window
+	or another process is syncing the manager; the request stays in Redis and
+	`enqueue_due_manager_syncs` enqueues the job again.
+	"""
+	requested_at = get_manager_sync_request(manager_name)
+	if requested_at is None or not is_manager_sync_due(float(requested_at)):
+		return
+
+	with advisory_lock(get_manager_lock_name(manager_name)) as acquired:
+		if not acquired:
+			return
+
+		# Only the request read above is served; a newer one stays for another sync
+		frappe.cache().eval(SERVE_MANAGER_SYNC_REQUEST, 1, get_manager_sync_request_key(), manager_name, requested_at)
+		sync_manager(manager_name)
+
+
+def sync_manager(manager_name):
+	"""Sync a manager, tracking the outcome in its sync status"""
+	if not frappe.db.exists("User Permission Manager", manager_name):
+		return
+
+	set_manager_sync_status(manager_name, "Running")
+	try:
+		frappe.get_doc("User Permission Manager", manager_name).sync_user_permissions()
+		set_manager_sync_status(manager_name, "Applied", last_synced_on=now_datetime())
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(title="User Permission Manager Sync Failed", message=frappe.get_traceback())
+		set_manager_sync_status(manager_name, "Failed")
+
+
+def set_manager_sync_status(manager_name, status, **values):
+	"""Store the sync status of a manager and notify open forms of it"""
+	frappe.db.set_value(
+		"User Permission Manager",
+		manager_name,
+		{"sync_status": status, **values},
+		update_modified=False,
+	)
+	frappe.db.commit()
+
+	frappe.publish_realtime(
+		MANAGER_SYNC_EVENT,
+		{"manager": manager_name, "status": status},
+		doctype="User Permission Manager",
+		docname=manager_name,
+	)
+
+
+def enqueue_sync_all(jobs=None):
+	"""Shard all active managers across background jobs and return the summary log name
+
+	Managers are dealt round-robin into `jobs` shards, each synced by its own
+	job on the long queue. Shards add their counts to one User Permission Sync
+	Log; the last shard to finish marks it as completed.
+	"""
+	managers = frappe.get_all(
+		"User Permission Manager",
+		filters={"is_active": 1},
+		order_by="name asc",
+		pluck="name",
+	)
+	jobs = max(1, min(cint(jobs) or SYNC_ALL_DEFAULT_JOBS, len(managers) or 1))
+	shards = [managers[index::jobs] for index in range(jobs)]
+
+	sync_log = frappe.get_doc(
+		{
+			"doctype": "User Permission Sync Log",
+			"operation": "Sync All Managers",
+			"status": "Queued" if managers else "Completed",
+			"started_on": now_datetime(),
+			"finished_on": None if managers else now_datetime(),
+			"total_managers": len(managers),
+			"total_shards": len(shards) if managers else 0,
+		}
+	).insert(ignore_permissions=True)
+
+	if managers:
+		for index, shard in enumerate(shards):
+			frappe.enqueue(
+				"duplicate.api.permission_jobs.run_sync_shard",
+				queue="long",
+				timeout=SYNC_SHARD_TIMEOUT,
+				job_id=get_sync_shard_job_id(sync_log.name, index),
+				enqueue_after_commit=True,
+				sync_log=sync_log.name,
+				managers=shard,
+				notify_user=frappe.session.user,
+			)
+
+	return sync_log.name
+
+
+def get_sync_shard_job_id(sync_log, index):
+	"""Get the background job id of one shard of a sync of all managers"""
+	return f"user_permission_sync_all:{sync_log}:{index}"
+
+
+def count_live_sync_shards(sync_log, total_shards):
+	"""Count the shards of a sync of all managers whose job is still queued or running"""
+	return len([index for index in range(total_shards) if is_job_enqueued(get_sync_shard_job_id(sync_log, index))])
+
+
+def sync_manager_with_lock(manager_name):
+	"""Sync one manager unless another process is already syncing it
+
+	Returns a result dict with a status of Success, Failed or Skipped.
+	"""
+	with advisory_lock(get_manager_lock_name(manager_name)) as acquired:
+		if not acquired:
+			return {
+				"manager": manager_name,
+				"status": "Skipped",
+				"message": _("Another sync of this manager is running"),
+			}
+
+		try:
+			frappe.get_doc("User Permission Manager", manager_name).sync_user_permissions()
+			frappe.db.commit()
+			return {"manager": manager_name, "status": "Success", "message": _("Synced successfully")}
+		except Exception as e:
+			frappe.db.rollback()
+			frappe.log_error(title="User Permission Manager Sync Failed", message=frappe.get_traceback())
+			return {"manager": manager_name, "status": "Failed", "message": str(e)}
+
+
+def run_sync_shard(sync_log, managers, notify_user=None):
+	"""Background job syncing one shard of a sync of all managers
+
+	The result of each manager is streamed to `notify_user` as soon as it is
+	synced, and the log's counters once the shard is recorded.
+	"""
+	frappe.db.set_value("User Permission Sync Log", sync_log, "status", "Running", update_modified=False)
+	frappe.db.commit()
+
+	results = []
+	for manager_name in managers:
+		results.append(sync_manager_with_lock(manager_name))
+		if notify_user:
+			frappe.publish_realtime(SYNC_ALL_RESULT_EVENT, {"sync_log": sync_log, **results[-1]}, user=notify_user)
+
+	record_shard_results(sync_log, results)
+	if notify_user:
+		frappe.publish_realtime(SYNC_ALL_PROGRESS_EVENT, get_sync_log_summary(sync_log), user=notify_user)
+
+
+def record_shard_results(sync_log, results):
+	"""Add the results of a shard to the summary log with atomic increments"""
+	counts = {status: len([r for r in results if r["status"] == status]) for status in ("Success", "Failed", "Skipped")}
+
+	# Locking the log makes concurrent shards append their items and counts one at a time
+	frappe.db.get_value("User Permission Sync Log", sync_log, "name", for_update=True)
+	append_sync_log_items(sync_log, [r for r in results if r["status"] != "Success"])
+
+	frappe.db.sql(
+		"""
+		UPDATE `tabUser Permission Sync Log`
+		SET success_count = success_count + %(success)s, failed_count = failed_count + %(failed)s,
+			skipped_count = skipped_count + %(skipped)s, finished_shards = finished_shards + 1
+		WHERE name = %(name)s
+	""",
+		{"success": counts["Success"], "failed": counts["Failed"], "skipped": counts["Skipped"], "name": sync_log},
+	)
+	frappe.db.commit()
+
+	# Only the shard that completes the count flips the status
+	finished_on = now_datetime()
+	frappe.db.sql(
+		"""
+		UPDATE `tabUser Permission Sync Log`
+		SET status = 'Completed', finished_on = %(finished_on)s,
+			duration = %(duration)s
+		WHERE name = %(name)s AND finished_shards >= total_shards AND status != 'Completed'
+	""",
+		{
+			"finished_on": finished_on,
+			"duration": time_diff_in_seconds(
+				finished_on, frappe.db.get_value("User Permission Sync Log", sync_log, "started_on")
+			),
+			"name": sync_log,
+		},
+	)
+	frappe.db.commit()
+
+
+def mark_sync_log_failed(sync_log, message):
+	"""End a sync log as Failed, keeping why in one of its items"""
+	frappe.db.get_value("User Permission Sync Log", sync_log, "name", for_update=True)
+	append_sync_log_items(sync_log, [{"manager": None, "status": "Failed", "message": message}])
+
+	finished_on = now_datetime()
+	frappe.db.set_value(
+		"User Permission Sync Log",
+		sync_log,
+		{
+			"status": "Failed",
+			"finished_on": finished_on,
+			"duration": time_diff_in_seconds(
+				finished_on, frappe.db.get_value("User Permission Sync Log", sync_log, "started_on")
+			),
+		},
+		update_modified=False,
+	)
+	frappe.db.commit()
+
+
+def append_sync_log_items(sync_log, results):
+	"""Add result rows after the existing items of a sync log, whose row the caller has locked"""
+	start_idx = frappe.db.count("User Permission Sync Log Item", {"parent": sync_log})
+	for idx, result in enumerate(results, start=start_idx + 1):
+		frappe.get_doc(
+			{
+				"doctype": "User Permission Sync Log Item",
+				"parent": sync_log,
+				"parenttype": "User Permission Sync Log",
+				"parentfield": "items",
+				"idx": idx,
+				"user_permission_manager": result["manager"],
+				"status": result["status"],
+				"message": result["message"],
+			}
+		).db_insert()
+
+
+def get_sync_log_summary(sync_log):
+	"""Get the counters of a User Permission Sync Log"""
+	return frappe.db.get_value(
+		"User Permission Sync Log",
+		sync_log,
+		[
+			"name",
+			"operation",
+			"status",
+			"started_on",
+			"finished_on",
+			"duration",
+			"total_managers",
+			"total_shards",
+			"finished_shards",
+			"success_count",
+			"failed_count",
+			"skipped_count",
+			"missing_count",
+			"mismatched_count",
+			"extra_count",
+			"affected_users",
+			"detection_duration",
+			"repair_duration",
+		],
+		as_dict=True,
+	)
@@ -0,0 +1,166 @@
+import hashlib
+import random
+import time
+from contextlib import contextmanager
+
+import frappe
+
+# Seconds to wait for the advisory lock of a user
+USER_LOCK_TIMEOUT = 30
+
+# Attempts and base delay in seconds of writes retried on lock conflicts
+LOCK_CONFLICT_RETRIES = 5
+LOCK_CONFLICT_BACKOFF = 0.2
+
+
+def get_lock_key(name):
+	"""Get a server wide advisory lock key for `name`, scoped to the site database"""
+	return hashlib.sha1(f"{frappe.conf.db_name}:{name}".encode()).hexdigest()
+
+
+def acquire_advisory_lock(name, timeout=0):
+	"""Try to take the advisory lock `name` within `timeout` seconds"""
+	key = get_lock_key(name)
+
+	if frappe.db.db_type == "postgres":
+		lock_id = int(key[:15], 16)
+		deadline = time.monotonic() + timeout
+		while True:
+			if frappe.db.sql("SELECT pg_try_advisory_lock(%s)", (lock_id,))[0][0]:
+				return True
+			if time.monotonic() >= deadline:
+				return False
+			time.sleep(0.1)
+
+	return frappe.db.sql("SELECT GET_LOCK(%s, %s)", (key, timeout))[0][0] == 1
+
+
+def release_advisory_lock(name):
+	"""Release the advisory lock `name` held by this database session"""
+	key = get_lock_key(name)
+
+	if frappe.db.db_type == "postgres":
+		frappe.db.sql("SELECT pg_advisory_unlock(%s)", (int(key[:15], 16),))
+	else:
+		frappe.db.sql("SELECT RELEASE_LOCK(%s)", (key,))
+
+
+@contextmanager
+def advisory_lock(name, timeout=0):
+	"""Hold the database advisory lock `name` for the duration of the block
+
+	Yields whether the lock was acquired. The lock belongs to the database
+	session, so it survives commits and is dropped if the worker dies.
+	"""
+	acquired = acquire_advisory_lock(name, timeout)
+	try:
+		yield acquired
+	finally:
+		if acquired:
+			release_advisory_lock(name)
+
+
+def get_user_lock_name(user):
+	"""Get the advisory lock name guarding the User Permissions of a user
+
+	Each user has their own lock, hashed into a key by `get_lock_key`, so
+	chunks of different users never wait on each other.
+	"""
+	return f"user_permission_user:{user}"
+
+
+def get_held_user_locks():
+	"""Get the set of user lock names held by this request or job"""
+	if getattr(frappe.local, "user_permission_locks", None) is None:
+		frappe.local.user_permission_locks = set()
+	return frappe.local.user_permission_locks
+
+
+def lock_users(users, timeout=USER_LOCK_TIMEOUT):
+	"""Take the advisory locks of `users` until the current transaction ends
+
+	Locks are taken in sorted order, so two processes locking overlapping users
+	cannot wait on each other. They are released on the next commit or rollback.
+	Raises `frappe.QueryTimeoutError` if a lock is not free within `timeout`.
+	"""
+	held = get_held_user_locks()
+	names = sorted({get_user_lock_name(user) for user in users} - held)
+	if not names:
+		return
+
+	frappe.db.after_commit.add(release_user_locks)
+	frappe.db.after_rollback.add(release_user_locks)
+
+	for name in names:
+		if not acquire_advisory_lock(name, timeout):
+			raise frappe.QueryTimeoutError(f"Could not lock {name} within {timeout} seconds")
+		held.add(name)
+
+
+def release_user_locks():
+	"""Release the user locks taken by `lock_users` in this transaction"""
+	held = get_held_user_locks()
+	for name in sorted(held):
+		release_advisory_lock(name)
+	held.clear()
+
+
+def retry_on_lock_conflict(fn, *args, **kwargs):
+	"""Call `fn`, retrying with exponential backoff on deadlocks and lock waits
+
+	When the transaction holds no writes yet, a conflict rolls it back and `fn`
+	is retried. Otherwise only the writes of `fn` are undone, back to a
+	savepoint taken before it, so the caller's earlier writes are kept. A
+	deadlock discards the whole transaction, including that savepoint; then
+	the conflict is raised to the caller, whose writes are lost anyway. Inside
+	`without_lock_conflict_retry`, conflicts are always raised to the caller
+	retrying the whole transaction.
+	"""
+	if frappe.flags.without_lock_conflict_retry:
+		return fn(*args, **kwargs)
+
+	# Imported here, as the statistics module imports this one
+	from duplicate.api.permission_statistics import get_statistic_savepoint, rollback_statistic_deltas
+
+	for attempt in range(LOCK_CONFLICT_RETRIES):
+		savepoint = None
+		if frappe.db.transaction_writes:
+			savepoint = f"lock_conflict_retry_{attempt}"
+			statistics = get_statistic_savepoint()
+			frappe.db.savepoint(savepoint)
+
+		try:
+			result = fn(*args, **kwargs)
+		except (frappe.QueryDeadlockError, frappe.QueryTimeoutError) as e:
+			if attempt == LOCK_CONFLICT_RETRIES - 1:
+				raise
+			if savepoint:
+				try:
+					frappe.db.rollback(save_point=savepoint)
+				except Exception:
+					# The savepoint went away with the whole transaction
+					raise e from None
+				rollback_statistic_deltas(statistics)
+			else:
+				frappe.db.rollback()
+			time.sleep(LOCK_CONFLICT_BACKOFF * 2**attempt * (1 + random.random()))
+			continue
+
+		if savepoint:
+			frappe.db.release_savepoint(savepoint)
+		return result
+
+
+@contextmanager
+def without_lock_conflict_retry():
+	"""Raise lock conflicts from `retry_on_lock_conflict` instead of retrying them
+
+	Used while one transaction holds several operations that are retried
+	together from the start.
+	"""
+	previous = frappe.flags.without_lock_conflict_retry
+	frappe.flags.without_lock_conflict_retry = True
+	try:
+		yield
+	finally:
+		frappe.flags.without_lock_conflict_retry = previous
@@ -0,0 +1,210 @@
+import frappe
+from frappe import _
+from frappe.utils import cint, now
+
+from duplicate.api.permission_locks import lock_users
+from duplicate.api.permission_targets import TARGET_USER_BATCH_SIZE, bind_users
+from duplicate.api.permission_writer import (
+	execute_permission_changes,
+	get_change_counts,
+	get_desired_permissions,
+	get_permission_changes,
+	get_permission_key,
+)
+
+# Plans are kept in Redis long enough to be reviewed and executed
+PERMISSION_PLAN_KEY = "user_permission_manager_plan"
+PERMISSION_PLAN_TTL = 30 * 60
+
+# Users shown per page of a plan summary
+PLAN_PAGE_LENGTH = 100
+
+# Users one plan may cover, as a plan is cached as a single Redis value
+PLAN_MAX_USERS = 2000
+
+
+def get_plan_key(plan_id):
+	"""Get the Redis key of a permission plan"""
+	return f"{PERMISSION_PLAN_KEY}:{plan_id}"
+
+
+def get_user_permissions_fingerprint(users):
+	"""Get the row count and last modification of the User Permissions of `users`
+
+	Used to detect writes made between planning and executing a plan.
+	"""
+	count, last_modified = 0, None
+	for start in range(0, len(users), TARGET_USER_BATCH_SIZE):
+		chunk_count, chunk_modified = frappe.db.sql(
+			"""
+			SELECT COUNT(*), MAX(modified)
+			FROM `tabUser Permission`
+			WHERE user IN %(users)s
+		""",
+			{"users": tuple(users[start : start + TARGET_USER_BATCH_SIZE])},
+		)[0]
+		count += chunk_count
+		if chunk_modified and (last_modified is None or chunk_modified > last_modified):
+			last_modified = chunk_modified
+
+	return [count, str(last_modified) if last_modified else None]
+
+
+def check_plan_size(users):
+	"""Refuse plans covering more than `PLAN_MAX_USERS` users"""
+	if len(users) > PLAN_MAX_USERS:
+		frappe.throw(
+			_("A plan can cover at most {0} users, please plan a page of users at a time").format(PLAN_MAX_USERS)
+		)
+
+
+def get_plan_target_users(manager):
+	"""Get the target users of a manager for a plan, reading no more than the plan may hold"""
+	users = []
+	for batch in manager.iter_target_user_batches():
+		users.extend(batch)
+		check_plan_size(users)
+	return users
+
+
+def build_permission_plan(manager, users):
+	"""Compute, without writing, what applying a manager to `users` would change
+
+	Changes are read with one non-locking query per chunk of users; execution
+	locks the users and checks nothing changed since. The plan is cached so
+	that `execute_plan` writes exactly what was reviewed.
+	"""
+	users = sorted(set(users))
+	check_plan_size(users)
+	chunks = []
+	for start in range(0, len(users), TARGET_USER_BATCH_SIZE):
+		chunk = users[start : start + TARGET_USER_BATCH_SIZE]
+		chunks.append({"users": chunk, "changes": get_permission_changes(manager, chunk, for_update=False)})
+
+	plan = {
+		"plan_id": frappe.generate_hash(length=12),
+		"manager": manager.name,
+		"manager_modified": str(manager.modified),
+		"owner": frappe.session.user,
+		"created": now(),
+		"fingerprint": get_user_permissions_fingerprint(users),
+		"desired_count": len(get_desired_permissions(manager)),
+		"chunks": chunks,
+	}
+	frappe.cache().set_value(get_plan_key(plan["plan_id"]), plan, expires_in_sec=PERMISSION_PLAN_TTL)
+	return plan
+
+
+def get_permission_plan(plan_id):
+	"""Load a cached plan, checking that the current user may use it"""
+	plan = frappe.cache().get_value(get_plan_key(plan_id))
+	if not plan:
+		frappe.throw(_("Permission plan {0} not found or expired").format(plan_id))
+
+	if plan["owner"] != frappe.session.user and "System Manager" not in frappe.get_roles():
+		frappe.throw(_("Not permitted"), frappe.PermissionError)
+
+	return plan
+
+
+def get_plan_user_changes(plan):
+	"""Get the changes of a plan per user, in user order
+
+	Released rows are listed as deleted: they are removed unless another
+	manager still grants them.
+	"""
+	user_changes = {}
+	for chunk in plan["chunks"]:
+		for user in chunk["users"]:
+			user_changes[user] = {"insert": [], "update": [], "delete": [], "own": [], "unchanged": 0}
+
+		changes = chunk["changes"]
+		changed_keys = {}
+		for row in [*changes["update"], *changes["own"]]:
+			changed_keys.setdefault(row.user, set()).add(
+				get_permission_key(row.allow, row.for_value, row.applicable_for)
+			)
+		for row in changes["insert"]:
+			changed_keys.setdefault(row.user, set()).add(row.key)
+		for user in chunk["users"]:
+			user_changes[user]["unchanged"] = plan["desired_count"] - len(changed_keys.get(user, ()))
+
+		for row in changes["insert"]:
+			user_changes[row.user]["insert"].append(format_plan_row(*row.key, row.permission_values))
+		for row in changes["update"]:
+			user_changes[row.user]["update"].append(
+				format_plan_row(row.allow, row.for_value, row.applicable_for, row.permission_values)
+			)
+		for kind, rows in (("delete", changes["release"]), ("own", changes["own"])):
+			for row in rows:
+				user_changes[row.user][kind].append(format_plan_row(row.allow, row.for_value, row.applicable_for))
+
+	return user_changes
+
+
+def format_plan_row(allow, for_value, applicable_for=None, values=None):
+	"""Describe one planned User Permission row"""
+	row = {"allow": allow, "for_value": for_value, "applicable_for": applicable_for or None}
+	if values:
+		row.update(zip(("apply_to_all_doctypes", "is_default", "hide_descendants"), values, strict=True))
+	return row
+
+
+def get_plan_summary(plan, start=0, page_length=PLAN_PAGE_LENGTH):
+	"""Get the totals of a plan and one page of its per-user changes
+
+	Users whose permissions are all unchanged are counted but not listed.
+	"""
+	totals = {"inserted": 0, "updated": 0, "owned": 0, "released": 0, "unchanged": 0}
+	for chunk in plan["chunks"]:
+		for key, count in get_change_counts(chunk["changes"]).items():
+			totals[key] += count
+
+	user_changes = get_plan_user_changes(plan)
+	changed_users = [
+		{"user": user, **changes}
+		for user, changes in user_changes.items()
+		if changes["insert"] or changes["update"] or changes["delete"] or changes["own"]
+	]
+
+	start = cint(start)
+	page_length = cint(page_length) or PLAN_PAGE_LENGTH
+	return {
+		"plan_id": plan["plan_id"],
+		"manager": plan["manager"],
+		"created": plan["created"],
+		"totals": totals,
+		"user_count": len(user_changes),
+		"changed_user_count": len(changed_users),
+		"users": changed_users[start : start + page_length],
+		"has_more": len(changed_users) > start + page_length,
+	}
+
+
+def execute_plan(plan_id):
+	"""Write a cached plan as-is in one transaction, binding its users to the manager
+
+	Refuses plans whose manager or users' permissions changed since planning,
+	since the plan would no longer describe what gets written.
+	"""
+	plan = get_permission_plan(plan_id)
+	manager_modified = frappe.db.get_value("User Permission Manager", plan["manager"], "modified")
+	users = [user for chunk in plan["chunks"] for user in chunk["users"]]
+
+	if str(manager_modified) != plan["manager_modified"]:
+		frappe.throw(_("The manager changed since this plan was made, please preview it again"))
+
+	lock_users(users)
+	if get_user_permissions_fingerprint(users) != plan["fingerprint"]:
+		frappe.throw(_("User Permissions changed since this plan was made, please preview it again"))
+
+	# Planned users stay targets of the manager, like users it was applied to by hand
+	explicit_user = frappe.db.get_value("User Permission Manager", plan["manager"], "user_field")
+	bind_users(plan["manager"], [user for user in users if user != explicit_user])
+	for chunk in plan["chunks"]:
+		execute_permission_changes(plan["manager"], chunk["changes"])
+
+	frappe.db.commit()
+	frappe.cache().delete_value(get_plan_key(plan_id))
+	return get_plan_summary(plan)
+
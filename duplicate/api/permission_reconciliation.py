@@ -0,0 +1,288 @@
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import flt, now_datetime
+
+from duplicate.api.permission_jobs import (
+	SYNC_SHARD_TIMEOUT,
+	append_sync_log_items,
+	get_manager_lock_name,
+	mark_sync_log_failed,
+)
+from duplicate.api.permission_locks import advisory_lock
+from duplicate.api.permission_targets import MANAGER_TARGET_FIELDS, get_target_user_counts
+from duplicate.api.permission_writer import apply_manager_to_users
+
+# A reconciliation job stops and re-enqueues itself after this many seconds,
+# well inside the job timeout
+RECONCILIATION_TIME_BUDGET = 30 * 60
+
+
+def get_reconciliation_job_id(sync_log, hop=None):
+	"""Get the background job id running a reconciliation, or one continuation of it"""
+	job_id = f"user_permission_reconciliation:{sync_log}"
+	return f"{job_id}:{hop}" if hop is not None else job_id
+
+
+def start_reconciliation():
+	"""Create a Reconciliation sync log for all active managers and start running it"""
+	managers = frappe.get_all(
+		"User Permission Manager", filters={"is_active": 1}, fields=["name", *MANAGER_TARGET_FIELDS]
+	)
+
+	sync_log = frappe.get_doc(
+		{
+			"doctype": "User Permission Sync Log",
+			"operation": "Reconciliation",
+			"status": "Queued",
+			"started_on": now_datetime(),
+			"total_managers": len(managers),
+			"total_shards": 1,
+			"total_pairs": sum(get_target_user_counts(managers).values()),
+		}
+	).insert(ignore_permissions=True)
+
+	enqueue_reconciliation(sync_log.name)
+	return sync_log.name
+
+
+def enqueue_reconciliation(sync_log, hop=None):
+	"""Enqueue the job running a reconciliation from its last checkpoint
+
+	A running job continues itself with a `hop` of its own, since a job with
+	the same id as the running one would be dropped as a duplicate.
+	"""
+	frappe.enqueue(
+		"duplicate.api.permission_reconciliation.run_reconciliation",
+		queue="long",
+		timeout=SYNC_SHARD_TIMEOUT,
+		job_id=get_reconciliation_job_id(sync_log, hop),
+		deduplicate=True,
+		enqueue_after_commit=True,
+		sync_log=sync_log,
+	)
+
+
+def get_remaining_managers(log):
+	"""Get the managers left to reconcile, with the cursor to resume the first one after"""
+	filters = {"is_active": 1}
+	if log.checkpoint_manager:
+		# An empty checkpoint user means the checkpoint manager is finished
+		filters["name"] = [">=" if log.checkpoint_user else ">", log.checkpoint_manager]
+
+	managers = frappe.get_all("User Permission Manager", filters=filters, order_by="name asc", pluck="name")
+	return [
+		(manager_name, log.checkpoint_user if manager_name == log.checkpoint_manager else None)
+		for manager_name in managers
+	]
+
+
+def run_reconciliation(sync_log):
+	"""Background job walking (manager, user) pairs from the last checkpoint
+
+	Each chunk of users is written and checkpointed in the same transaction,
+	so a worker restart never redoes a finished chunk. Once the time budget is
+	spent the job stops and enqueues a continuation under a job id of its own.
+	"""
+	with advisory_lock(get_reconciliation_job_id(sync_log)) as acquired:
+		if not acquired:
+			return
+
+		try:
+			hop = reconcile_until_budget(sync_log)
+		except Exception:
+			# Ended as Failed, so the hourly resume does not retry it forever
+			frappe.db.rollback()
+			frappe.log_error(title="User Permission Reconciliation Failed", message=frappe.get_traceback())
+			mark_sync_log_failed(sync_log, frappe.get_traceback())
+			return
+
+	if hop is not None:
+		# Enqueued once the lock is released, so the continuation can take it
+		enqueue_reconciliation(sync_log, hop)
+		frappe.db.commit()
+
+
+def reconcile_until_budget(sync_log):
+	"""Reconcile from the last checkpoint until done or out of time
+
+	Managers locked by another sync are skipped and recorded, and retried once
+	the other managers are done; while some are left, the log stays Running for
+	the hourly resume. A manager whose reconciliation raises is recorded as
+	Failed and not retried, and the log ends as Failed.
+
+	Returns the hop of the continuation to enqueue when out of time.
+	"""
+	log = frappe.get_doc("User Permission Sync Log", sync_log)
+	if log.status in ("Completed", "Failed"):
+		return
+
+	log.db_set("status", "Running", update_modified=False)
+	frappe.db.commit()
+
+	job_start = time.monotonic()
+	chunk_start = job_start
+
+	# Skipped managers are retried from their first user, without moving the checkpoint back
+	managers = [
+		*((manager_name, after, False) for manager_name, after in get_remaining_managers(log)),
+		*((manager_name, None, True) for manager_name in get_skipped_managers(sync_log)),
+	]
+	for manager_name, after, retry in managers:
+		with advisory_lock(get_manager_lock_name(manager_name)) as acquired:
+			if not acquired:
+				if not retry:
+					set_manager_result(sync_log, manager_name, "Skipped", _("Another sync of this manager is running"))
+					save_checkpoint(log, manager_name, None, 0, time.monotonic() - chunk_start)
+					chunk_start = time.monotonic()
+				continue
+
+			try:
+				manager = frappe.get_doc("User Permission Manager", manager_name)
+				manager.ensure_user_permission_custom_field()
+
+				for users in manager.iter_target_user_batches(after=after):
+					apply_manager_to_users(manager, users)
+
+					now = time.monotonic()
+					if retry:
+						save_progress(log, len(users), now - chunk_start)
+					else:
+						save_checkpoint(log, manager_name, users[-1], len(users), now - chunk_start)
+					chunk_start = now
+
+					if now - job_start > RECONCILIATION_TIME_BUDGET:
+						return log.processed_pairs
+			except Exception as e:
+				frappe.db.rollback()
+				frappe.log_error(title="User Permission Reconciliation Failed", message=frappe.get_traceback())
+				set_manager_result(sync_log, manager_name, "Failed", str(e))
+			else:
+				if retry:
+					set_manager_result(sync_log, manager_name, "Success", _("Reconciled after being skipped"))
+
+			if not retry:
+				save_checkpoint(log, manager_name, None, 0, time.monotonic() - chunk_start)
+			chunk_start = time.monotonic()
+
+	if get_skipped_managers(sync_log):
+		# Left Running for `resume_stalled_reconciliations` to retry them
+		return
+
+	failed_count = frappe.db.count("User Permission Sync Log Item", {"parent": sync_log, "status": "Failed"})
+	finished_on = now_datetime()
+	frappe.db.set_value(
+		"User Permission Sync Log",
+		sync_log,
+		{
+			"status": "Failed" if failed_count else "Completed",
+			"finished_on": finished_on,
+			"duration": log.elapsed_seconds,
+			"finished_shards": 1,
+			"failed_count": failed_count,
+		},
+		update_modified=False,
+	)
+	frappe.db.commit()
+
+
+def get_skipped_managers(sync_log):
+	"""Get the managers a reconciliation skipped because they were locked"""
+	return frappe.get_all(
+		"User Permission Sync Log Item",
+		filters={"parent": sync_log, "status": "Skipped"},
+		order_by="idx asc",
+		pluck="user_permission_manager",
+	)
+
+
+def set_manager_result(sync_log, manager_name, status, message):
+	"""Record the outcome of a manager in a reconciliation log, replacing its previous one"""
+	item = frappe.db.get_value(
+		"User Permission Sync Log Item", {"parent": sync_log, "user_permission_manager": manager_name}
+	)
+	if item:
+		frappe.db.set_value(
+			"User Permission Sync Log Item", item, {"status": status, "message": message}, update_modified=False
+		)
+	else:
+		frappe.db.get_value("User Permission Sync Log", sync_log, "name", for_update=True)
+		append_sync_log_items(sync_log, [{"manager": manager_name, "status": status, "message": message}])
+	frappe.db.commit()
+
+
+def save_checkpoint(log, manager_name, user, pairs, elapsed):
+	"""Store the reconciliation progress and commit it together with the chunk's writes"""
+	log.checkpoint_manager = manager_name
+	log.checkpoint_user = user
+	frappe.db.set_value(
+		"User Permission Sync Log",
+		log.name,
+		{"checkpoint_manager": log.checkpoint_manager, "checkpoint_user": log.checkpoint_user},
+		update_modified=False,
+	)
+	save_progress(log, pairs, elapsed)
+
+
+def save_progress(log, pairs, elapsed):
+	"""Add processed pairs and elapsed time to the reconciliation log and commit with the chunk's writes"""
+	log.processed_pairs = (log.processed_pairs or 0) + pairs
+	log.elapsed_seconds = flt(log.elapsed_seconds) + elapsed
+
+	frappe.db.set_value(
+		"User Permission Sync Log",
+		log.name,
+		{"processed_pairs": log.processed_pairs, "elapsed_seconds": log.elapsed_seconds},
+		update_modified=False,
+	)
+	frappe.db.commit()
+
+
+def resume_stalled_reconciliations():
+	"""Scheduled job re-enqueueing reconciliations whose worker stopped
+
+	Running jobs hold the reconciliation lock and deduplicate by job id, so
+	re-enqueueing a reconciliation that is still running is a no-op.
+	"""
+	for sync_log in frappe.get_all(
+		"User Permission Sync Log",
+		filters={"operation": "Reconciliation", "status": ["in", ["Queued", "Running"]]},
+		pluck="name",
+	):
+		enqueue_reconciliation(sync_log)
+
+
+def get_reconciliation_progress(sync_log):
+	"""Get the progress of a reconciliation with its throughput in pairs per second and ETA"""
+	log = frappe.db.get_value(
+		"User Permission Sync Log",
+		sync_log,
+		[
+			"name",
+			"operation",
+			"status",
+			"started_on",
+			"finished_on",
+			"checkpoint_manager",
+			"checkpoint_user",
+			"total_pairs",
+			"processed_pairs",
+			"elapsed_seconds",
+			"failed_count",
+		],
+		as_dict=True,
+	)
+	if not log or log.operation != "Reconciliation":
+		frappe.throw(_("Reconciliation {0} not found").format(sync_log))
+
+	throughput = log.processed_pairs / log.elapsed_seconds if log.elapsed_seconds else 0
+	remaining = max(log.total_pairs - log.processed_pairs, 0)
+	log.update(
+		{
+			"throughput": flt(throughput, 2),
+			"eta_seconds": flt(remaining / throughput, 0) if throughput and log.status in ("Queued", "Running") else None,
+			"progress": flt(log.processed_pairs * 100 / log.total_pairs, 2) if log.total_pairs else 100,
+		}
+	)
+	return log
@@ -0,0 +1,239 @@
+import frappe
+from frappe.utils import now
+
+from duplicate.api.permission_locks import advisory_lock
+from duplicate.duplicate.doctype.user_permission_statistic.user_permission_statistic import (
+	get_statistic_name,
+)
+
+STATISTIC_DOCTYPE = "User Permission Statistic"
+
+# Statistic rows updated per statement
+STATISTIC_CHUNK_SIZE = 500
+
+# Number of most granted DocTypes reported
+COMMON_PERMISSION_LIMIT = 5
+
+
+def get_pending_deltas():
+	"""Get the statistic deltas queued by the current transaction
+
+	Deltas are written right before the transaction commits, so the summary
+	rows stay locked only for the duration of the commit.
+	"""
+	deltas = getattr(frappe.local, "user_permission_statistic_deltas", None)
+	if deltas is None:
+		deltas = frappe.local.user_permission_statistic_deltas = {}
+		frappe.db.before_commit.add(flush_statistic_deltas)
+		frappe.db.after_rollback.add(discard_statistic_deltas)
+	return deltas
+
+
+def count_permission_changes(rows, sign=1):
+	"""Queue the statistic changes of inserting (`sign=1`) or deleting (`sign=-1`) User Permissions
+
+	`rows` have the `user`, `allow` and `user_permission_manager` of each permission.
+	"""
+	deltas = get_pending_deltas()
+	for row in rows:
+		keys = [("Total", None), ("User", row.user), ("Allow", row.allow)]
+		if row.get("user_permission_manager"):
+			keys.append(("Managed", None))
+		for key in keys:
+			deltas[key] = deltas.get(key, 0) + sign
+
+
+def count_adopted_permissions(count):
+	"""Queue the statistic change of `count` manual User Permissions becoming managed"""
+	if count:
+		deltas = get_pending_deltas()
+		deltas[("Managed", None)] = deltas.get(("Managed", None), 0) + count
+
+
+def discard_statistic_deltas():
+	"""Drop the deltas of a rolled back transaction"""
+	frappe.local.user_permission_statistic_deltas = None
+
+
+def get_statistic_savepoint():
+	"""Copy the queued deltas, to restore them when rolling back to a savepoint"""
+	return dict(getattr(frappe.local, "user_permission_statistic_deltas", None) or {})
+
+
+def rollback_statistic_deltas(saved):
+	"""Restore the deltas queued when `get_statistic_savepoint` was called"""
+	deltas = getattr(frappe.local, "user_permission_statistic_deltas", None)
+	if deltas is not None:
+		deltas.clear()
+		deltas.update(saved)
+
+
+def flush_statistic_deltas():
+	"""Add the queued deltas to the summary rows
+
+	A failing flush must not abort the caller's commit: its writes are rolled
+	back to a savepoint and logged, and the daily recount repairs the counts.
+	"""
+	deltas = frappe.local.user_permission_statistic_deltas or {}
+	frappe.local.user_permission_statistic_deltas = None
+	if not any(deltas.values()):
+		return
+
+	frappe.db.savepoint("user_permission_statistics")
+	try:
+		apply_statistic_deltas(deltas)
+	except Exception as e:
+		try:
+			frappe.db.rollback(save_point="user_permission_statistics")
+		except Exception:
+			# The savepoint went away with the whole transaction
+			raise e from None
+		frappe.log_error(title="User Permission Statistics Update Failed", message=frappe.get_traceback())
+	else:
+		frappe.db.release_savepoint("user_permission_statistics")
+
+
+def apply_statistic_deltas(deltas):
+	"""Add `deltas` to the summary rows
+
+	Rows are locked in name order with one statement per chunk, so concurrent
+	flushes cannot deadlock on each other.
+	"""
+	changes = sorted(
+		(get_statistic_name(*key), key, delta) for key, delta in deltas.items() if delta
+	)
+	if not changes:
+		return
+
+	insert_statistic_rows([(name, *key, 0) for name, key, _delta in changes], ignore_duplicates=True)
+	for start in range(0, len(changes), STATISTIC_CHUNK_SIZE):
+		chunk = changes[start : start + STATISTIC_CHUNK_SIZE]
+		frappe.db.sql(
+			f"""
+			UPDATE `tabUser Permission Statistic`
+			SET value = value + CASE name {" ".join(["WHEN %s THEN %s"] * len(chunk))} ELSE 0 END
+			WHERE name IN %s
+		""",
+			(*(value for name, _key, delta in chunk for value in (name, delta)), tuple(name for name, *_ in chunk)),
+		)
+
+	# The number of users with permissions changes when a user's count leaves or reaches zero
+	user_deltas = {name: delta for name, key, delta in changes if key[0] == "User"}
+	if not user_deltas:
+		return
+
+	values = dict(
+		frappe.db.sql(
+			"SELECT name, value FROM `tabUser Permission Statistic` WHERE name IN %(names)s",
+			{"names": tuple(user_deltas)},
+		)
+	)
+	users_delta = 0
+	for name, delta in user_deltas.items():
+		value = values.get(name, 0)
+		users_delta += (value > 0) - (value - delta > 0)
+
+	emptied = tuple(name for name, value in values.items() if value <= 0)
+	if emptied:
+		frappe.db.sql("DELETE FROM `tabUser Permission Statistic` WHERE name IN %(names)s", {"names": emptied})
+
+	if users_delta:
+		insert_statistic_rows([("Users", "Users", None, 0)], ignore_duplicates=True)
+		frappe.db.sql(
+			"UPDATE `tabUser Permission Statistic` SET value = value + %(delta)s WHERE name = 'Users'",
+			{"delta": users_delta},
+		)
+
+
+def insert_statistic_rows(rows, ignore_duplicates=False):
+	"""Insert `(name, statistic_type, reference, value)` summary rows"""
+	timestamp = now()
+	frappe.db.bulk_insert(
+		STATISTIC_DOCTYPE,
+		fields=["name", "creation", "modified", "modified_by", "owner", "docstatus", "statistic_type", "reference", "value"],
+		values=[(name, timestamp, timestamp, "Administrator", "Administrator", 0, *row) for name, *row in rows],
+		ignore_duplicates=ignore_duplicates,
+		chunk_size=STATISTIC_CHUNK_SIZE,
+	)
+
+
+def recount_permission_statistics():
+	"""Scheduled job recomputing every statistic from `tabUser Permission`
+
+	Corrects any drift of the incremental counts, e.g. from rows written
+	outside of this app.
+	"""
+	with advisory_lock("user_permission_statistic_recount") as acquired:
+		if not acquired:
+			return
+
+		user_counts = frappe.db.sql("SELECT user, COUNT(*) FROM `tabUser Permission` GROUP BY user")
+		allow_counts = frappe.db.sql("SELECT allow, COUNT(*) FROM `tabUser Permission` GROUP BY allow")
+		managed = 0
+		if frappe.db.has_column("User Permission", "user_permission_manager"):
+			managed = frappe.db.sql(
+				"""
+				SELECT COUNT(*) FROM `tabUser Permission`
+				WHERE COALESCE(user_permission_manager, '') != ''
+			"""
+			)[0][0]
+
+		rows = [
+			("Total", None, sum(count for _user, count in user_counts)),
+			("Managed", None, managed),
+			("Users", None, len(user_counts)),
+			*(("User", user, count) for user, count in user_counts),
+			*(("Allow", allow, count) for allow, count in allow_counts),
+		]
+
+		frappe.local.user_permission_statistic_deltas = None
+		frappe.db.delete(STATISTIC_DOCTYPE)
+		insert_statistic_rows([(get_statistic_name(kind, reference), kind, reference, value) for kind, reference, value in rows])
+		frappe.db.commit()
+
+
+def get_statistics():
+	"""Read the permission totals and the most granted DocTypes from the summary rows"""
+	totals = dict(
+		frappe.get_all(
+			STATISTIC_DOCTYPE,
+			filters={"name": ["in", ["Total", "Managed", "Users"]]},
+			fields=["name", "value"],
+			as_list=True,
+		)
+	)
+	common_permissions = frappe.get_all(
+		STATISTIC_DOCTYPE,
+		filters={"statistic_type": "Allow", "value": [">", 0]},
+		fields=["reference as allow", "value as count"],
+		order_by="value desc",
+		limit_page_length=COMMON_PERMISSION_LIMIT,
+	)
+
+	return {
+		"total_permissions": totals.get("Total", 0),
+		"managed_permissions": totals.get("Managed", 0),
+		"manual_permissions": totals.get("Total", 0) - totals.get("Managed", 0),
+		"users_with_permissions": totals.get("Users", 0),
+		"common_permissions": common_permissions,
+	}
+
+
+def update_permission_statistics(doc, method=None):
+	"""User Permission `on_update` hook counting inserted and changed rows"""
+	previous = doc.get_doc_before_save()
+	if previous:
+		if (previous.user, previous.allow, bool(previous.get("user_permission_manager"))) == (
+			doc.user,
+			doc.allow,
+			bool(doc.get("user_permission_manager")),
+		):
+			return
+		count_permission_changes([previous], -1)
+
+	count_permission_changes([doc])
+
+
+def remove_permission_statistics(doc, method=None):
+	"""User Permission `on_trash` hook counting deleted rows"""
+	count_permission_changes([doc], -1)
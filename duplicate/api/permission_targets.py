@@ -0,0 +1,398 @@
+import heapq
+import json
+
+import frappe
+from frappe import _
+from frappe.utils import cint, now
+
+from duplicate.api.response_versions import bump_versions
+from duplicate.duplicate.doctype.user_permission_manager_binding.user_permission_manager_binding import (
+	get_binding_name,
+)
+
+# Number of users resolved and applied per chunk
+TARGET_USER_BATCH_SIZE = 1000
+
+# Fields of a manager needed to count its target users
+MANAGER_TARGET_FIELDS = ["is_template", "apply_to_all_users", "user_field", "target_role", "target_user_filter"]
+
+# Resolved counts and preview pages are cached for a short while only,
+# since role assignments and user records change outside of the manager
+TARGET_USER_CACHE_KEY = "user_permission_manager_targets"
+TARGET_USER_CACHE_TTL = 300
+
+
+def has_rule_targets(manager):
+	"""Check if a manager targets all users, or users by role or saved filter"""
+	return bool(
+		manager.get("apply_to_all_users") or manager.get("target_role") or manager.get("target_user_filter")
+	)
+
+
+def has_bound_users(manager_name):
+	"""Check if any user is bound to a manager"""
+	return bool(frappe.db.exists("User Permission Manager Binding", {"user_permission_manager": manager_name}))
+
+
+def has_target_users(manager):
+	"""Check if a manager targets any user at all"""
+	return bool(manager.get("user_field") or has_rule_targets(manager) or has_bound_users(manager.name))
+
+
+def get_saved_user_filters(list_filter):
+	"""Get the filters of a saved User list filter as a list of [doctype, field, operator, value]"""
+	reference_doctype, filters = frappe.db.get_value(
+		"List Filter", list_filter, ["reference_doctype", "filters"]
+	) or (None, None)
+
+	if reference_doctype != "User":
+		frappe.throw(_("Saved filter {0} does not filter Users").format(list_filter))
+
+	filters = json.loads(filters or "[]")
+	if isinstance(filters, dict):
+		return [["User", fieldname, "=", value] for fieldname, value in filters.items()]
+
+	return [list(f[:4]) if len(f) > 3 else ["User", *f[:3]] for f in filters]
+
+
+def get_rule_filters(manager):
+	"""Get the User filters selected by the role and saved filter of a manager
+
+	Managers applied to all users select every enabled System User.
+	"""
+	filters = [
+		["User", "enabled", "=", 1],
+		["User", "user_type", "=", "System User"],
+	]
+
+	if manager.get("apply_to_all_users"):
+		return filters
+
+	if manager.get("target_role"):
+		filters.append(["Has Role", "role", "=", manager.target_role])
+
+	if manager.get("target_user_filter"):
+		filters.extend(get_saved_user_filters(manager.target_user_filter))
+
+	return filters
+
+
+def explicit_user_matches_rules(manager):
+	"""Check if the explicit `user_field` of a manager is also selected by its rules"""
+	return bool(
+		frappe.get_all(
+			"User",
+			filters=[*get_rule_filters(manager), ["User", "name", "=", manager.user_field]],
+			limit_page_length=1,
+		)
+	)
+
+
+def iter_target_user_batches(manager, batch_size=None, after=None):
+	"""Yield the target users of a manager, `batch_size` users at a time
+
+	Targets are the users selected by the rules, the explicit `user_field` and
+	the users bound to the manager; template managers only have bound users.
+	Rule based and bound users are each paged with a keyset on the user name
+	and merged in name order, so memory use is bounded by the batch size
+	whatever the number of matching users. The last user of a batch is a valid
+	`after` cursor to resume from.
+	"""
+	batch_size = cint(batch_size) or TARGET_USER_BATCH_SIZE
+
+	sources = [iter_keyset_users(get_bound_user_page, manager.name, batch_size, after)]
+	if has_rule_targets(manager):
+		sources.append(iter_keyset_users(get_rule_user_page, get_rule_filters(manager), batch_size, after))
+
+	explicit_user = manager.get("user_field")
+	if explicit_user and (not after or get_user_sort_key(explicit_user) > get_user_sort_key(after)):
+		sources.append([explicit_user])
+
+	batch = []
+	last = None
+	for user in heapq.merge(*sources, key=get_user_sort_key):
+		# A user selected by several sources is yielded once
+		if last is not None and get_user_sort_key(user) == get_user_sort_key(last):
+			continue
+
+		last = user
+		batch.append(user)
+		if len(batch) == batch_size:
+			yield batch
+			batch = []
+
+	if batch:
+		yield batch
+
+
+def get_user_sort_key(user):
+	"""Order user names like the case-insensitive collation of the database"""
+	return user.lower()
+
+
+def iter_keyset_users(get_page, source, batch_size, after=None):
+	"""Yield the users of a source one by one, reading `batch_size` at a time after the cursor"""
+	while True:
+		users = get_page(source, after, batch_size)
+		yield from users
+
+		if len(users) < batch_size:
+			return
+
+		after = users[-1]
+
+
+def get_rule_user_page(filters, after, page_length):
+	"""Get one page of the users selected by rule filters, in name order"""
+	return frappe.get_all(
+		"User",
+		filters=[*filters, ["User", "name", ">", after]] if after else filters,
+		order_by="`tabUser`.`name` asc",
+		limit_page_length=page_length,
+		pluck="name",
+		distinct=True,
+	)
+
+
+def get_bound_user_page(manager_name, after, page_length):
+	"""Get one page of the users bound to a manager, in name order"""
+	filters = {"user_permission_manager": manager_name}
+	if after:
+		filters["user"] = [">", after]
+
+	return frappe.get_all(
+		"User Permission Manager Binding",
+		filters=filters,
+		order_by="user asc",
+		limit_page_length=page_length,
+		pluck="user",
+	)
+
+
+def bind_users(manager_name, users):
+	"""Record that a manager was applied to `users` explicitly, skipping known bindings
+
+	Bound users are the targets of template managers, and keep users a regular
+	manager was applied to by hand from being treated as drift.
+	"""
+	timestamp = now()
+	session_user = frappe.session.user
+	frappe.db.bulk_insert(
+		"User Permission Manager Binding",
+		fields=["name", "creation", "modified", "modified_by", "owner", "docstatus", "user_permission_manager", "user"],
+		values=[
+			(get_binding_name(manager_name, user), timestamp, timestamp, session_user, session_user, 0, manager_name, user)
+			for user in users
+		],
+		ignore_duplicates=True,
+		chunk_size=TARGET_USER_BATCH_SIZE,
+	)
+	clear_target_user_cache(manager_name)
+
+
+def unbind_users(manager_name, users=None):
+	"""Drop the bindings of a manager to `users`, or to all users"""
+	if users is None:
+		frappe.db.delete("User Permission Manager Binding", {"user_permission_manager": manager_name})
+	else:
+		for start in range(0, len(users), TARGET_USER_BATCH_SIZE):
+			frappe.db.delete(
+				"User Permission Manager Binding",
+				{"user_permission_manager": manager_name, "user": ["in", users[start : start + TARGET_USER_BATCH_SIZE]]},
+			)
+	clear_target_user_cache(manager_name)
+
+
+def get_target_user_count(manager):
+	"""Get the number of target users of a manager, cached for a short while"""
+	cache_key = f"{TARGET_USER_CACHE_KEY}:{manager.name}:count"
+	count = frappe.cache().get_value(cache_key)
+	if count is None:
+		explicit_user = manager.get("user_field")
+		count = 0
+		if has_rule_targets(manager):
+			count = frappe.get_all(
+				"User",
+				filters=get_rule_filters(manager),
+				fields=["count(distinct `tabUser`.`name`) as total"],
+			)[0].total
+			if explicit_user and not explicit_user_matches_rules(manager):
+				count += 1
+		elif explicit_user:
+			count = 1
+
+		count += count_extra_bound_users(manager)
+		frappe.cache().set_value(cache_key, count, expires_in_sec=TARGET_USER_CACHE_TTL)
+
+	return count
+
+
+def count_extra_bound_users(manager):
+	"""Count the users bound to a manager that its rules and `user_field` do not already select"""
+	rule_filters = get_rule_filters(manager) if has_rule_targets(manager) else None
+	count = 0
+	for users in iter_bound_user_batches(manager.name):
+		users = [user for user in users if user != manager.get("user_field")]
+		if users and rule_filters:
+			matched = frappe.get_all(
+				"User",
+				filters=[*rule_filters, ["User", "name", "in", users]],
+				pluck="name",
+				distinct=True,
+			)
+			users = set(users) - set(matched)
+		count += len(users)
+	return count
+
+
+def get_untargeted_users(manager, users):
+	"""Get the `users` a manager does not target anymore, with one query per kind of target"""
+	users = set(users) - {manager.get("user_field")}
+	if users and has_rule_targets(manager):
+		users -= set(
+			frappe.get_all(
+				"User",
+				filters=[*get_rule_filters(manager), ["User", "name", "in", list(users)]],
+				pluck="name",
+				distinct=True,
+			)
+		)
+
+	if users:
+		users -= set(
+			frappe.get_all(
+				"User Permission Manager Binding",
+				filters={"user_permission_manager": manager.name, "user": ["in", list(users)]},
+				pluck="user",
+			)
+		)
+	return users
+
+
+def iter_bound_user_batches(manager_name, batch_size=None, after=None):
+	"""Yield the users bound to a manager, paged with a keyset on the user"""
+	batch_size = cint(batch_size) or TARGET_USER_BATCH_SIZE
+	while True:
+		users = get_bound_user_page(manager_name, after, batch_size)
+		if users:
+			yield users
+
+		if len(users) < batch_size:
+			return
+
+		after = users[-1]
+
+
+def get_target_user_counts(managers):
+	"""Get the number of target users of many managers with a few grouped queries
+
+	`managers` are rows with the targeting fields of each manager. Managers
+	targeting a saved filter, and regular managers with bound users, are
+	counted one by one with `get_target_user_count`.
+	"""
+	binding_counts = {}
+	if managers:
+		binding_counts = dict(
+			frappe.db.sql(
+				"""
+				SELECT user_permission_manager, COUNT(*)
+				FROM `tabUser Permission Manager Binding`
+				WHERE user_permission_manager IN %(managers)s
+				GROUP BY user_permission_manager
+			""",
+				{"managers": tuple(manager.name for manager in managers)},
+			)
+		)
+
+	counts = {}
+	grouped = []
+	for manager in managers:
+		if manager.get("is_template"):
+			counts[manager.name] = binding_counts.get(manager.name, 0)
+		elif manager.get("target_user_filter") or binding_counts.get(manager.name):
+			counts[manager.name] = get_target_user_count(manager)
+		else:
+			grouped.append(manager)
+
+	rule_managers = [manager for manager in grouped if has_rule_targets(manager)]
+	roles = tuple({manager.target_role for manager in rule_managers if not manager.apply_to_all_users})
+	explicit_users = tuple({manager.user_field for manager in rule_managers if manager.get("user_field")})
+
+	all_users_count = 0
+	if any(manager.apply_to_all_users for manager in rule_managers):
+		all_users_count = frappe.db.count("User", {"enabled": 1, "user_type": "System User"})
+
+	role_counts = {}
+	if roles:
+		role_counts = dict(
+			frappe.db.sql(
+				"""
+				SELECT hr.role, COUNT(DISTINCT hr.parent)
+				FROM `tabHas Role` hr
+				INNER JOIN `tabUser` u ON u.name = hr.parent AND u.enabled = 1 AND u.user_type = 'System User'
+				WHERE hr.parenttype = 'User' AND hr.role IN %(roles)s
+				GROUP BY hr.role
+			""",
+				{"roles": roles},
+			)
+		)
+
+	# Explicit users already selected by the rules are not counted twice
+	enabled_users, user_roles = set(), set()
+	if explicit_users:
+		for user, role in frappe.db.sql(
+			"""
+			SELECT u.name, hr.role
+			FROM `tabUser` u
+			LEFT JOIN `tabHas Role` hr ON hr.parent = u.name AND hr.parenttype = 'User' AND hr.role IN %(roles)s
+			WHERE u.name IN %(users)s AND u.enabled = 1 AND u.user_type = 'System User'
+		""",
+			{"users": explicit_users, "roles": roles or ("",)},
+		):
+			enabled_users.add(user)
+			user_roles.add((user, role))
+
+	for manager in grouped:
+		explicit_user = manager.get("user_field")
+		if not has_rule_targets(manager):
+			counts[manager.name] = 1 if explicit_user else 0
+		elif manager.apply_to_all_users:
+			counts[manager.name] = all_users_count + (1 if explicit_user and explicit_user not in enabled_users else 0)
+		else:
+			counts[manager.name] = role_counts.get(manager.target_role, 0) + (
+				1 if explicit_user and (explicit_user, manager.target_role) not in user_roles else 0
+			)
+
+	return counts
+
+
+def get_target_user_page(manager, after=None, page_length=20):
+	"""Get one page of target users after the `after` cursor, cached for a short while
+
+	Returns the users and the cursor of the next page, if any.
+	"""
+	page_length = cint(page_length) or 20
+	cache_key = f"{TARGET_USER_CACHE_KEY}:{manager.name}:page:{after or ''}:{page_length}"
+	page = frappe.cache().get_value(cache_key)
+
+	if page is None:
+		users = []
+		for batch in iter_target_user_batches(manager, batch_size=page_length, after=after):
+			users.extend(batch)
+			if len(users) >= page_length:
+				break
+
+		users = users[:page_length]
+		page = {
+			"users": users,
+			"next_after": users[-1] if len(users) == page_length else None,
+		}
+		frappe.cache().set_value(cache_key, page, expires_in_sec=TARGET_USER_CACHE_TTL)
+
+	return page
+
+
+def clear_target_user_cache(manager_name):
+	"""Drop cached target counts and pages of a manager, with the version of its preview"""
+	frappe.cache().delete_keys(f"{TARGET_USER_CACHE_KEY}:{manager_name}:")
+	bump_versions("manager", [manager_name])
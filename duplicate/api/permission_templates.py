@@ -0,0 +1,59 @@
+import frappe
+from frappe import _
+
+from duplicate.api.permission_jobs import (
+	BULK_APPLY_CHUNK_SIZE,
+	enqueue_bulk_apply,
+	get_bulk_apply_job_status,
+)
+from duplicate.api.permission_targets import TARGET_USER_BATCH_SIZE, bind_users, unbind_users
+from duplicate.api.permission_writer import apply_manager_to_users, release_manager_permissions
+
+
+def get_template(template_name):
+	"""Load a manager, checking that it is a template"""
+	template = frappe.get_doc("User Permission Manager", template_name)
+	if not template.is_template:
+		frappe.throw(_("User Permission Manager {0} is not a template").format(template_name))
+	return template
+
+
+def instantiate_template(template_name, users):
+	"""Bind a template to `users` and grant them its permissions
+
+	The template stays the single owner of the granted permissions, so later
+	edits of the template reach every bound user through its sync. Up to
+	`BULK_APPLY_CHUNK_SIZE` users are applied inline, more in background jobs.
+	"""
+	template = get_template(template_name)
+	users = sorted(set(users))
+	bind_users(template.name, users)
+	frappe.db.commit()
+
+	result = {"template": template.name, "bound": len(users), "inserted": 0}
+	if not template.is_active or not users:
+		return result
+
+	template.ensure_user_permission_custom_field()
+	if len(users) > BULK_APPLY_CHUNK_SIZE:
+		result["job"] = get_bulk_apply_job_status(enqueue_bulk_apply(template.name, users))
+		return result
+
+	for start in range(0, len(users), TARGET_USER_BATCH_SIZE):
+		result["inserted"] += apply_manager_to_users(template, users[start : start + TARGET_USER_BATCH_SIZE])["inserted"]
+		frappe.db.commit()
+	return result
+
+
+def unbind_template(template_name, users):
+	"""Unbind `users` from a template and release the permissions it granted them"""
+	template = get_template(template_name)
+	users = sorted(set(users))
+	if not users:
+		# Releasing without users would release the template for everyone
+		frappe.throw(_("Please select at least one user"))
+
+	unbind_users(template.name, users)
+	released = release_manager_permissions(template.name, users=users)
+	frappe.db.commit()
+	return {"template": template.name, "unbound": len(users), "released": released}
@@ -0,0 +1,166 @@
+import frappe
+from frappe import _
+from frappe.utils import getdate, now_datetime, today
+
+from duplicate.api.permission_jobs import get_manager_lock_name, record_shard_results
+from duplicate.api.permission_locks import advisory_lock, lock_users, retry_on_lock_conflict
+from duplicate.api.permission_writer import (
+	apply_manager_to_users,
+	clear_user_permission_cache,
+	release_permissions,
+)
+
+
+def get_last_sweep_date():
+	"""Get the date of the last completed expiry sweep, if any"""
+	last_sweep = frappe.get_all(
+		"User Permission Sync Log",
+		filters={"operation": "Expiry Sweep", "status": "Completed"},
+		fields=["started_on"],
+		order_by="started_on desc",
+		limit_page_length=1,
+	)
+	return getdate(last_sweep[0].started_on) if last_sweep else None
+
+
+def get_expired_details(since, until):
+	"""Get the details of active managers whose `valid_until` passed in [since, until)
+
+	Uses the index on `valid_until`, so the cost follows the number of expired rows.
+	"""
+	conditions = "d.valid_until >= %(since)s AND d.valid_until < %(until)s" if since else "d.valid_until < %(until)s"
+	return frappe.db.sql(
+		f"""
+		SELECT d.parent AS manager, d.allow, d.for_value, d.applicable_for
+		FROM `tabUser Permission Details` d
+		INNER JOIN `tabUser Permission Manager` m ON m.name = d.parent AND m.is_active = 1
+		WHERE {conditions} AND d.parenttype = 'User Permission Manager'
+	""",
+		{"since": since, "until": until},
+		as_dict=True,
+	)
+
+
+def get_started_managers(since, until):
+	"""Get the active managers with a detail whose `valid_from` was reached in (since, until]"""
+	conditions = "d.valid_from > %(since)s AND d.valid_from <= %(until)s" if since else "d.valid_from <= %(until)s"
+	return frappe.db.sql_list(
+		f"""
+		SELECT DISTINCT d.parent
+		FROM `tabUser Permission Details` d
+		INNER JOIN `tabUser Permission Manager` m ON m.name = d.parent AND m.is_active = 1
+		WHERE {conditions} AND d.parenttype = 'User Permission Manager'
+			AND (d.valid_until IS NULL OR d.valid_until >= %(until)s)
+		ORDER BY d.parent
+	""",
+		{"since": since, "until": until},
+	)
+
+
+def revoke_expired_detail(detail):
+	"""Release the permissions a manager granted through an expired detail
+
+	Returns the number of released rows.
+	"""
+	rows = frappe.db.sql(
+		"""
+		SELECT up.name, up.user
+		FROM `tabUser Permission Ownership` o
+		INNER JOIN `tabUser Permission` up ON up.name = o.user_permission
+		WHERE o.user_permission_manager = %(manager)s AND up.allow = %(allow)s
+			AND up.for_value = %(for_value)s AND COALESCE(up.applicable_for, '') = %(applicable_for)s
+	""",
+		{
+			"manager": detail.manager,
+			"allow": detail.allow,
+			"for_value": detail.for_value,
+			"applicable_for": detail.applicable_for or "",
+		},
+		as_dict=True,
+	)
+
+	def release():
+		lock_users({row.user for row in rows})
+		clear_user_permission_cache(release_permissions(detail.manager, rows))
+
+	retry_on_lock_conflict(release)
+	frappe.db.commit()
+	return len(rows)
+
+
+def grant_started_manager(manager_name):
+	"""Apply a manager whose details became valid to its target users
+
+	Returns the number of inserted rows.
+	"""
+	manager = frappe.get_doc("User Permission Manager", manager_name)
+	granted = 0
+	for users in manager.iter_target_user_batches():
+		granted += apply_manager_to_users(manager, users)["inserted"]
+		frappe.db.commit()
+	return granted
+
+
+def sweep_permission_validity():
+	"""Scheduled job granting details that became valid and revoking expired ones
+
+	Only details whose dates were reached since the last sweep are read, through
+	the indexes on `valid_from` and `valid_until`. Counts are recorded in an
+	Expiry Sweep User Permission Sync Log.
+	"""
+	with advisory_lock("user_permission_expiry_sweep") as acquired:
+		if not acquired:
+			return
+
+		since = get_last_sweep_date()
+		until = getdate(today())
+
+		sync_log = frappe.get_doc(
+			{
+				"doctype": "User Permission Sync Log",
+				"operation": "Expiry Sweep",
+				"status": "Running",
+				"started_on": now_datetime(),
+				"total_shards": 1,
+			}
+		).insert(ignore_permissions=True)
+		frappe.db.commit()
+
+		expired_by_manager = {}
+		for detail in get_expired_details(since, until):
+			expired_by_manager.setdefault(detail.manager, []).append(detail)
+		started = get_started_managers(since, until)
+
+		results = []
+		revoked = granted = 0
+		for manager_name in sorted(set(expired_by_manager) | set(started)):
+			with advisory_lock(get_manager_lock_name(manager_name), timeout=60) as locked:
+				if not locked:
+					results.append(
+						{
+							"manager": manager_name,
+							"status": "Skipped",
+							"message": _("Another sync of this manager is running"),
+						}
+					)
+					continue
+
+				try:
+					for detail in expired_by_manager.get(manager_name, []):
+						revoked += revoke_expired_detail(detail)
+					if manager_name in started:
+						granted += grant_started_manager(manager_name)
+					results.append({"manager": manager_name, "status": "Success", "message": _("Swept")})
+				except Exception as e:
+					frappe.db.rollback()
+					frappe.log_error(title="User Permission Expiry Sweep Failed", message=frappe.get_traceback())
+					results.append({"manager": manager_name, "status": "Failed", "message": str(e)})
+
+		frappe.db.set_value(
+			"User Permission Sync Log",
+			sync_log.name,
+			{"total_managers": len(results), "granted_count": granted, "revoked_count": revoked},
+			update_modified=False,
+		)
+		record_shard_results(sync_log.name, results)
+		return sync_log.name
@@ -0,0 +1,387 @@
+import frappe
+from frappe.utils import getdate, now
+
+from duplicate.api.permission_cache import clear_user_sidebar_cache
+from duplicate.api.permission_locks import lock_users, retry_on_lock_conflict
+from duplicate.api.permission_statistics import count_adopted_permissions, count_permission_changes
+from duplicate.api.response_versions import bump_versions
+from duplicate.duplicate.doctype.user_permission_ownership.user_permission_ownership import (
+	get_ownership_name,
+)
+
+# User Permission columns driven by a User Permission Details row
+PERMISSION_VALUE_FIELDS = ("apply_to_all_doctypes", "is_default", "hide_descendants")
+
+# Maximum number of names per `IN (...)` clause of bulk updates and deletes
+WRITE_CHUNK_SIZE = 1000
+
+
+def get_permission_key(allow, for_value, applicable_for=None):
+	"""Get the key identifying a User Permission of a user"""
+	return (allow, for_value, applicable_for or "")
+
+
+def get_detail_values(detail):
+	"""Get the User Permission column values for a User Permission Details row"""
+	return (
+		1 if detail.apply_to_all_doctypes or not detail.applicable_for else 0,
+		1 if detail.is_default else 0,
+		1 if detail.hide_descendants else 0,
+	)
+
+
+def is_detail_valid(detail, date=None):
+	"""Check if a User Permission Details row is within its validity window on `date`"""
+	date = getdate(date)
+	if detail.get("valid_from") and getdate(detail.valid_from) > date:
+		return False
+	if detail.get("valid_until") and getdate(detail.valid_until) < date:
+		return False
+	return True
+
+
+def get_desired_permissions(manager):
+	"""Get the permission key -> column values map a manager grants to each of its users today"""
+	return {
+		get_permission_key(detail.allow, detail.for_value, detail.applicable_for): get_detail_values(detail)
+		for detail in manager.user_permission_details
+		if detail.allow and detail.for_value and is_detail_valid(detail)
+	}
+
+
+def get_permission_changes(manager, users, for_update=True):
+	"""Compare the permissions a manager grants to `users` with the existing User Permissions
+
+	Reads every relevant User Permission of the users, with this manager's
+	ownership of it, in one query. A row is shared by all managers granting the
+	same key: only its primary owner (`user_permission_manager`) writes its
+	values, other managers just record their ownership. Reads that only report
+	or pre-check changes pass `for_update=False` to take no row locks.
+
+	Returns a dict with the rows to insert, update, own and release, plus the
+	number of rows left unchanged.
+	"""
+	desired = get_desired_permissions(manager)
+	changes = {"insert": [], "update": [], "own": [], "release": [], "unchanged": 0}
+	if not users:
+		return changes
+
+	conditions = ["o.name IS NOT NULL", "up.user_permission_manager = %(manager)s"]
+	if desired:
+		conditions.append("up.allow IN %(allows)s")
+
+	# A locking read sees rows committed by a concurrent sync after this transaction's
+	# snapshot was taken (MariaDB reads at REPEATABLE READ otherwise)
+	lock_clause = "FOR UPDATE" if for_update and frappe.db.db_type == "mariadb" else ""
+
+	existing = frappe.db.sql(
+		f"""
+		SELECT up.name, up.user, up.allow, up.for_value, up.applicable_for,
+			up.apply_to_all_doctypes, up.is_default, up.hide_descendants, up.user_permission_manager,
+			o.name AS ownership
+		FROM `tabUser Permission` up
+		LEFT JOIN `tabUser Permission Ownership` o
+			ON o.user_permission = up.name AND o.user_permission_manager = %(manager)s
+		WHERE up.user IN %(users)s AND ({" OR ".join(conditions)})
+		ORDER BY up.creation, up.name
+		{lock_clause}
+	""",
+		{
+			"users": tuple(users),
+			"allows": tuple({key[0] for key in desired}),
+			"manager": manager.name,
+		},
+		as_dict=True,
+	)
+
+	found = set()
+	for row in existing:
+		key = get_permission_key(row.allow, row.for_value, row.applicable_for)
+		values = desired.get(key)
+		owned = bool(row.ownership) or row.user_permission_manager == manager.name
+
+		if values is None or (row.user, key) in found:
+			# Stale or duplicated rows are only released if this manager owns them
+			if owned:
+				changes["release"].append(row)
+			continue
+
+		found.add((row.user, key))
+		changed = False
+
+		if not row.ownership:
+			changes["own"].append(row)
+			changed = True
+
+		# Rows of another primary owner are left as they are; manual rows are adopted
+		if row.user_permission_manager in (None, "", manager.name):
+			current = tuple(row.get(field) or 0 for field in PERMISSION_VALUE_FIELDS)
+			if current != values or row.user_permission_manager != manager.name:
+				changes["update"].append(frappe._dict(row, permission_values=values))
+				changed = True
+
+		if not changed:
+			changes["unchanged"] += 1
+
+	for user in users:
+		for key, values in desired.items():
+			if (user, key) not in found:
+				changes["insert"].append(frappe._dict(user=user, key=key, permission_values=values))
+
+	return changes
+
+
+def execute_permission_changes(manager_name, changes):
+	"""Write the changes computed by `get_permission_changes` with bulk statements
+
+	Nothing is committed here; callers commit once per chunk of users.
+	"""
+	timestamp = now()
+	session_user = frappe.session.user
+	touched_users = release_permissions(manager_name, changes["release"])
+
+	# Rows getting the same values are updated together
+	updates_by_values = {}
+	for row in changes["update"]:
+		updates_by_values.setdefault(row.permission_values, []).append(row.name)
+		touched_users.add(row.user)
+	count_adopted_permissions(len([row for row in changes["update"] if not row.user_permission_manager]))
+
+	for values, names in sorted(updates_by_values.items()):
+		names.sort()
+		for start in range(0, len(names), WRITE_CHUNK_SIZE):
+			frappe.db.sql(
+				"""
+				UPDATE `tabUser Permission`
+				SET apply_to_all_doctypes = %(apply_to_all_doctypes)s, is_default = %(is_default)s,
+					hide_descendants = %(hide_descendants)s, user_permission_manager = %(manager)s,
+					modified = %(modified)s, modified_by = %(modified_by)s
+				WHERE name IN %(names)s
+			""",
+				{
+					**dict(zip(PERMISSION_VALUE_FIELDS, values, strict=True)),
+					"manager": manager_name,
+					"modified": timestamp,
+					"modified_by": session_user,
+					"names": tuple(names[start : start + WRITE_CHUNK_SIZE]),
+				},
+			)
+
+	# Rows shared with another manager change owners, which the users' responses show
+	owned = [(row.name, row.user) for row in changes["own"]]
+	touched_users.update(row.user for row in changes["own"])
+
+	if changes["insert"]:
+		inserted = [
+			(frappe.generate_hash(length=10), row)
+			for row in sorted(changes["insert"], key=lambda row: (row.user, row.key))
+		]
+		frappe.db.bulk_insert(
+			"User Permission",
+			fields=[
+				"name",
+				"creation",
+				"modified",
+				"modified_by",
+				"owner",
+				"docstatus",
+				"user",
+				"allow",
+				"for_value",
+				"applicable_for",
+				*PERMISSION_VALUE_FIELDS,
+				"user_permission_manager",
+			],
+			values=[
+				(
+					name,
+					timestamp,
+					timestamp,
+					session_user,
+					session_user,
+					0,
+					row.user,
+					row.key[0],
+					row.key[1],
+					row.key[2] or None,
+					*row.permission_values,
+					manager_name,
+				)
+				for name, row in inserted
+			],
+		)
+		owned.extend((name, row.user) for name, row in inserted)
+		count_permission_changes(
+			frappe._dict(user=row.user, allow=row.key[0], user_permission_manager=manager_name) for row in changes["insert"]
+		)
+		touched_users.update(row.user for row in changes["insert"])
+
+	insert_ownerships(manager_name, owned, timestamp)
+	clear_user_permission_cache(touched_users)
+	return touched_users
+
+
+def insert_ownerships(manager_name, permissions, timestamp=None):
+	"""Record that a manager owns the `(user_permission, user)` pairs, skipping known ones"""
+	if not permissions:
+		return
+
+	timestamp = timestamp or now()
+	session_user = frappe.session.user
+	frappe.db.bulk_insert(
+		"User Permission Ownership",
+		fields=[
+			"name",
+			"creation",
+			"modified",
+			"modified_by",
+			"owner",
+			"docstatus",
+			"user_permission",
+			"user_permission_manager",
+			"user",
+		],
+		values=[
+			(
+				get_ownership_name(user_permission, manager_name),
+				timestamp,
+				timestamp,
+				session_user,
+				session_user,
+				0,
+				user_permission,
+				manager_name,
+				user,
+			)
+			for user_permission, user in permissions
+		],
+		ignore_duplicates=True,
+	)
+
+
+def release_permissions(manager_name, rows):
+	"""Drop a manager's ownership of User Permission rows
+
+	Rows left without any owner are deleted. Rows still owned by another
+	manager are kept and handed over to one of the remaining owners if this
+	manager was their primary owner. Returns the users whose rows changed.
+	"""
+	touched_users = {row.user for row in rows}
+	names = sorted({row.name for row in rows})
+
+	for start in range(0, len(names), WRITE_CHUNK_SIZE):
+		chunk = tuple(names[start : start + WRITE_CHUNK_SIZE])
+		frappe.db.sql(
+			"""
+			DELETE FROM `tabUser Permission Ownership`
+			WHERE user_permission_manager = %(manager)s AND user_permission IN %(names)s
+		""",
+			{"manager": manager_name, "names": chunk},
+		)
+
+		remaining = dict(
+			frappe.db.sql(
+				"""
+				SELECT user_permission, MIN(user_permission_manager)
+				FROM `tabUser Permission Ownership`
+				WHERE user_permission IN %(names)s
+				GROUP BY user_permission
+			""",
+				{"names": chunk},
+			)
+		)
+
+		orphaned = tuple(name for name in chunk if name not in remaining)
+		if orphaned:
+			count_permission_changes(
+				frappe.db.sql(
+					"""
+					SELECT user, allow, user_permission_manager FROM `tabUser Permission`
+					WHERE name IN %(names)s
+				""",
+					{"names": orphaned},
+					as_dict=True,
+				),
+				-1,
+			)
+			frappe.db.sql("DELETE FROM `tabUser Permission` WHERE name IN %(names)s", {"names": orphaned})
+
+		handovers = {}
+		for name, owner in remaining.items():
+			handovers.setdefault(owner, []).append(name)
+
+		for owner, owned_names in sorted(handovers.items()):
+			frappe.db.sql(
+				"""
+				UPDATE `tabUser Permission` SET user_permission_manager = %(owner)s
+				WHERE name IN %(names)s AND user_permission_manager = %(manager)s
+			""",
+				{"owner": owner, "names": tuple(owned_names), "manager": manager_name},
+			)
+
+	return touched_users
+
+
+def release_manager_permissions(manager_name, users=None):
+	"""Release every User Permission owned by a manager, optionally for some users only
+
+	Returns the number of released rows.
+	"""
+	user_condition = "AND up.user IN %(users)s" if users else ""
+	rows = frappe.db.sql(
+		f"""
+		SELECT up.name, up.user
+		FROM `tabUser Permission` up
+		WHERE up.user_permission_manager = %(manager)s {user_condition}
+		UNION
+		SELECT up.name, up.user
+		FROM `tabUser Permission Ownership` o
+		INNER JOIN `tabUser Permission` up ON up.name = o.user_permission
+		WHERE o.user_permission_manager = %(manager)s {user_condition}
+	""",
+		{"manager": manager_name, "users": tuple(users or ())},
+		as_dict=True,
+	)
+
+	lock_users({row.user for row in rows})
+	touched_users = release_permissions(manager_name, rows)
+	clear_user_permission_cache(touched_users)
+	return len(rows)
+
+
+def apply_manager_to_users(manager, users):
+	"""Reconcile the User Permissions a manager grants to `users` in bulk
+
+	The users are locked until the transaction ends and written in a fixed
+	order; lock conflicts are retried by `retry_on_lock_conflict`, keeping
+	the caller's earlier writes. Returns the number of inserted, updated,
+	released and unchanged rows.
+	"""
+	users = sorted(set(users))
+
+	def apply():
+		lock_users(users)
+		changes = get_permission_changes(manager, users)
+		execute_permission_changes(manager.name, changes)
+		return get_change_counts(changes)
+
+	return retry_on_lock_conflict(apply)
+
+
+def get_change_counts(changes):
+	"""Get the number of rows per kind of change"""
+	return {
+		"inserted": len(changes["insert"]),
+		"updated": len(changes["update"]),
+		"owned": len(changes["own"]),
+		"released": len(changes["release"]),
+		"unchanged": changes["unchanged"],
+	}
+
+
+def clear_user_permission_cache(users):
+	"""Clear Frappe's cached User Permissions of `users` after bulk writes, with their sidebar data and versions"""
+	for user in users:
+		frappe.cache().hdel("user_permissions", user)
+	clear_user_sidebar_cache(users)
+	bump_versions("user", users)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+
+import frappe
+
+# Version tokens of read-heavy responses, per role, manager or user
+RESPONSE_VERSION_CACHE_KEY = "duplicate_response_version"
+
+# Responses of a kind that also show data of every name of another kind fold
+# in the generation of that kind, which any change of one of its names bumps
+GENERATION_KINDS = {"user": "manager"}
+
+# Target users and role permissions also change through writes without doc
+# events, so their versions are only trusted for a while
+MANAGER_VERSION_TTL = 5 * 60
+ROLE_VERSION_TTL = 5 * 60
+USER_VERSION_TTL = 60 * 60
+
+
+def get_version_key(kind, name):
+	"""Get the Redis key of the version of a `kind` ("role", "manager" or "user") of response"""
+	return f"{RESPONSE_VERSION_CACHE_KEY}:{kind}:{name}"
+
+
+def get_version(kind, name, ttl):
+	"""Get the current version token of a response, starting a new one if there is none
+
+	Tokens are random rather than incrementing, so a token handed out before
+	Redis was flushed can never match again.
+	"""
+	key = get_version_key(kind, name)
+	version = frappe.cache().get_value(key)
+	if not version:
+		version = frappe.generate_hash(length=12)
+		frappe.cache().set_value(key, version, expires_in_sec=ttl)
+	return version
+
+
+def get_response_version(kind, name, ttl, args=None):
+	"""Get the version token of one response, from the versions it depends on and its arguments
+
+	Responses of the same name built with other `args`, such as another page or
+	another endpoint, get other tokens.
+	"""
+	versions = [get_version(kind, name, ttl)]
+	if kind in GENERATION_KINDS:
+		versions.append(get_version("generation", GENERATION_KINDS[kind], ttl))
+
+	token = json.dumps([versions, args], default=str, sort_keys=True)
+	return hashlib.sha1(token.encode()).hexdigest()[:12]
+
+
+def versioned_response(kind, name, version, builder, ttl, args=None):
+	"""Build a response tagged with its version, or answer "not modified"
+
+	When the client sends back the `version` it already has, `builder` is not
+	run. `args` are the arguments the response is built from. The version is
+	read before building, so a change made meanwhile gets a new version and is
+	picked up by the next request.
+	"""
+	current = get_response_version(kind, name, ttl, args)
+	if version and version == current:
+		return {"not_modified": 1, "version": current}
+
+	response = builder()
+	response["version"] = current
+	return response
+
+
+def bump_versions(kind, names):
+	"""Drop the versions of changed responses, now and once the transaction commits
+
+	A response built before the commit still reads the old rows, so its version
+	is dropped again after the commit.
+	"""
+	keys = [get_version_key(kind, name) for name in names if name]
+	if not keys:
+		return
+
+	for key in keys:
+		frappe.cache().delete_value(key)
+
+	pending = getattr(frappe.local, "response_version_bumps", None)
+	if pending is None:
+		pending = frappe.local.response_version_bumps = set()
+		frappe.db.after_commit.add(flush_version_bumps)
+		frappe.db.after_rollback.add(discard_version_bumps)
+	pending.update(keys)
+
+
+def bump_generation(kind):
+	"""Drop the generation of a kind, and with it the versions of the responses folding it in"""
+	bump_versions("generation", [kind])
+
+
+def flush_version_bumps():
+	"""Drop the versions changed by the committed transaction"""
+	keys = frappe.local.response_version_bumps or set()
+	frappe.local.response_version_bumps = None
+	for key in keys:
+		frappe.cache().delete_value(key)
+
+
+def discard_version_bumps():
+	"""Forget the versions of a rolled back transaction"""
+	frappe.local.response_version_bumps = None
+
+
+def bump_manager_version(doc, method=None):
+	"""User Permission Manager doc event dropping its version and the users', which show manager names"""
+	bump_versions("manager", [doc.name])
+	bump_generation("manager")
+
+
+def bump_permission_user_version(doc, method=None):
+	"""User Permission doc event dropping the version of its user"""
+	bump_versions("user", [doc.user])
+
+
+def bump_role_version(doc, method=None):
+	"""Role doc event dropping its version"""
+	bump_versions("role", [doc.name])
+
+
+def bump_permission_role_version(doc, method=None):
+	"""Custom DocPerm doc event dropping the version of its role"""
+	bump_versions("role", [doc.role])
+
+
+def bump_doctype_role_versions(doc, method=None):
+	"""DocType doc event dropping the versions of the roles in its permissions, before and after the save"""
+	previous = doc.get_doc_before_save()
+	perms = [*(doc.get("permissions") or []), *((previous and previous.get("permissions")) or [])]
+	bump_versions("role", {perm.role for perm in perms})
@@ -1,5 +1,9 @@
 import frappe
 from frappe import _
+from frappe.utils import cint
+
+from duplicate.api.page_search import search_by_name_prefix
+from duplicate.api.response_versions import ROLE_VERSION_TTL, bump_versions, versioned_response
 
 
 @frappe.whitelist()
@@ -16,45 +20,9 @@ def duplicate_role(source_role, new_role_name, copy_permissions=True):
 		dict: Result with success status and new role name
 	"""
 	try:
-		# Check if source role exists
-		if not frappe.db.exists("Role", source_role):
-			frappe.throw(_("Source role '{0}' does not exist").format(source_role))
-		
-		# Check if new role name already exists
-		if frappe.db.exists("Role", new_role_name):
-			frappe.throw(_("Role '{0}' already exists").format(new_role_name))
-		
-		# Get source role document
-		source_role_doc = frappe.get_doc("Role", source_role)
-		
-		# Create new role document
-		new_role_doc = frappe.new_doc("Role")
-		new_role_doc.role_name = new_role_name
-		
-		# Copy basic fields from source role
-		fields_to_copy = [
-			"disabled", "desk_access", "two_factor_auth", 
-			"restrict_to_domain", "is_custom"
-		]
-		
-		for field in fields_to_copy:
-			if hasattr(source_role_doc, field):
-				setattr(new_role_doc, field, getattr(source_role_doc, field))
-		
-		# Insert the new role
-		new_role_doc.insert(ignore_permissions=True)
-		
-		if copy_permissions:
-			# Copy all permissions from source role
-			copy_role_permissions(source_role, new_role_name)
-		
+		result = create_role_copy(source_role, new_role_name, copy_permissions)
 		frappe.db.commit()
-		
-		return {
-			"success": True,
-			"message": _("Role '{0}' duplicated successfully as '{1}'").format(source_role, new_role_name),
-			"new_role": new_role_name
-		}
+		return result
 		
 	except Exception as e:
 		frappe.db.rollback()
@@ -65,6 +33,47 @@ def duplicate_role(source_role, new_role_name, copy_permissions=True):
 		}
 
 
+def create_role_copy(source_role, new_role_name, copy_permissions=True):
+	"""Create a copy of a role, and optionally of its permissions, without committing"""
+	# Check if source role exists
+	if not frappe.db.exists("Role", source_role):
+		frappe.throw(_("Source role '{0}' does not exist").format(source_role))
+	
+	# Check if new role name already exists
+	if frappe.db.exists("Role", new_role_name):
+		frappe.throw(_("Role '{0}' already exists").format(new_role_name))
+	
+	# Get source role document
+	source_role_doc = frappe.get_doc("Role", source_role)
+	
+	# Create new role document
+	new_role_doc = frappe.new_doc("Role")
+	new_role_doc.role_name = new_role_name
+	
+	# Copy basic fields from source role
+	fields_to_copy = [
+		"disabled", "desk_access", "two_factor_auth", 
+		"restrict_to_domain", "is_custom"
+	]
+	
+	for field in fields_to_copy:
+		if hasattr(source_role_doc, field):
+			setattr(new_role_doc, field, getattr(source_role_doc, field))
+	
+	# Insert the new role
+	new_role_doc.insert(ignore_permissions=True)
+	
+	if copy_permissions:
+		# Copy all permissions from source role
+		copy_role_permissions(source_role, new_role_name)
+	
+	return {
+		"success": True,
+		"message": _("Role '{0}' duplicated successfully as '{1}'").format(source_role, new_role_name),
+		"new_role": new_role_name
+	}
+
+
 def copy_role_permissions(source_role, target_role):
 	"""
 	Copy all permissions from source role to target role
@@ -122,15 +131,59 @@ def copy_role_permissions(source_role, target_role):
 		
 		new_perm.role = target_role
 		new_perm.insert(ignore_permissions=True)
+	
+	# DocPerm rows are inserted on their own, without the DocType's doc events
+	bump_versions("role", [target_role])
+
+
+# Permission flags packed into the bitmask of compact responses, lowest bit first
+PERMISSION_BITS = (
+	"read", "write", "create", "delete", "submit", "cancel", "amend",
+	"report", "export", "import", "share", "print", "email", "if_owner"
+)
+
+# Role fields returned by compact role details
+COMPACT_ROLE_FIELDS = ["role_name", "desk_access", "two_factor_auth", "disabled"]
+
+
+def get_permission_mask(perm):
+	"""Pack the permission flags of a DocPerm row into an integer"""
+	mask = 0
+	for bit, field in enumerate(PERMISSION_BITS):
+		if perm.get(field):
+			mask |= 1 << bit
+	return mask
+
+
+def pack_permissions(permissions):
+	"""Pack DocPerm rows into a DocType list and one `[doctype index, permlevel, mask]` row each
+	
+	Field names are sent once in `PERMISSION_BITS` instead of on every row.
+	"""
+	doctypes = []
+	doctype_index = {}
+	rows = []
+	
+	for perm in permissions:
+		if perm.parent not in doctype_index:
+			doctype_index[perm.parent] = len(doctypes)
+			doctypes.append(perm.parent)
+		rows.append([doctype_index[perm.parent], perm.get("permlevel") or 0, get_permission_mask(perm)])
+	
+	return {"doctypes": doctypes, "rows": rows}
 
 
 @frappe.whitelist()
-def get_role_details(role_name):
+def get_role_details(role_name, compact=0, version=None):
 	"""
 	Get detailed information about a role including its permissions
 	
 	Args:
 		role_name (str): Name of the role
+		compact (bool): Return permissions packed by `pack_permissions`, and
+			only the main fields of the role
+		version (str): `version` of a previous response; if the role did not
+			change since, only `{"not_modified": 1}` is returned
 		
 	Returns:
 		dict: Role details and permissions
@@ -138,31 +191,50 @@ def get_role_details(role_name):
 	if not frappe.db.exists("Role", role_name):
 		frappe.throw(_("Role '{0}' does not exist").format(role_name))
 	
-	role_doc = frappe.get_doc("Role", role_name)
+	return versioned_response(
+		"role",
+		role_name,
+		version,
+		lambda: build_role_details(role_name, compact),
+		ROLE_VERSION_TTL,
+		args=("details", compact)
+	)
+
+
+def build_role_details(role_name, compact=0):
+	"""Read a role and its DocType and custom permissions"""
+	fields = ["parent", "permlevel", *PERMISSION_BITS]
 	
 	# Get DocType permissions
 	doctype_permissions = frappe.get_all(
 		"DocPerm",
 		filters={"role": role_name},
-		fields=["parent", "permlevel", "read", "write", "create", "delete",
-				"submit", "cancel", "amend", "report", "export", "import",
-				"share", "print", "email", "if_owner"]
+		fields=fields
 	)
 	
 	# Get Custom permissions
 	custom_permissions = frappe.get_all(
 		"Custom DocPerm",
 		filters={"role": role_name},
-		fields=["parent", "permlevel", "read", "write", "create", "delete",
-				"submit", "cancel", "amend", "report", "export", "import",
-				"share", "print", "email", "if_owner"]
+		fields=fields
 	)
 	
+	total_permissions = len(doctype_permissions) + len(custom_permissions)
+	
+	if cint(compact):
+		return {
+			"role": frappe.db.get_value("Role", role_name, COMPACT_ROLE_FIELDS, as_dict=True),
+			"bits": PERMISSION_BITS,
+			"doctype_permissions": pack_permissions(doctype_permissions),
+			"custom_permissions": pack_permissions(custom_permissions),
+			"total_permissions": total_permissions
+		}
+	
 	return {
-		"role": role_doc.as_dict(),
+		"role": frappe.get_doc("Role", role_name).as_dict(),
 		"doctype_permissions": doctype_permissions,
 		"custom_permissions": custom_permissions,
-		"total_permissions": len(doctype_permissions) + len(custom_permissions)
+		"total_permissions": total_permissions
 	}
 
 
@@ -212,13 +284,47 @@ def get_all_roles_summary():
 		order_by="name"
 	)
 	
+	return add_role_permission_counts(roles)
+
+
+def add_role_permission_counts(roles):
+	"""Add the DocPerm and Custom DocPerm counts of each role, with one grouped query each"""
+	names = [role.name for role in roles]
+	if not names:
+		return roles
+	
+	doctype_counts = dict(frappe.get_all(
+		"DocPerm",
+		filters={"role": ["in", names]},
+		fields=["role", "count(*) as count"],
+		group_by="role",
+		as_list=True
+	))
+	custom_counts = dict(frappe.get_all(
+		"Custom DocPerm",
+		filters={"role": ["in", names]},
+		fields=["role", "count(*) as count"],
+		group_by="role",
+		as_list=True
+	))
+	
 	for role in roles:
-		# Count permissions for each role
-		doctype_count = frappe.db.count("DocPerm", {"role": role.name})
-		custom_count = frappe.db.count("Custom DocPerm", {"role": role.name})
-		
-		role["permission_count"] = doctype_count + custom_count
-		role["doctype_permissions"] = doctype_count
-		role["custom_permissions"] = custom_count
+		role["doctype_permissions"] = doctype_counts.get(role.name, 0)
+		role["custom_permissions"] = custom_counts.get(role.name, 0)
+		role["permission_count"] = role["doctype_permissions"] + role["custom_permissions"]
 	
 	return roles
+
+
+@frappe.whitelist()
+def search_roles(txt=None, after=None, page_length=None):
+	"""Search roles by name prefix, one page at a time, with their permission counts
+	
+	Pass `next_after` back as `after` to get the next page.
+	"""
+	if not frappe.has_permission("Role", "read"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	page = search_by_name_prefix("Role", txt, after, page_length, fields=["disabled"])
+	add_role_permission_counts(page["results"])
+	return page
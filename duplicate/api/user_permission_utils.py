@@ -1,5 +1,51 @@
 import frappe
 from frappe import _
+from frappe.utils import cint
+
+from duplicate.api.page_cache import PAGE_STATISTICS_TTL, get_page_data
+from duplicate.api.page_search import search_by_name_prefix
+from duplicate.api.permission_cache import get_user_sidebar
+from duplicate.api.permission_batch import run_permission_batch
+from duplicate.api.permission_clone import clone_permissions
+from duplicate.api.permission_jobs import (
+	BULK_APPLY_CHUNK_SIZE,
+	apply_manager_to_user_chunk,
+	cancel_bulk_apply_job,
+	check_job_access,
+	enqueue_bulk_apply,
+	enqueue_sync_all,
+	get_bulk_apply_job_status,
+	get_sync_log_summary,
+	publish_bulk_apply_results,
+)
+from duplicate.api.permission_plans import (
+	build_permission_plan,
+	execute_plan,
+	get_permission_plan,
+	get_plan_summary,
+	get_plan_target_users,
+)
+from duplicate.api.permission_reconciliation import (
+	enqueue_reconciliation,
+	get_reconciliation_progress,
+	start_reconciliation,
+)
+from duplicate.api.permission_statistics import get_statistics
+from duplicate.api.permission_targets import (
+	MANAGER_TARGET_FIELDS,
+	get_target_user_count,
+	get_target_user_counts,
+	get_target_user_page,
+	unbind_users,
+)
+from duplicate.api.permission_templates import instantiate_template, unbind_template
+from duplicate.api.permission_writer import release_manager_permissions
+from duplicate.api.response_versions import MANAGER_VERSION_TTL, USER_VERSION_TTL, versioned_response
+
+
+# Rows returned per page of a user's permissions summary
+SUMMARY_PAGE_LENGTH = 100
+SUMMARY_MAX_PAGE_LENGTH = 500
 
 
 @frappe.whitelist()
@@ -7,66 +53,272 @@ def get_available_permission_managers():
 	"""Get all active User Permission Managers"""
 	managers = frappe.get_all("User Permission Manager",
 		filters={"is_active": 1},
-		fields=["name", "manager_name", "description", "apply_to_all_users", "user_field"],
+		fields=["name", "manager_name", "description", *MANAGER_TARGET_FIELDS],
 		order_by="manager_name"
 	)
 	
-	# Add permission count for each manager
+	return add_manager_counts(managers)
+
+
+def add_manager_counts(managers):
+	"""Add the detail, managed permission and target user counts of each manager
+	
+	Each count is read with one grouped query for all managers. The managers
+	must have the `MANAGER_TARGET_FIELDS`.
+	"""
+	names = tuple(manager.name for manager in managers)
+	if not names:
+		return managers
+	
+	detail_counts = dict(frappe.db.sql("""
+		SELECT parent, COUNT(*)
+		FROM `tabUser Permission Details`
+		WHERE parent IN %(managers)s AND parenttype = 'User Permission Manager'
+			AND parentfield = 'user_permission_details'
+		GROUP BY parent
+	""", {"managers": names}))
+	
+	managed_counts = dict(frappe.db.sql("""
+		SELECT user_permission_manager, COUNT(*)
+		FROM `tabUser Permission Ownership`
+		WHERE user_permission_manager IN %(managers)s
+		GROUP BY user_permission_manager
+	""", {"managers": names}))
+	
+	target_counts = get_target_user_counts(managers)
+	
 	for manager in managers:
-		count = frappe.db.count("User Permission Details", {"parent": manager.name})
-		manager["permission_count"] = count
+		manager["permission_count"] = detail_counts.get(manager.name, 0)
+		manager["managed_permission_count"] = managed_counts.get(manager.name, 0)
+		manager["target_user_count"] = target_counts.get(manager.name, 0)
 	
 	return managers
 
 
+def build_manager_page_managers():
+	"""Get all managers listed on the dashboard with their counts"""
+	return add_manager_counts(frappe.get_all(
+		"User Permission Manager",
+		fields=["name", "manager_name", "description", "is_active", *MANAGER_TARGET_FIELDS],
+		order_by="manager_name"
+	))
+
+
+@frappe.whitelist()
+def search_users(txt=None, after=None, page_length=None):
+	"""Search enabled System Users by email prefix, one page at a time
+	
+	Pass `next_after` back as `after` to get the next page.
+	"""
+	if not frappe.has_permission("User Permission Manager", "read"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	return search_by_name_prefix(
+		"User",
+		txt,
+		after,
+		page_length,
+		filters={"enabled": 1, "user_type": "System User"},
+		fields=["full_name"]
+	)
+
+
+@frappe.whitelist()
+def get_manager_page_data():
+	"""Get the data of the User Permission Manager dashboard"""
+	if not frappe.has_permission("User Permission Manager", "read"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	return get_cached_manager_page_data()
+
+
+def get_cached_manager_page_data():
+	"""Get the managers and statistics of the dashboard from Redis
+	
+	Managers are cached until they change; statistics are refreshed every
+	minute rather than on each User Permission write. Users are searched from
+	the page as the user types, see `search_users`.
+	"""
+	return {
+		"managers": get_page_data("managers", build_manager_page_managers),
+		"stats": get_page_data("stats", get_permission_statistics, ttl=PAGE_STATISTICS_TTL),
+	}
+
+
+@frappe.whitelist()
+def get_user_permission_sidebar(user_email, version=None):
+	"""Get the managers, permission counts and available managers shown on the User form
+	
+	The user's part is cached until their User Permissions change; active
+	managers are cached until a manager changes. Pass the `version` of a
+	previous response to get `{"not_modified": 1}` while neither changed.
+	"""
+	if not frappe.has_permission("User", "read", user_email):
+		frappe.throw(_("Insufficient permissions"))
+	
+	def build():
+		sidebar = get_user_sidebar(user_email, build_user_sidebar)
+		applied = {manager.user_permission_manager for manager in sidebar["managers"]}
+		return {
+			**sidebar,
+			"available_managers": [
+				manager for manager in get_page_data("active_managers", build_active_managers)
+				if manager.name not in applied
+			]
+		}
+	
+	return versioned_response("user", user_email, version, build, USER_VERSION_TTL, args=("sidebar",))
+
+
+def build_user_sidebar(user_email):
+	"""Get the managers granting permissions to a user, and the user's permission counts"""
+	managers = frappe.db.sql("""
+		SELECT o.user_permission_manager, upm.manager_name, upm.description, COUNT(*) AS permission_count
+		FROM `tabUser Permission Ownership` o
+		LEFT JOIN `tabUser Permission Manager` upm ON o.user_permission_manager = upm.name
+		WHERE o.user = %s
+		GROUP BY o.user_permission_manager, upm.manager_name, upm.description
+		ORDER BY upm.manager_name
+	""", (user_email,), as_dict=True)
+	
+	managed_column = frappe.db.has_column("User Permission", "user_permission_manager")
+	total, managed = frappe.db.sql(f"""
+		SELECT COUNT(*), {"SUM(CASE WHEN COALESCE(user_permission_manager, '') != '' THEN 1 ELSE 0 END)" if managed_column else "0"}
+		FROM `tabUser Permission`
+		WHERE user = %s
+	""", (user_email,))[0]
+	
+	return {
+		"managers": managers,
+		"total_permissions": total,
+		"managed_permissions": cint(managed),
+		"manual_permissions": total - cint(managed)
+	}
+
+
+def build_active_managers():
+	"""Get the active managers that can be applied to a user"""
+	return frappe.get_all(
+		"User Permission Manager",
+		filters={"is_active": 1},
+		fields=["name", "manager_name"],
+		order_by="manager_name"
+	)
+
+
 @frappe.whitelist()
-def get_user_permissions_summary(user_email):
-	"""Get summary of user permissions with their source managers"""
+def get_user_permissions_summary(user_email, group_by=None, allow=None, manager=None, source=None,
+		after=None, page_length=None, version=None):
+	"""Get the User Permissions of a user with their source managers, one page at a time
+	
+	With `group_by="allow"` only the number of permissions per allowed DocType
+	is returned. Otherwise rows are returned in name order after the `after`
+	cursor; pass `next_after` back to get the next page. Rows can be filtered by
+	`allow`, by a `manager` granting them and by `source` ("managed" or "manual").
+	Pass the `version` of a previous response to get `{"not_modified": 1}` while
+	the user's permissions did not change.
+	"""
+	if not frappe.has_permission("User Permission", "read"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	return versioned_response(
+		"user",
+		user_email,
+		version,
+		lambda: build_user_permissions_summary(user_email, group_by, allow, manager, source, after, page_length),
+		USER_VERSION_TTL,
+		args=("summary", group_by, allow, manager, source, after, page_length)
+	)
+
+
+def build_user_permissions_summary(user_email, group_by=None, allow=None, manager=None, source=None,
+		after=None, page_length=None):
+	"""Read one page or the groups of the User Permissions of a user"""
 	# Ensure custom field exists
-	from duplicate.duplicate.doctype.user_permission_manager.user_permission_manager import UserPermissionManager
 	doc = frappe.new_doc("User Permission Manager")
 	doc.ensure_user_permission_custom_field()
 	
-	permissions = frappe.db.sql("""
+	conditions = ["up.user = %(user)s"]
+	if allow:
+		conditions.append("up.allow = %(allow)s")
+	if manager:
+		conditions.append("""EXISTS (
+			SELECT 1 FROM `tabUser Permission Ownership` o
+			WHERE o.user_permission = up.name AND o.user_permission_manager = %(manager)s
+		)""")
+	if source == "managed":
+		conditions.append("COALESCE(up.user_permission_manager, '') != ''")
+	elif source == "manual":
+		conditions.append("COALESCE(up.user_permission_manager, '') = ''")
+	elif source:
+		frappe.throw(_("Source must be managed or manual"))
+	
+	values = {"user": user_email, "allow": allow, "manager": manager}
+	
+	if group_by == "allow":
+		groups = frappe.db.sql(f"""
+			SELECT
+				up.allow,
+				COUNT(*) AS count,
+				SUM(CASE WHEN COALESCE(up.user_permission_manager, '') != '' THEN 1 ELSE 0 END) AS managed_count
+			FROM `tabUser Permission` up
+			WHERE {" AND ".join(conditions)}
+			GROUP BY up.allow
+			ORDER BY up.allow
+		""", values, as_dict=True)
+		
+		return {
+			"groups": groups,
+			"total_permissions": sum(group.count for group in groups)
+		}
+	elif group_by:
+		frappe.throw(_("Permissions can only be grouped by allow"))
+	
+	# The keyset on name follows the (user, name) index, whatever the page
+	if after:
+		conditions.append("up.name > %(after)s")
+	page_length = min(cint(page_length) or SUMMARY_PAGE_LENGTH, SUMMARY_MAX_PAGE_LENGTH)
+	
+	permissions = frappe.db.sql(f"""
 		SELECT 
 			up.name,
 			up.allow,
 			up.for_value,
 			up.applicable_for,
-			up.apply_to_all,
+			up.apply_to_all_doctypes,
 			up.is_default,
 			up.user_permission_manager,
 			upm.manager_name
 		FROM `tabUser Permission` up
 		LEFT JOIN `tabUser Permission Manager` upm ON up.user_permission_manager = upm.name
-		WHERE up.user = %s
-		ORDER BY up.allow, up.for_value
-	""", (user_email,), as_dict=True)
-	
-	# Group by source
-	managed_permissions = []
-	manual_permissions = []
-	
-	for perm in permissions:
-		if perm.user_permission_manager:
-			managed_permissions.append(perm)
-		else:
-			manual_permissions.append(perm)
+		WHERE {" AND ".join(conditions)}
+		ORDER BY up.name
+		LIMIT %(limit)s
+	""", {**values, "after": after, "limit": page_length}, as_dict=True)
 	
 	return {
-		"managed_permissions": managed_permissions,
-		"manual_permissions": manual_permissions,
-		"total_permissions": len(permissions)
+		"permissions": permissions,
+		"next_after": permissions[-1].name if len(permissions) == page_length else None
 	}
 
 
-@frappe.whitelist()
-def bulk_apply_permission_manager(manager_name, user_emails):
-	"""Apply permission manager to multiple users"""
+def parse_user_emails(user_emails):
+	"""Normalise a JSON list of user emails or `{"user": ...}` rows into unique emails"""
 	if isinstance(user_emails, str):
 		import json
 		user_emails = json.loads(user_emails)
 	
+	emails = []
+	for entry in user_emails or []:
+		email = entry.get("user") if isinstance(entry, dict) else entry
+		if email and email not in emails:
+			emails.append(email)
+	
+	return emails
+
+
+def get_active_manager_for_bulk_apply(manager_name):
+	"""Load an active manager after checking write permission"""
 	if not frappe.has_permission("User Permission Manager", "write"):
 		frappe.throw(_("Insufficient permissions"))
 	
@@ -75,26 +327,74 @@ def bulk_apply_permission_manager(manager_name, user_emails):
 	if not manager_doc.is_active:
 		frappe.throw(_("User Permission Manager is not active"))
 	
+	return manager_doc
+
+
+@frappe.whitelist()
+def bulk_apply_permission_manager(manager_name, user_emails, job_handle=None):
+	"""Apply permission manager to multiple users
+	
+	With a `job_handle` chosen by the caller, the results of each chunk are
+	also streamed over the `user_permission_bulk_apply_results` realtime event
+	as soon as the chunk is committed.
+	"""
+	user_emails = parse_user_emails(user_emails)
+	manager_doc = get_active_manager_for_bulk_apply(manager_name)
+	manager_doc.ensure_user_permission_custom_field()
+	
 	results = []
 	
-	for user_email in user_emails:
-		try:
-			manager_doc.create_user_permissions_for_user(user_email)
-			results.append({
-				"user": user_email,
-				"success": True,
-				"message": _("Permissions applied successfully")
-			})
-		except Exception as e:
-			results.append({
-				"user": user_email,
-				"success": False,
-				"message": str(e)
-			})
+	for start in range(0, len(user_emails), BULK_APPLY_CHUNK_SIZE):
+		chunk = user_emails[start:start + BULK_APPLY_CHUNK_SIZE]
+		chunk_results = apply_manager_to_user_chunk(manager_doc, chunk)
+		if job_handle:
+			publish_bulk_apply_results(job_handle, start // BULK_APPLY_CHUNK_SIZE, chunk_results, frappe.session.user)
+		results.extend(chunk_results)
 	
 	return {"results": results}
 
 
+@frappe.whitelist()
+def enqueue_bulk_apply_permission_manager(manager_name, user_emails):
+	"""Apply permission manager to multiple users in background jobs
+	
+	Progress is published per chunk over the `user_permission_bulk_apply_progress`
+	realtime event. Returns a job handle for `get_bulk_apply_status` and
+	`cancel_bulk_apply`.
+	"""
+	user_emails = parse_user_emails(user_emails)
+	get_active_manager_for_bulk_apply(manager_name)
+	
+	if not user_emails:
+		frappe.throw(_("Please select at least one user"))
+	
+	job_handle = enqueue_bulk_apply(manager_name, user_emails)
+	
+	return get_bulk_apply_job_status(job_handle)
+
+
+@frappe.whitelist()
+def get_bulk_apply_status(job_handle, include_failed=1):
+	"""Get the progress of a background bulk apply
+	
+	Pages receiving the streamed results can leave out the failed users with
+	`include_failed=0`; `failed_count` is always returned.
+	"""
+	job_status = get_bulk_apply_job_status(job_handle)
+	check_job_access(job_status)
+	if not cint(include_failed):
+		job_status.pop("failed")
+	return job_status
+
+
+@frappe.whitelist()
+def cancel_bulk_apply(job_handle):
+	"""Cancel the chunks of a background bulk apply that have not started yet"""
+	check_job_access(get_bulk_apply_job_status(job_handle))
+	cancel_bulk_apply_job(job_handle)
+	return get_bulk_apply_job_status(job_handle)
+
+
 @frappe.whitelist()
 def remove_permission_manager_from_user(manager_name, user_email):
 	"""Remove all permissions created by a specific manager for a user"""
@@ -106,18 +406,9 @@ def remove_permission_manager_from_user(manager_name, user_email):
 	doc = frappe.new_doc("User Permission Manager")
 	doc.ensure_user_permission_custom_field()
 	
-	permissions_to_delete = frappe.get_all("User Permission",
-		filters={
-			"user": user_email,
-			"user_permission_manager": manager_name
-		},
-		pluck="name"
-	)
-	
-	deleted_count = 0
-	for perm_name in permissions_to_delete:
-		frappe.delete_doc("User Permission", perm_name, ignore_permissions=True)
-		deleted_count += 1
+	# Permissions also granted by another manager are kept for that manager
+	unbind_users(manager_name, [user_email])
+	deleted_count = release_manager_permissions(manager_name, users=[user_email])
 	
 	frappe.db.commit()
 	
@@ -129,11 +420,52 @@ def remove_permission_manager_from_user(manager_name, user_email):
 
 
 @frappe.whitelist()
-def get_permission_manager_preview(manager_name):
-	"""Get detailed preview of what permissions will be applied"""
+def run_permission_operations(operations, atomic=0):
+	"""Run a list of typed operations in one request and transaction
+	
+	Operations are `{"type": ..., **arguments}` with the arguments of the
+	matching single endpoint: `duplicate_role` (source_role, new_role_name,
+	copy_permissions), `apply_manager` and `remove_manager` (manager_name,
+	user_email) and `preview_manager` (manager_name, after, page_length).
+	Returns the result, status and duration of each operation and the total
+	duration. With `atomic`, nothing is kept if an operation fails.
+	"""
+	if isinstance(operations, str):
+		import json
+		operations = json.loads(operations)
+	
+	return run_permission_batch(operations, atomic=cint(atomic))
+
+
+@frappe.whitelist()
+def get_permission_manager_preview(manager_name, after=None, page_length=20, include_plan=False, version=None):
+	"""Get detailed preview of what permissions will be applied
+
+	Target users are returned one page at a time; pass `next_after` back as
+	`after` to get the next page. With `include_plan`, the dry-run plan of the
+	page's users is included and can be executed with `execute_permission_plan`.
+	Without a plan, pass the `version` of a previous response to get
+	`{"not_modified": 1}` while the manager did not change.
+	"""
+	if cint(include_plan):
+		# Plans follow the users' current permissions, which the version does not cover
+		return build_permission_manager_preview(manager_name, after, page_length, include_plan)
+	
+	return versioned_response(
+		"manager",
+		manager_name,
+		version,
+		lambda: build_permission_manager_preview(manager_name, after, page_length),
+		MANAGER_VERSION_TTL,
+		args=("preview", after, page_length)
+	)
+
+
+def build_permission_manager_preview(manager_name, after=None, page_length=20, include_plan=False):
+	"""Read a manager's details, one page of its target users and optionally their plan"""
 	manager_doc = frappe.get_doc("User Permission Manager", manager_name)
 	
-	target_users = manager_doc.get_target_users()
+	target_page = get_target_user_page(manager_doc, after=after, page_length=page_length)
 	
 	preview_data = {
 		"manager_details": {
@@ -142,11 +474,14 @@ def get_permission_manager_preview(manager_name):
 			"description": manager_doc.description,
 			"is_active": manager_doc.is_active,
 			"apply_to_all_users": manager_doc.apply_to_all_users,
-			"user_field": manager_doc.user_field
+			"user_field": manager_doc.user_field,
+			"target_role": manager_doc.target_role,
+			"target_user_filter": manager_doc.target_user_filter
 		},
 		"permission_details": [],
-		"target_users": target_users,
-		"target_user_count": len(target_users)
+		"target_users": target_page["users"],
+		"next_after": target_page["next_after"],
+		"target_user_count": get_target_user_count(manager_doc)
 	}
 	
 	for detail in manager_doc.user_permission_details:
@@ -158,49 +493,149 @@ def get_permission_manager_preview(manager_name):
 			"is_default": detail.is_default
 		})
 	
+	if cint(include_plan):
+		preview_data["plan"] = get_plan_summary(build_permission_plan(manager_doc, target_page["users"]))
+	
 	return preview_data
 
 
 @frappe.whitelist()
-def sync_all_permission_managers():
-	"""Sync all active permission managers"""
+def plan_permission_manager(manager_name, users=None):
+	"""Get the dry-run plan of applying a manager to `users`, or to all its target users
+	
+	Nothing is written; the returned `plan_id` can be executed as-is with
+	`execute_permission_plan` for a while. A plan covers at most
+	`PLAN_MAX_USERS` users; plan larger managers a page of users at a time.
+	"""
+	if not frappe.has_permission("User Permission Manager", "read"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	manager_doc = frappe.get_doc("User Permission Manager", manager_name)
+	users = parse_user_emails(users) if users else get_plan_target_users(manager_doc)
+	
+	return get_plan_summary(build_permission_plan(manager_doc, users))
+
+
+@frappe.whitelist()
+def get_permission_plan_page(plan_id, start=0, page_length=None):
+	"""Get another page of the per-user changes of a plan"""
+	return get_plan_summary(get_permission_plan(plan_id), start=start, page_length=page_length)
+
+
+@frappe.whitelist()
+def execute_permission_plan(plan_id):
+	"""Write a previously computed plan exactly as it was previewed"""
 	if not frappe.has_permission("User Permission Manager", "write"):
 		frappe.throw(_("Insufficient permissions"))
 	
-	active_managers = frappe.get_all("User Permission Manager",
-		filters={"is_active": 1},
-		pluck="name"
+	return execute_plan(plan_id)
+
+
+@frappe.whitelist()
+def sync_all_permission_managers(jobs=None):
+	"""Sync all active permission managers in sharded background jobs
+	
+	Returns the summary of the User Permission Sync Log the shards report to;
+	poll it with `get_sync_all_status`.
+	"""
+	if not frappe.has_permission("User Permission Manager", "write"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	sync_log = enqueue_sync_all(jobs)
+	
+	return get_sync_log_summary(sync_log)
+
+
+@frappe.whitelist()
+def get_sync_all_status(sync_log):
+	"""Get the progress of a sync of all permission managers"""
+	if not frappe.has_permission("User Permission Sync Log", "read"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	return get_sync_log_summary(sync_log)
+
+
+@frappe.whitelist()
+def start_permission_reconciliation():
+	"""Reconcile all active permission managers in a resumable background job"""
+	if not frappe.has_permission("User Permission Manager", "write"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	return get_reconciliation_progress(start_reconciliation())
+
+
+@frappe.whitelist()
+def resume_permission_reconciliation(sync_log):
+	"""Resume a stopped reconciliation from its last checkpoint"""
+	if not frappe.has_permission("User Permission Manager", "write"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	enqueue_reconciliation(sync_log)
+	return get_reconciliation_progress(sync_log)
+
+
+@frappe.whitelist()
+def get_reconciliation_status(sync_log):
+	"""Get the progress, throughput and ETA of a reconciliation"""
+	if not frappe.has_permission("User Permission Sync Log", "read"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	return get_reconciliation_progress(sync_log)
+
+
+@frappe.whitelist()
+def clone_user_permissions(source_user, target_users, create_manager=0, manager_name=None):
+	"""Copy all User Permissions of one user to one or many target users
+	
+	With `create_manager`, one template User Permission Manager bound to all
+	target users is created to own the copies.
+	"""
+	if not frappe.has_permission("User Permission", "create"):
+		frappe.throw(_("Insufficient permissions"))
+	if cint(create_manager) and not frappe.has_permission("User Permission Manager", "create"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	return clone_permissions(
+		source_user,
+		parse_user_emails(target_users),
+		create_manager=cint(create_manager),
+		manager_name=manager_name
 	)
+
+
+@frappe.whitelist()
+def instantiate_permission_template(template, user_emails):
+	"""Bind a template User Permission Manager to users and grant them its permissions
 	
-	results = []
+	Later edits of the template are synced to all bound users. Large selections
+	are applied in background jobs; their progress is returned under `job`.
+	"""
+	if not frappe.has_permission("User Permission Manager", "write"):
+		frappe.throw(_("Insufficient permissions"))
 	
-	for manager_name in active_managers:
-		try:
-			manager_doc = frappe.get_doc("User Permission Manager", manager_name)
-			manager_doc.sync_user_permissions()
-			
-			results.append({
-				"manager": manager_name,
-				"success": True,
-				"message": _("Synced successfully")
-			})
-		except Exception as e:
-			results.append({
-				"manager": manager_name,
-				"success": False,
-				"message": str(e)
-			})
+	user_emails = parse_user_emails(user_emails)
+	if not user_emails:
+		frappe.throw(_("Please select at least one user"))
 	
-	return {
-		"results": results,
-		"total_managers": len(active_managers),
-		"success_count": len([r for r in results if r["success"]])
-	}
+	return instantiate_template(template, user_emails)
+
+
+@frappe.whitelist()
+def unbind_permission_template(template, user_emails):
+	"""Unbind users from a template and remove the permissions it granted them"""
+	if not frappe.has_permission("User Permission Manager", "write"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	return unbind_template(template, parse_user_emails(user_emails))
 
 
 @frappe.whitelist()
 def get_permission_statistics():
-	"""Get statistics about user permissions and managers"""
+	"""Get statistics about user permissions and managers
+	
+	User Permission counts are read from the incrementally maintained User
+	Permission Statistic rows rather than counted on each call.
+	"""
 	stats = {}
 	
 	# Permission Manager stats
@@ -209,32 +644,6 @@ def get_permission_statistics():
 	stats["inactive_managers"] = stats["total_managers"] - stats["active_managers"]
 	
 	# User Permission stats
-	stats["total_permissions"] = frappe.db.count("User Permission")
-	
-	# Managed vs Manual permissions
-	from duplicate.duplicate.doctype.user_permission_manager.user_permission_manager import UserPermissionManager
-	doc = frappe.new_doc("User Permission Manager")
-	doc.ensure_user_permission_custom_field()
-	
-	managed_count = frappe.db.count("User Permission", {"user_permission_manager": ["!=", ""]})
-	stats["managed_permissions"] = managed_count
-	stats["manual_permissions"] = stats["total_permissions"] - managed_count
-	
-	# Users with permissions
-	users_with_permissions = frappe.db.sql("""
-		SELECT COUNT(DISTINCT user) as count
-		FROM `tabUser Permission`
-	""")[0][0]
-	stats["users_with_permissions"] = users_with_permissions
-	
-	# Most common permission types
-	common_permissions = frappe.db.sql("""
-		SELECT allow, COUNT(*) as count
-		FROM `tabUser Permission`
-		GROUP BY allow
-		ORDER BY count DESC
-		LIMIT 5
-	""", as_dict=True)
-	stats["common_permissions"] = common_permissions
+	stats.update(get_statistics())
 	
 	return stats
@@ -0,0 +1,14 @@
+# Bench discovers the commands of an app from the `commands` list of this module
+from duplicate.duplicate.commands.permission_commands import (
+	reconcile_permission_managers,
+	sync_permission_managers,
+)
+from duplicate.duplicate.commands.role_commands import duplicate_role, list_roles, role_permissions
+
+commands = [
+	duplicate_role,
+	list_roles,
+	role_permissions,
+	sync_permission_managers,
+	reconcile_permission_managers,
+]
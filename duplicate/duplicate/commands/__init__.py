@@ -1 +1 @@
-# Commands will be auto-discovered by Frappe
\ No newline at end of file
+# Commands are registered with bench in duplicate/commands.py
\ No newline at end of file
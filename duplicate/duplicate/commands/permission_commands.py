@@ -0,0 +1,165 @@
+import sys
+import time
+
+import click
+import frappe
+from frappe.commands import pass_context, get_site
+
+# Seconds between two progress checks of a --wait
+WAIT_POLL_INTERVAL = 10
+
+# A --wait gives up after this many seconds, or after this many without progress
+SYNC_WAIT_TIMEOUT = 6 * 60 * 60
+RECONCILIATION_STALL_TIMEOUT = 2 * 60 * 60
+
+
+@click.command('sync-permission-managers')
+@click.option('--jobs', default=4, type=int, help='Number of background jobs to shard the managers across')
+@click.option('--wait', is_flag=True, help='Wait for all shards to finish and print the summary')
+@click.option('--timeout', default=SYNC_WAIT_TIMEOUT, type=int, help='Seconds to wait for the shards with --wait')
+@click.option('--site')
+@pass_context
+def sync_permission_managers(context, jobs, wait, timeout, site):
+	"""Resync all active User Permission Managers in sharded background jobs"""
+	
+	site = get_site(context, site)
+	
+	with frappe.init_site(site):
+		frappe.connect()
+		
+		try:
+			from duplicate.api.permission_jobs import (
+				count_live_sync_shards,
+				enqueue_sync_all,
+				get_sync_log_summary,
+			)
+			
+			sync_log = enqueue_sync_all(jobs)
+			frappe.db.commit()
+			
+			summary = get_sync_log_summary(sync_log)
+			click.echo(f"Queued {summary.total_managers} managers in {summary.total_shards} jobs ({sync_log})")
+			
+			deadline = time.monotonic() + timeout
+			while wait and summary.status != "Completed":
+				if time.monotonic() >= deadline:
+					click.echo(click.style(f"✗ Stopped waiting after {timeout}s, see {sync_log}", fg='red'))
+					sys.exit(1)
+				
+				time.sleep(WAIT_POLL_INTERVAL)
+				frappe.db.rollback()
+				summary = get_sync_log_summary(sync_log)
+				click.echo(f"  {summary.finished_shards}/{summary.total_shards} jobs finished")
+				
+				if summary.status != "Completed" and not count_live_sync_shards(sync_log, summary.total_shards):
+					# The last shard may have finished since the log was read
+					frappe.db.rollback()
+					summary = get_sync_log_summary(sync_log)
+					if summary.status != "Completed":
+						click.echo(click.style(
+							f"✗ {summary.total_shards - summary.finished_shards} jobs stopped without finishing, "
+							f"see {sync_log}",
+							fg='red'
+						))
+						sys.exit(1)
+			
+			if summary.status == "Completed":
+				color = 'green' if not summary.failed_count else 'yellow'
+				click.echo(click.style(
+					f"✓ Synced {summary.success_count} managers, {summary.failed_count} failed, "
+					f"{summary.skipped_count} skipped in {summary.duration or 0:.0f}s",
+					fg=color
+				))
+				if summary.failed_count:
+					sys.exit(1)
+			
+		except Exception as e:
+			click.echo(click.style(f"✗ Error: {str(e)}", fg='red'))
+			sys.exit(1)
+		
+		finally:
+			frappe.destroy()
+
+
+@click.command('reconcile-permission-managers')
+@click.option('--resume', help='Name of a Reconciliation sync log to resume from its checkpoint')
+@click.option('--wait', is_flag=True, help='Wait for the reconciliation to finish, printing throughput and ETA')
+@click.option(
+	'--stall-timeout',
+	default=RECONCILIATION_STALL_TIMEOUT,
+	type=int,
+	help='Seconds without progress after which --wait gives up'
+)
+@click.option('--site')
+@pass_context
+def reconcile_permission_managers(context, resume, wait, stall_timeout, site):
+	"""Reconcile all active User Permission Managers in a resumable background job"""
+	
+	site = get_site(context, site)
+	
+	with frappe.init_site(site):
+		frappe.connect()
+		
+		try:
+			from duplicate.api.permission_reconciliation import (
+				enqueue_reconciliation,
+				get_reconciliation_progress,
+				start_reconciliation,
+			)
+			
+			if resume:
+				enqueue_reconciliation(resume)
+				sync_log = resume
+			else:
+				sync_log = start_reconciliation()
+			frappe.db.commit()
+			
+			progress = get_reconciliation_progress(sync_log)
+			click.echo(f"Reconciling {progress.total_pairs} manager/user pairs ({sync_log})")
+			
+			stalled_since = time.monotonic()
+			while wait and progress.status not in ("Completed", "Failed"):
+				if time.monotonic() - stalled_since >= stall_timeout:
+					# The hourly scheduler keeps resuming it, so the reconciliation is not lost
+					click.echo(click.style(
+						f"✗ Stopped waiting after {stall_timeout}s without progress, "
+						f"resume with --resume {sync_log}",
+						fg='red'
+					))
+					sys.exit(1)
+				
+				time.sleep(WAIT_POLL_INTERVAL)
+				frappe.db.rollback()
+				processed_pairs = progress.processed_pairs
+				progress = get_reconciliation_progress(sync_log)
+				if progress.processed_pairs != processed_pairs:
+					stalled_since = time.monotonic()
+				eta = f", ETA {progress.eta_seconds:.0f}s" if progress.eta_seconds else ""
+				click.echo(
+					f"  {progress.processed_pairs}/{progress.total_pairs} pairs "
+					f"({progress.throughput} pairs/s{eta})"
+				)
+			
+			if progress.status == "Completed":
+				click.echo(click.style(
+					f"✓ Reconciled {progress.processed_pairs} pairs in {progress.elapsed_seconds or 0:.0f}s",
+					fg='green'
+				))
+			elif progress.status == "Failed":
+				click.echo(click.style(
+					f"✗ Reconciliation failed for {progress.failed_count or 0} managers, see {sync_log}",
+					fg='red'
+				))
+				sys.exit(1)
+			
+		except Exception as e:
+			click.echo(click.style(f"✗ Error: {str(e)}", fg='red'))
+			sys.exit(1)
+		
+		finally:
+			frappe.destroy()
+
+
+# Registered with bench in duplicate/commands.py
+# These will be available as: bench sync-permission-managers, bench reconcile-permission-managers
+__all__ = ['sync_permission_managers', 'reconcile_permission_managers']
@@ -147,6 +147,6 @@ def role_permissions(context, role_name, site):
 			frappe.destroy()
 
 
-# Export commands for Frappe to discover
+# Registered with bench in duplicate/commands.py
 # These will be available as: bench duplicate-role, bench list-roles, bench role-permissions
 __all__ = ['duplicate_role', 'list_roles', 'role_permissions']
@@ -4,6 +4,9 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
+from frappe.utils import cint
+
+from duplicate.api.role_utils import PERMISSION_BITS, get_permission_mask
 
 
 class RoleDuplicate(Document):
@@ -330,8 +333,12 @@ def test_doctype_permissions(source_role):
 		return {"status": "error", "message": str(e)}
 
 @frappe.whitelist()
-def get_role_permissions_preview(source_role):
-	"""Get a preview of permissions for a source role"""
+def get_role_permissions_preview(source_role, compact=0):
+	"""Get a preview of permissions for a source role
+	
+	With `compact`, permissions are packed as DocTypes and one bitmask per
+	DocType, in the `pack_permissions` format.
+	"""
 	try:
 		# Get ALL DocPerm records for the source role (not grouped) 
 		docperms = frappe.get_all("DocPerm", 
@@ -376,6 +383,22 @@ def get_role_permissions_preview(source_role):
 		
 		permissions_list = list(perm_dict.values())
 		
+		if cint(compact):
+			# Permissions are combined per DocType, so every row is at level 0
+			masks = {}
+			for perm in docperms:
+				masks[perm.parent] = masks.get(perm.parent, 0) | get_permission_mask(perm)
+			doctypes = list(masks)
+			return {
+				"status": "success",
+				"bits": PERMISSION_BITS,
+				"permissions": {
+					"doctypes": doctypes,
+					"rows": [[idx, 0, masks[doctype]] for idx, doctype in enumerate(doctypes)]
+				},
+				"total_count": len(doctypes)
+			}
+		
 		return {
 			"status": "success",
 			"permissions": permissions_list,
@@ -1,15 +1,27 @@
 # Copyright (c) 2025, sammish and contributors
 # For license information, please see license.txt
 
+from unittest.mock import patch
+
 import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from duplicate.api.permission_jobs import run_manager_sync
+
 
 class TestUserPermissionManager(FrappeTestCase):
 	def setUp(self):
 		"""Set up test data"""
 		self.test_user = "test@example.com"
 		
+		# Manager syncs run right away instead of in a debounced background job
+		for patcher in (
+			patch("duplicate.api.permission_jobs.enqueue_manager_sync", side_effect=run_manager_sync),
+			patch("duplicate.api.permission_jobs.MANAGER_SYNC_DEBOUNCE", 0),
+		):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+		
 		# Create test user if not exists
 		if not frappe.db.exists("User", self.test_user):
 			user = frappe.new_doc("User")
@@ -63,6 +75,15 @@ class TestUserPermissionManager(FrappeTestCase):
 			# Ignore cleanup errors in tests
 			pass
 	
+	def delete_user_permission_data(self, users):
+		"""Delete the User Permissions, ownership and bindings a test committed for `users`"""
+		# Without owners left, no active manager protects the permissions
+		frappe.db.delete("User Permission Ownership", {"user": ["in", users]})
+		frappe.db.delete("User Permission Manager Binding", {"user": ["in", users]})
+		for name in frappe.get_all("User Permission", filters={"user": ["in", users]}, pluck="name"):
+			frappe.delete_doc("User Permission", name, ignore_permissions=True, force=True)
+		frappe.db.commit()
+	
 	def test_create_user_permission_manager(self):
 		"""Test creating a User Permission Manager"""
 		# Ensure test company exists
@@ -260,3 +281,1009 @@ class TestUserPermissionManager(FrappeTestCase):
 			manager_doc = frappe.get_doc("User Permission Manager", manager_name)
 			manager_doc.is_active = 0
 			manager_doc.save(ignore_permissions=True)
+
+	def test_active_flag_cache_invalidated_on_save(self):
+		"""Test that the cached active flag follows manager saves"""
+		from duplicate.api.permission_cache import is_manager_active
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Cache Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 0
+		manager.append("user_permission_details", {
+			"allow": "Role",
+			"for_value": "System Manager"
+		})
+		manager.insert(ignore_permissions=True)
+		
+		self.assertFalse(is_manager_active(manager.name))
+		
+		manager.is_active = 1
+		manager.save(ignore_permissions=True)
+		self.assertTrue(is_manager_active(manager.name))
+		
+		manager.is_active = 0
+		manager.save(ignore_permissions=True)
+		self.assertFalse(is_manager_active(manager.name))
+	
+	def test_role_targeting_applies_to_all_role_users(self):
+		"""Test that a role targeted manager applies to every enabled user with the role"""
+		from duplicate.api.permission_targets import get_target_user_count
+		
+		if not frappe.db.exists("Role", "Test Target Role"):
+			frappe.get_doc({"doctype": "Role", "role_name": "Test Target Role"}).insert(ignore_permissions=True)
+		
+		role_users = []
+		for index in range(3):
+			email = f"test_target_{index}@example.com"
+			if not frappe.db.exists("User", email):
+				frappe.get_doc({
+					"doctype": "User",
+					"email": email,
+					"first_name": f"Target {index}",
+					"user_type": "System User",
+					"roles": [{"role": "Test Target Role"}]
+				}).insert(ignore_permissions=True)
+			role_users.append(email)
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Role Target Manager"
+		manager.user_field = self.test_user
+		manager.target_role = "Test Target Role"
+		manager.is_active = 1
+		manager.append("user_permission_details", {
+			"allow": "Role",
+			"for_value": "System Manager"
+		})
+		manager.insert(ignore_permissions=True)
+		
+		self.assertEqual(get_target_user_count(manager), len(role_users) + 1)
+		self.assertCountEqual(
+			[user for users in manager.iter_target_user_batches(batch_size=2) for user in users],
+			[*role_users, self.test_user]
+		)
+		
+		manager.sync_user_permissions()
+		for user in [*role_users, self.test_user]:
+			self.assertTrue(frappe.db.exists("User Permission", {
+				"user": user,
+				"allow": "Role",
+				"for_value": "System Manager",
+				"user_permission_manager": manager.name
+			}))
+	
+	def test_users_added_by_hand_stay_targets(self):
+		"""Test that users added by hand to a role targeted manager are counted and kept by syncs"""
+		from duplicate.api.permission_targets import get_target_user_count, get_target_user_counts
+		
+		if not frappe.db.exists("Role", "Test Target Role"):
+			frappe.get_doc({"doctype": "Role", "role_name": "Test Target Role"}).insert(ignore_permissions=True)
+		
+		role_user = "test_bound_role@example.com"
+		if not frappe.db.exists("User", role_user):
+			frappe.get_doc({
+				"doctype": "User",
+				"email": role_user,
+				"first_name": "Bound Role",
+				"user_type": "System User",
+				"roles": [{"role": "Test Target Role"}]
+			}).insert(ignore_permissions=True)
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Bound Target Manager"
+		manager.target_role = "Test Target Role"
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		role_count = get_target_user_count(manager)
+		
+		# The test user does not have the role, so it is only a target once added
+		manager.add_user(self.test_user)
+		manager.add_user(role_user)
+		
+		self.assertEqual(get_target_user_count(manager), role_count + 1)
+		self.assertEqual(get_target_user_counts([manager])[manager.name], role_count + 1)
+		targets = [user for users in manager.iter_target_user_batches(batch_size=1) for user in users]
+		self.assertIn(self.test_user, targets)
+		self.assertEqual(len(targets), len(set(targets)))
+		
+		manager.sync_user_permissions()
+		self.assertTrue(frappe.db.exists("User Permission", {
+			"user": self.test_user,
+			"allow": "Role",
+			"for_value": "System Manager",
+			"user_permission_manager": manager.name
+		}))
+	
+	def test_sync_request_made_during_a_sync_is_kept(self):
+		"""Test that a save made after a sync read its request is left for another sync"""
+		import time
+		
+		from duplicate.api.permission_jobs import (
+			get_manager_sync_request,
+			get_manager_sync_request_key,
+			request_manager_sync,
+		)
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Debounced Sync Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		self.addCleanup(frappe.cache().execute_command, "HDEL", get_manager_sync_request_key(), manager.name)
+		
+		# Served requests are removed
+		request_manager_sync(manager.name)
+		self.assertIsNone(get_manager_sync_request(manager.name))
+		
+		newer = repr(time.time() + 1)
+		
+		def save_meanwhile(requested_at):
+			# Another process saves the manager once the job read the request
+			frappe.cache().execute_command("HSET", get_manager_sync_request_key(), manager.name, newer)
+			return True
+		
+		with patch("duplicate.api.permission_jobs.is_manager_sync_due", side_effect=save_meanwhile):
+			request_manager_sync(manager.name)
+		
+		self.assertEqual(frappe.safe_decode(get_manager_sync_request(manager.name)), newer)
+	
+	def test_available_managers_carry_grouped_counts(self):
+		"""Test that the available managers are listed with their detail, managed permission and target counts"""
+		from duplicate.api.permission_targets import get_target_user_count
+		from duplicate.api.user_permission_utils import get_available_permission_managers
+		
+		if not frappe.db.exists("Role", "Test Target Role"):
+			frappe.get_doc({"doctype": "Role", "role_name": "Test Target Role"}).insert(ignore_permissions=True)
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Counted Manager"
+		manager.user_field = self.test_user
+		manager.target_role = "Test Target Role"
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "Guest"})
+		manager.insert(ignore_permissions=True)
+		
+		counted = {row.name: row for row in get_available_permission_managers()}[manager.name]
+		
+		self.assertEqual(counted.permission_count, 2)
+		self.assertEqual(counted.target_user_count, get_target_user_count(manager))
+		self.assertEqual(
+			counted.managed_permission_count,
+			frappe.db.count("User Permission Ownership", {"user_permission_manager": manager.name})
+		)
+		self.assertEqual(counted.managed_permission_count, 2 * counted.target_user_count)
+	
+	def test_manager_page_data_cached_until_managers_change(self):
+		"""Test that the dashboard data is served from Redis until a manager changes"""
+		from duplicate.api.user_permission_utils import get_cached_manager_page_data
+		
+		get_cached_manager_page_data()
+		with (
+			patch("duplicate.api.user_permission_utils.build_manager_page_managers", side_effect=AssertionError),
+			patch("duplicate.api.user_permission_utils.get_permission_statistics", side_effect=AssertionError),
+		):
+			# A warm load rebuilds nothing
+			cached = get_cached_manager_page_data()
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Page Cache Manager"
+		manager.user_field = self.test_user
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		
+		self.assertNotIn(manager.name, [row.name for row in cached["managers"]])
+		self.assertIn(manager.name, [row.name for row in get_cached_manager_page_data()["managers"]])
+	
+	def test_apply_to_all_users_resumes_from_checkpoint(self):
+		"""Test that an all-users sync resumes after the stored checkpoint"""
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test All Users Manager"
+		manager.apply_to_all_users = 1
+		manager.is_active = 0
+		manager.append("user_permission_details", {
+			"allow": "Role",
+			"for_value": "System Manager"
+		})
+		manager.insert(ignore_permissions=True)
+		manager.is_active = 1
+		
+		enabled_users = frappe.get_all("User",
+			filters={"enabled": 1, "user_type": "System User"},
+			order_by="name asc",
+			pluck="name"
+		)
+		self.assertCountEqual(manager.get_target_users(), enabled_users)
+		
+		# Resuming after the first user leaves that user untouched
+		manager.db_set("sync_checkpoint", enabled_users[0], update_modified=False)
+		manager.sync_user_permissions(resume=True)
+		
+		applied = frappe.get_all("User Permission",
+			filters={"user_permission_manager": manager.name},
+			pluck="user"
+		)
+		self.assertCountEqual(applied, enabled_users[1:])
+		self.assertFalse(frappe.db.get_value("User Permission Manager", manager.name, "sync_checkpoint"))
+	
+	def test_background_bulk_apply_runs_chunks_and_cancels(self):
+		"""Test that a background bulk apply applies every chunk, reports its progress and skips cancelled chunks"""
+		from duplicate.api.permission_jobs import (
+			cancel_bulk_apply_job,
+			enqueue_bulk_apply,
+			get_bulk_apply_job_status,
+			run_bulk_apply_chunk,
+		)
+		
+		users = [self.test_user]
+		for index in range(2):
+			email = f"test_bulk_{index}@example.com"
+			if not frappe.db.exists("User", email):
+				frappe.get_doc({
+					"doctype": "User",
+					"email": email,
+					"first_name": f"Bulk {index}",
+					"user_type": "System User"
+				}).insert(ignore_permissions=True)
+			users.append(email)
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Bulk Apply Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		
+		with patch("frappe.enqueue") as enqueue:
+			job_handle = enqueue_bulk_apply(manager.name, users, chunk_size=2)
+		
+		chunks = [call.kwargs for call in enqueue.call_args_list]
+		self.assertEqual([chunk["users"] for chunk in chunks], [users[:2], users[2:]])
+		self.assertEqual(get_bulk_apply_job_status(job_handle)["status"], "Queued")
+		
+		run_bulk_apply_chunk(job_handle, manager.name, chunks[0]["users"], chunks[0]["chunk_index"])
+		self.assertEqual(get_bulk_apply_job_status(job_handle)["status"], "Running")
+		
+		# The chunk not started yet is skipped once cancelled
+		cancel_bulk_apply_job(job_handle)
+		run_bulk_apply_chunk(job_handle, manager.name, chunks[1]["users"], chunks[1]["chunk_index"])
+		
+		status = get_bulk_apply_job_status(job_handle)
+		self.assertEqual(status["status"], "Cancelled")
+		self.assertEqual(status["success_count"], 2)
+		self.assertEqual(status["processed_users"], 2)
+		for user in users[:2]:
+			self.assertTrue(frappe.db.exists("User Permission", {
+				"user": user,
+				"allow": "Role",
+				"for_value": "System Manager",
+				"user_permission_manager": manager.name
+			}))
+		self.assertFalse(frappe.db.exists("User Permission", {
+			"user": users[2],
+			"user_permission_manager": manager.name
+		}))
+	
+	def test_bulk_apply_streams_chunk_results(self):
+		"""Test that a bulk apply streams the applied users and the failures of each chunk"""
+		from duplicate.api.permission_jobs import BULK_APPLY_RESULTS_EVENT
+		from duplicate.api.permission_targets import bind_users
+		from duplicate.api.user_permission_utils import bulk_apply_permission_manager
+		
+		failing_user = "test_stream_failure@example.com"
+		
+		def bind_or_fail(manager_name, users):
+			if failing_user in users:
+				raise frappe.ValidationError("Test stream failure")
+			return bind_users(manager_name, users)
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Streamed Bulk Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		
+		with (
+			patch("duplicate.api.permission_jobs.bind_users", side_effect=bind_or_fail),
+			patch("frappe.publish_realtime") as publish_realtime,
+		):
+			bulk_apply_permission_manager(manager.name, [self.test_user, failing_user], job_handle="test-stream")
+		
+		events = [call.args[1] for call in publish_realtime.call_args_list if call.args[0] == BULK_APPLY_RESULTS_EVENT]
+		self.assertEqual(len(events), 1)
+		self.assertEqual(events[0]["job_handle"], "test-stream")
+		self.assertEqual(events[0]["status"], "Completed")
+		self.assertEqual(events[0]["applied"], [self.test_user])
+		self.assertEqual([failure["user"] for failure in events[0]["failed"]], [failing_user])
+		self.assertIn("Test stream failure", events[0]["failed"][0]["message"])
+	
+	def test_sync_all_shards_managers_and_records_results(self):
+		"""Test that a sync of all managers splits them across shards and completes its log once all shards ran"""
+		from duplicate.api.permission_jobs import enqueue_sync_all, run_sync_shard
+		
+		for index in range(3):
+			manager = frappe.new_doc("User Permission Manager")
+			manager.manager_name = f"Test Sync All Manager {index}"
+			manager.user_field = self.test_user
+			manager.is_active = 1
+			manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+			manager.insert(ignore_permissions=True)
+		
+		with patch("frappe.enqueue") as enqueue:
+			sync_log = enqueue_sync_all(jobs=2)
+		
+		self.addCleanup(frappe.delete_doc, "User Permission Sync Log", sync_log, ignore_permissions=True)
+		
+		shards = [call.kwargs for call in enqueue.call_args_list]
+		active = frappe.get_all("User Permission Manager", filters={"is_active": 1}, pluck="name")
+		self.assertEqual(len(shards), 2)
+		self.assertCountEqual([name for shard in shards for name in shard["managers"]], active)
+		self.assertEqual(frappe.db.get_value("User Permission Sync Log", sync_log, "status"), "Queued")
+		
+		for shard in shards:
+			run_sync_shard(shard["sync_log"], shard["managers"])
+		
+		log = frappe.get_doc("User Permission Sync Log", sync_log)
+		self.assertEqual(log.status, "Completed")
+		self.assertEqual(log.finished_shards, 2)
+		self.assertEqual(log.success_count + log.failed_count + log.skipped_count, len(active))
+		self.assertEqual([item.idx for item in log.items], list(range(1, len(log.items) + 1)))
+	
+	def test_reconciliation_resumes_within_its_time_budget(self):
+		"""Test that a reconciliation out of time continues from its checkpoint until every pair is done"""
+		from duplicate.api.permission_reconciliation import run_reconciliation, start_reconciliation
+		
+		for index in range(2):
+			manager = frappe.new_doc("User Permission Manager")
+			manager.manager_name = f"Test Reconciliation Manager {index}"
+			manager.user_field = self.test_user
+			manager.is_active = 1
+			manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+			manager.insert(ignore_permissions=True)
+		
+		with (
+			patch("duplicate.api.permission_reconciliation.enqueue_reconciliation") as enqueue,
+			patch("duplicate.api.permission_reconciliation.RECONCILIATION_TIME_BUDGET", -1),
+		):
+			sync_log = start_reconciliation()
+			self.addCleanup(frappe.delete_doc, "User Permission Sync Log", sync_log, ignore_permissions=True)
+			
+			# Every chunk spends the whole budget, so each run hands over to a continuation
+			runs = 0
+			while frappe.db.get_value("User Permission Sync Log", sync_log, "status") != "Completed" and runs < 50:
+				run_reconciliation(sync_log)
+				runs += 1
+		
+		hops = [call.args[1] for call in enqueue.call_args_list if len(call.args) > 1]
+		log = frappe.get_doc("User Permission Sync Log", sync_log)
+		self.assertEqual(log.status, "Completed")
+		self.assertGreater(len(hops), 1)
+		self.assertEqual(hops, sorted(set(hops)))
+		self.assertEqual(log.processed_pairs, log.total_pairs)
+	
+	def test_failing_manager_ends_reconciliation_as_failed(self):
+		"""Test that a manager whose reconciliation raises is recorded and the log ends as Failed"""
+		from duplicate.api.permission_reconciliation import run_reconciliation, start_reconciliation
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Failing Reconciliation Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		
+		with (
+			patch("duplicate.api.permission_reconciliation.enqueue_reconciliation"),
+			patch(
+				"duplicate.api.permission_reconciliation.apply_manager_to_users",
+				side_effect=Exception("Test reconciliation error")
+			),
+		):
+			sync_log = start_reconciliation()
+			self.addCleanup(frappe.delete_doc, "User Permission Sync Log", sync_log, ignore_permissions=True)
+			run_reconciliation(sync_log)
+		
+		log = frappe.get_doc("User Permission Sync Log", sync_log)
+		self.assertEqual(log.status, "Failed")
+		self.assertIn(manager.name, [item.user_permission_manager for item in log.items if item.status == "Failed"])
+	
+	def test_shared_permission_kept_until_last_manager_removed(self):
+		"""Test that a permission granted by two managers survives removing one of them"""
+		managers = []
+		for label in ("First", "Second"):
+			manager = frappe.new_doc("User Permission Manager")
+			manager.manager_name = f"Test Shared {label} Manager"
+			manager.user_field = self.test_user
+			manager.is_active = 1
+			manager.append("user_permission_details", {
+				"allow": "Role",
+				"for_value": "System Manager"
+			})
+			manager.insert(ignore_permissions=True)
+			managers.append(manager)
+		
+		filters = {"user": self.test_user, "allow": "Role", "for_value": "System Manager"}
+		self.assertEqual(frappe.db.count("User Permission", filters), 1)
+		
+		permission = frappe.db.get_value("User Permission", filters)
+		self.assertCountEqual(
+			frappe.get_all("User Permission Ownership",
+				filters={"user_permission": permission},
+				pluck="user_permission_manager"
+			),
+			[manager.name for manager in managers]
+		)
+		
+		frappe.delete_doc("User Permission Manager", managers[0].name, ignore_permissions=True)
+		self.assertEqual(
+			frappe.db.get_value("User Permission", permission, "user_permission_manager"),
+			managers[1].name
+		)
+		
+		frappe.delete_doc("User Permission Manager", managers[1].name, ignore_permissions=True)
+		self.assertFalse(frappe.db.exists("User Permission", permission))
+	
+	def test_drift_repair_recreates_missing_permissions(self):
+		"""Test that the scheduled drift repair restores a permission deleted behind the manager's back"""
+		from duplicate.api.permission_drift import repair_permission_drift
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Drift Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {
+			"allow": "Role",
+			"for_value": "System Manager"
+		})
+		manager.insert(ignore_permissions=True)
+		
+		filters = {"user": self.test_user, "allow": "Role", "for_value": "System Manager"}
+		frappe.db.delete("User Permission", filters)
+		
+		sync_log = repair_permission_drift()
+		
+		self.assertTrue(frappe.db.exists("User Permission", filters))
+		self.assertGreaterEqual(frappe.db.get_value("User Permission Sync Log", sync_log, "missing_count"), 1)
+	
+	def test_drift_repair_releases_users_who_left_a_saved_filter(self):
+		"""Test that the drift repair releases the permissions of users no longer matching a manager's saved filter"""
+		import json
+		
+		from duplicate.api.permission_drift import repair_permission_drift
+		
+		list_filter = frappe.get_doc({
+			"doctype": "List Filter",
+			"filter_name": "Test Drift Filter",
+			"reference_doctype": "User",
+			"filters": json.dumps([["User", "location", "=", "Test Drift Town"]])
+		}).insert(ignore_permissions=True)
+		self.addCleanup(frappe.delete_doc, "List Filter", list_filter.name, ignore_permissions=True)
+		
+		user = "test_drift_filter@example.com"
+		if not frappe.db.exists("User", user):
+			frappe.get_doc({
+				"doctype": "User",
+				"email": user,
+				"first_name": "Drift Filter",
+				"user_type": "System User"
+			}).insert(ignore_permissions=True)
+		frappe.db.set_value("User", user, "location", "Test Drift Town")
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Filter Drift Manager"
+		manager.target_user_filter = list_filter.name
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		
+		filters = {"user": user, "allow": "Role", "for_value": "System Manager", "user_permission_manager": manager.name}
+		self.assertTrue(frappe.db.exists("User Permission", filters))
+		
+		frappe.db.set_value("User", user, "location", None)
+		repair_permission_drift()
+		self.assertFalse(frappe.db.exists("User Permission", filters))
+	
+	def test_drift_repair_failure_marks_log_failed(self):
+		"""Test that a drift repair whose detection raises leaves its log Failed with the error"""
+		from duplicate.api.permission_drift import repair_permission_drift
+		
+		with patch("duplicate.api.permission_drift.find_missing_permissions", side_effect=Exception("Test drift error")):
+			sync_log = repair_permission_drift()
+		self.addCleanup(frappe.delete_doc, "User Permission Sync Log", sync_log, ignore_permissions=True)
+		
+		log = frappe.get_doc("User Permission Sync Log", sync_log)
+		self.assertEqual(log.status, "Failed")
+		self.assertIn("Test drift error", log.items[0].message)
+	
+	def test_concurrent_overlapping_applies(self):
+		"""Test that parallel workers applying overlapping managers leave no errors or duplicates"""
+		import threading
+		
+		users = []
+		for index in range(5):
+			email = f"test_concurrent_{index}@example.com"
+			if not frappe.db.exists("User", email):
+				frappe.get_doc({
+					"doctype": "User",
+					"email": email,
+					"first_name": f"Concurrent {index}",
+					"user_type": "System User"
+				}).insert(ignore_permissions=True)
+			users.append(email)
+		self.addCleanup(self.delete_user_permission_data, users)
+		
+		managers = []
+		for label in ("First", "Second"):
+			manager = frappe.new_doc("User Permission Manager")
+			manager.manager_name = f"Test Concurrent {label} Manager"
+			manager.is_active = 0
+			manager.append("user_permission_details", {
+				"allow": "Role",
+				"for_value": "System Manager"
+			})
+			manager.insert(ignore_permissions=True)
+			managers.append(manager.name)
+		frappe.db.commit()
+		
+		site = frappe.local.site
+		errors = []
+		
+		def worker(manager_name):
+			frappe.init(site=site)
+			frappe.connect()
+			try:
+				manager = frappe.get_doc("User Permission Manager", manager_name)
+				for _ in range(3):
+					manager.apply_to_users(list(reversed(users)))
+					frappe.db.commit()
+			except Exception as e:
+				errors.append(e)
+			finally:
+				frappe.destroy()
+		
+		threads = [threading.Thread(target=worker, args=(managers[index % 2],)) for index in range(6)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		
+		self.assertFalse(errors)
+		for user in users:
+			permissions = frappe.get_all("User Permission",
+				filters={"user": user, "allow": "Role", "for_value": "System Manager"},
+				pluck="name"
+			)
+			self.assertEqual(len(permissions), 1)
+			self.assertEqual(
+				frappe.db.count("User Permission Ownership", {"user_permission": permissions[0]}),
+				2
+			)
+	
+	def test_invalid_detail_links_reported_together(self):
+		"""Test that every invalid details row is reported in one validation error"""
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Invalid Links Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 0
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "_Test Missing Role 1"})
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "_Test Missing Role 2"})
+		
+		with self.assertRaises(frappe.LinkValidationError) as context:
+			manager.insert(ignore_permissions=True)
+		
+		self.assertIn("Row #2", str(context.exception))
+		self.assertIn("Row #3", str(context.exception))
+	
+	def test_permission_plan_is_dry_run_until_executed(self):
+		"""Test that planning writes nothing and executing the plan writes exactly what was planned"""
+		from duplicate.api.permission_plans import build_permission_plan, execute_plan, get_plan_summary
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Plan Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 0
+		manager.append("user_permission_details", {
+			"allow": "Role",
+			"for_value": "System Manager"
+		})
+		manager.insert(ignore_permissions=True)
+		
+		filters = {"user": self.test_user, "allow": "Role", "for_value": "System Manager"}
+		frappe.db.delete("User Permission", filters)
+		
+		plan = build_permission_plan(manager, [self.test_user])
+		summary = get_plan_summary(plan)
+		
+		self.assertEqual(summary["totals"]["inserted"], 1)
+		self.assertEqual(summary["users"][0]["user"], self.test_user)
+		self.assertFalse(frappe.db.exists("User Permission", filters))
+		
+		execute_plan(plan["plan_id"])
+		self.assertTrue(frappe.db.exists("User Permission", filters))
+	
+	def test_executed_plan_survives_drift_repair(self):
+		"""Test that permissions planned for a user the manager does not target are kept by drift repair"""
+		from duplicate.api.permission_drift import find_extra_permissions, repair_permission_drift
+		from duplicate.api.permission_plans import build_permission_plan, execute_plan
+		
+		other_user = "test_plan_other@example.com"
+		if not frappe.db.exists("User", other_user):
+			frappe.get_doc({
+				"doctype": "User",
+				"email": other_user,
+				"first_name": "Plan Other",
+				"user_type": "System User"
+			}).insert(ignore_permissions=True)
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Plan Drift Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		
+		plan = build_permission_plan(manager, [other_user])
+		execute_plan(plan["plan_id"])
+		
+		self.assertNotIn(other_user, [row.user for row in find_extra_permissions() if row.manager == manager.name])
+		repair_permission_drift()
+		self.assertTrue(frappe.db.exists("User Permission", {
+			"user": other_user,
+			"allow": "Role",
+			"for_value": "System Manager",
+			"user_permission_manager": manager.name
+		}))
+	
+	def test_expired_details_are_not_granted_and_revoked(self):
+		"""Test that expired details grant nothing and the sweep revokes their permissions"""
+		from frappe.utils import add_days, today
+		
+		from duplicate.api.permission_validity import revoke_expired_detail
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Validity Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {
+			"allow": "Role",
+			"for_value": "System Manager",
+			"valid_until": add_days(today(), 30)
+		})
+		manager.append("user_permission_details", {
+			"allow": "Role",
+			"for_value": "Guest",
+			"valid_from": add_days(today(), 1)
+		})
+		manager.insert(ignore_permissions=True)
+		
+		filters = {"user": self.test_user, "allow": "Role", "for_value": "System Manager"}
+		self.assertTrue(frappe.db.exists("User Permission", filters))
+		self.assertFalse(frappe.db.exists("User Permission", {**filters, "for_value": "Guest"}))
+		
+		revoke_expired_detail(frappe._dict(
+			manager=manager.name, allow="Role", for_value="System Manager", applicable_for=None
+		))
+		self.assertFalse(frappe.db.exists("User Permission", filters))
+	
+	def test_clone_user_permissions_to_many_users(self):
+		"""Test that cloning copies every permission of the source once to each target user"""
+		from duplicate.api.permission_clone import clone_permissions
+		
+		targets = []
+		for index in range(3):
+			email = f"test_clone_{index}@example.com"
+			if not frappe.db.exists("User", email):
+				frappe.get_doc({
+					"doctype": "User",
+					"email": email,
+					"first_name": f"Clone {index}",
+					"user_type": "System User"
+				}).insert(ignore_permissions=True)
+			targets.append(email)
+		self.addCleanup(self.delete_user_permission_data, targets)
+		
+		if not frappe.db.exists("User Permission", {"user": self.test_user, "allow": "Role", "for_value": "Guest"}):
+			frappe.get_doc({
+				"doctype": "User Permission",
+				"user": self.test_user,
+				"allow": "Role",
+				"for_value": "Guest"
+			}).insert(ignore_permissions=True)
+		
+		source_count = frappe.db.count("User Permission", {"user": self.test_user})
+		clone_permissions(self.test_user, targets)
+		# Cloning twice does not duplicate anything
+		result = clone_permissions(self.test_user, targets)
+		
+		self.assertEqual(result["inserted"], 0)
+		for user in targets:
+			self.assertGreaterEqual(frappe.db.count("User Permission", {"user": user}), source_count)
+			self.assertTrue(frappe.db.exists("User Permission", {"user": user, "allow": "Role", "for_value": "Guest"}))
+		
+		# One manager owns the copies of every target user
+		result = clone_permissions(self.test_user, targets, create_manager=True, manager_name="Test Clone Manager")
+		manager = frappe.get_doc("User Permission Manager", result["manager"])
+		self.assertTrue(manager.is_template)
+		self.assertCountEqual(manager.get_target_users(), targets)
+		for user in targets:
+			self.assertTrue(frappe.db.exists("User Permission Ownership", {
+				"user": user,
+				"user_permission_manager": manager.name
+			}))
+	
+	def test_template_edits_reach_bound_users(self):
+		"""Test that a template's edits are synced to every user it was instantiated for"""
+		from duplicate.api.permission_templates import instantiate_template, unbind_template
+		
+		users = []
+		for index in range(2):
+			email = f"test_template_{index}@example.com"
+			if not frappe.db.exists("User", email):
+				frappe.get_doc({
+					"doctype": "User",
+					"email": email,
+					"first_name": f"Template {index}",
+					"user_type": "System User"
+				}).insert(ignore_permissions=True)
+			users.append(email)
+		
+		template = frappe.new_doc("User Permission Manager")
+		template.manager_name = "Test Template Manager"
+		template.is_template = 1
+		template.is_active = 1
+		template.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		template.insert(ignore_permissions=True)
+		
+		instantiate_template(template.name, users)
+		for user in users:
+			self.assertTrue(frappe.db.exists("User Permission", {"user": user, "allow": "Role", "for_value": "System Manager"}))
+		
+		template.append("user_permission_details", {"allow": "Role", "for_value": "Guest"})
+		template.save(ignore_permissions=True)
+		for user in users:
+			self.assertTrue(frappe.db.exists("User Permission", {"user": user, "allow": "Role", "for_value": "Guest"}))
+		
+		unbind_template(template.name, users[:1])
+		self.assertFalse(frappe.db.exists("User Permission", {"user": users[0], "allow": "Role", "for_value": "Guest"}))
+		self.assertTrue(frappe.db.exists("User Permission", {"user": users[1], "allow": "Role", "for_value": "Guest"}))
+	
+	def test_permission_statistics_follow_writes(self):
+		"""Test that the incremental statistics match a full recount"""
+		from duplicate.api.permission_statistics import get_statistics, recount_permission_statistics
+		
+		recount_permission_statistics()
+		before = get_statistics()
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Statistics Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		frappe.db.commit()
+		
+		after = get_statistics()
+		self.assertEqual(after["total_permissions"], before["total_permissions"] + 1)
+		self.assertEqual(after["managed_permissions"], before["managed_permissions"] + 1)
+		
+		frappe.delete_doc("User Permission Manager", manager.name, ignore_permissions=True)
+		frappe.db.commit()
+		self.assertEqual(get_statistics()["total_permissions"], before["total_permissions"])
+		
+		# A recount finds no drift to correct
+		recount_permission_statistics()
+		self.assertEqual(get_statistics()["total_permissions"], before["total_permissions"])
+	
+	def test_failing_statistics_flush_keeps_the_commit(self):
+		"""Test that a failing statistics update is logged without aborting the commit"""
+		from duplicate.api.permission_statistics import recount_permission_statistics
+		from duplicate.duplicate.doctype.user_permission_statistic.user_permission_statistic import (
+			get_statistic_name,
+		)
+		
+		# The skipped update leaves the counts for the recount to repair
+		self.addCleanup(recount_permission_statistics)
+		self.assertLessEqual(len(get_statistic_name("User", "x" * 140 + "@example.com")), 140)
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Statistics Failure Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		
+		with patch(
+			"duplicate.api.permission_statistics.apply_statistic_deltas", side_effect=frappe.ValidationError
+		), patch("frappe.log_error") as log_error:
+			manager.insert(ignore_permissions=True)
+			frappe.db.commit()
+		
+		log_error.assert_called_once()
+		frappe.db.rollback()
+		self.assertTrue(frappe.db.exists("User Permission Manager", manager.name))
+		self.assertTrue(
+			frappe.db.exists("User Permission", {"user": self.test_user, "allow": "Role", "for_value": "System Manager"})
+		)
+	
+	def test_user_permissions_summary_pages_and_groups(self):
+		"""Test that the summary groups permissions by allow and pages through rows"""
+		from duplicate.api.user_permission_utils import get_user_permissions_summary
+		
+		for role in ("System Manager", "Guest", "All"):
+			if not frappe.db.exists("User Permission", {"user": self.test_user, "allow": "Role", "for_value": role}):
+				frappe.get_doc({
+					"doctype": "User Permission",
+					"user": self.test_user,
+					"allow": "Role",
+					"for_value": role
+				}).insert(ignore_permissions=True)
+		
+		grouped = get_user_permissions_summary(self.test_user, group_by="allow")
+		role_group = next(group for group in grouped["groups"] if group.allow == "Role")
+		self.assertEqual(role_group.count, 3)
+		self.assertNotIn("permissions", grouped)
+		
+		names = []
+		after = None
+		while True:
+			page = get_user_permissions_summary(self.test_user, allow="Role", source="manual", after=after, page_length=2)
+			names.extend(perm.name for perm in page["permissions"])
+			after = page["next_after"]
+			if not after:
+				break
+		
+		self.assertEqual(len(names), 3)
+		self.assertEqual(names, sorted(names))
+	
+	def test_user_sidebar_follows_managed_permissions(self):
+		"""Test that the cached User form sidebar is refreshed when managed permissions change"""
+		from duplicate.api.user_permission_utils import get_user_permission_sidebar
+		
+		before = get_user_permission_sidebar(self.test_user)
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Sidebar Manager"
+		manager.user_field = self.test_user
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		
+		sidebar = get_user_permission_sidebar(self.test_user)
+		self.assertIn(manager.name, [m.user_permission_manager for m in sidebar["managers"]])
+		self.assertNotIn(manager.name, [m.name for m in sidebar["available_managers"]])
+		self.assertEqual(sidebar["managed_permissions"], before["managed_permissions"] + 1)
+		
+		frappe.delete_doc("User Permission Manager", manager.name, ignore_permissions=True)
+		sidebar = get_user_permission_sidebar(self.test_user)
+		self.assertNotIn(manager.name, [m.user_permission_manager for m in sidebar["managers"]])
+	
+	def test_summary_not_modified_until_permissions_change(self):
+		"""Test that a summary version is answered with not modified until the user's permissions change"""
+		from duplicate.api.user_permission_utils import get_user_permissions_summary
+		
+		summary = get_user_permissions_summary(self.test_user, group_by="allow")
+		self.assertTrue(summary["version"])
+		
+		unchanged = get_user_permissions_summary(self.test_user, group_by="allow", version=summary["version"])
+		self.assertEqual(unchanged, {"not_modified": 1, "version": summary["version"]})
+		
+		# Another view of the same user has its own version
+		rows = get_user_permissions_summary(self.test_user, version=summary["version"])
+		self.assertNotIn("not_modified", rows)
+		self.assertNotEqual(rows["version"], summary["version"])
+		
+		frappe.get_doc({
+			"doctype": "User Permission",
+			"user": self.test_user,
+			"allow": "Role",
+			"for_value": "Guest"
+		}).insert(ignore_permissions=True)
+		
+		changed = get_user_permissions_summary(self.test_user, group_by="allow", version=summary["version"])
+		self.assertNotIn("not_modified", changed)
+		self.assertNotEqual(changed["version"], summary["version"])
+		self.assertEqual(changed["total_permissions"], summary["total_permissions"] + 1)
+	
+	def test_permission_batch_keeps_operations_around_a_failure(self):
+		"""Test that a failed batch operation is rolled back alone"""
+		from duplicate.api.permission_batch import run_permission_batch
+		
+		manager = frappe.new_doc("User Permission Manager")
+		manager.manager_name = "Test Batch Manager"
+		manager.is_active = 1
+		manager.append("user_permission_details", {"allow": "Role", "for_value": "System Manager"})
+		manager.insert(ignore_permissions=True)
+		
+		batch = run_permission_batch([
+			{"type": "apply_manager", "manager_name": manager.name, "user_email": self.test_user},
+			{"type": "duplicate_role", "source_role": "Role That Does Not Exist", "new_role_name": "Test Batch Role"},
+			{"type": "preview_manager", "manager_name": manager.name},
+		])
+		
+		self.assertTrue(batch["committed"])
+		self.assertEqual([result["status"] for result in batch["results"]], ["Success", "Failed", "Success"])
+		self.assertEqual(batch["failed"], 1)
+		self.assertTrue(frappe.db.exists("User Permission", {
+			"user": self.test_user,
+			"allow": "Role",
+			"for_value": "System Manager",
+			"user_permission_manager": manager.name
+		}))
+		self.assertIn(self.test_user, batch["results"][2]["result"]["target_users"])
+		
+		removed = run_permission_batch(
+			[{"type": "remove_manager", "manager_name": manager.name, "user_email": self.test_user}], atomic=True
+		)
+		self.assertEqual(removed["results"][0]["result"]["deleted_count"], 1)
+	
+	def test_search_users_filters_and_pages(self):
+		"""Test that the user search applies its filters and pages by name"""
+		from duplicate.api.user_permission_utils import search_users
+		
+		page = search_users(txt=self.test_user[:4])
+		self.assertIn(self.test_user, [user.name for user in page["results"]])
+		
+		names = []
+		after = None
+		while True:
+			page = search_users(after=after, page_length=1)
+			names.extend(user.name for user in page["results"])
+			after = page["next_after"]
+			if not after or len(names) >= 3:
+				break
+		
+		self.assertEqual(names, sorted(names))
+		self.assertEqual(len(names), len(set(names)))
+	
+	def test_packed_permission_bits_round_trip(self):
+		"""Test that every permission flag survives packing into the bitmask of compact responses"""
+		from duplicate.api.role_utils import PERMISSION_BITS, pack_permissions
+		
+		for index, field in enumerate(PERMISSION_BITS):
+			perm = frappe._dict(parent="ToDo", permlevel=1, **{bit: int(bit == field) for bit in PERMISSION_BITS})
+			self.assertEqual(pack_permissions([perm]), {"doctypes": ["ToDo"], "rows": [[0, 1, 1 << index]]})
+		
+		perms = [
+			frappe._dict(parent="ToDo", permlevel=0, **{bit: index % 2 for index, bit in enumerate(PERMISSION_BITS)}),
+			frappe._dict(parent="Note", permlevel=0, **{bit: 1 for bit in PERMISSION_BITS}),
+			frappe._dict(parent="ToDo", permlevel=1, **{bit: 0 for bit in PERMISSION_BITS})
+		]
+		packed = pack_permissions(perms)
+		self.assertEqual(packed["doctypes"], ["ToDo", "Note"])
+		self.assertEqual(decode_permissions(packed, PERMISSION_BITS), perms)
+	
+	def test_compact_role_details_match_full_ones(self):
+		"""Test that compact role details decode to the same permissions as the full response"""
+		from duplicate.api.role_utils import get_role_details
+		
+		full = get_role_details("System Manager")
+		compact = get_role_details("System Manager", compact=1)
+		
+		self.assertNotEqual(compact["version"], full["version"])
+		self.assertEqual(compact["role"].role_name, full["role"].role_name)
+		self.assertEqual(compact["total_permissions"], full["total_permissions"])
+		for key in ("doctype_permissions", "custom_permissions"):
+			expected = [
+				frappe._dict(
+					parent=perm.parent,
+					permlevel=perm.permlevel or 0,
+					**{bit: 1 if perm.get(bit) else 0 for bit in compact["bits"]}
+				)
+				for perm in full[key]
+			]
+			self.assertCountEqual(decode_permissions(compact[key], compact["bits"]), expected)
+
+
+def decode_permissions(packed, bits):
+	"""Unpack compact permission rows the way role.js does"""
+	return [
+		frappe._dict(
+			parent=packed["doctypes"][doctype_index],
+			permlevel=permlevel,
+			**{bit: (mask >> index) & 1 for index, bit in enumerate(bits)}
+		)
+		for doctype_index, permlevel, mask in packed["rows"]
+	]
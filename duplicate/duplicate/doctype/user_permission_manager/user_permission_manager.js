@@ -2,6 +2,22 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('User Permission Manager', {
+	setup: function(frm) {
+		frm.set_query('target_user_filter', function() {
+			return {
+				filters: {
+					'reference_doctype': 'User'
+				}
+			};
+		});
+		
+		frappe.realtime.on('user_permission_manager_sync', function(data) {
+			if (data.manager === frm.doc.name && !frm.is_dirty()) {
+				frm.reload_doc();
+			}
+		});
+	},
+	
 	refresh: function(frm) {
 		// Add custom buttons
 		if (!frm.is_new()) {
@@ -20,6 +36,23 @@ frappe.ui.form.on('User Permission Manager', {
 			frm.add_custom_button(__('Check Missing Permissions'), function() {
 				check_missing_permissions(frm);
 			});
+			
+			if (frm.doc.is_template) {
+				frm.add_custom_button(__('Instantiate for Users'), function() {
+					instantiate_template(frm);
+				});
+			}
+			
+			show_sync_status(frm);
+			
+			if (frm.doc.sync_checkpoint) {
+				frm.add_custom_button(__('Resume Sync'), function() {
+					resume_sync(frm);
+				});
+				frm.dashboard.set_headline(
+					__('Last sync stopped after {0}. Resume it to apply the remaining users.', [frm.doc.sync_checkpoint])
+				);
+			}
 		}
 	},
 	
@@ -140,6 +173,12 @@ function preview_permissions(frm) {
 	if (frm.doc.apply_to_all_users) {
 		html += '<p><strong>' + __('Target') + ':</strong> All System Users</p>';
 	}
+	if (frm.doc.target_role) {
+		html += '<p><strong>' + __('Target Role') + ':</strong> ' + frm.doc.target_role + '</p>';
+	}
+	if (frm.doc.target_user_filter) {
+		html += '<p><strong>' + __('Target User Filter') + ':</strong> ' + frm.doc.target_user_filter + '</p>';
+	}
 	
 	html += '</div>';
 	
@@ -169,6 +208,23 @@ function sync_user(frm) {
 	);
 }
 
+function resume_sync(frm) {
+	frappe.call({
+		method: 'duplicate.duplicate.doctype.user_permission_manager.user_permission_manager.resume_user_permission_sync',
+		args: {
+			manager_name: frm.doc.name
+		},
+		callback: function(r) {
+			if (r.message && r.message.success) {
+				frappe.show_alert({
+					message: r.message.message,
+					indicator: 'blue'
+				});
+			}
+		}
+	});
+}
+
 function check_missing_permissions(frm) {
 	if (!frm.doc.is_active) {
 		frappe.msgprint(__('Permission Manager must be active to check permissions'));
@@ -221,3 +277,56 @@ function check_missing_permissions(frm) {
 		}
 	});
 }
+
+function instantiate_template(frm) {
+	let d = new frappe.ui.Dialog({
+		title: __('Instantiate Template'),
+		fields: [
+			{
+				fieldtype: 'MultiSelectList',
+				fieldname: 'users',
+				label: __('Users'),
+				reqd: 1,
+				get_data: function(txt) {
+					return frappe.db.get_link_options('User', txt, {enabled: 1, user_type: 'System User'});
+				}
+			}
+		],
+		primary_action_label: __('Instantiate'),
+		primary_action: function(values) {
+			d.hide();
+			frappe.call({
+				method: 'duplicate.api.user_permission_utils.instantiate_permission_template',
+				args: {
+					template: frm.doc.name,
+					user_emails: values.users
+				},
+				freeze: true,
+				freeze_message: __('Applying template...'),
+				callback: function(r) {
+					if (!r.message) return;
+					frappe.show_alert({
+						message: r.message.job
+							? __('Bound {0} users, permissions are being applied in the background', [r.message.bound])
+							: __('Bound {0} users and created {1} permissions', [r.message.bound, r.message.inserted]),
+						indicator: 'green'
+					});
+				}
+			});
+		}
+	});
+	d.show();
+}
+
+function show_sync_status(frm) {
+	var messages = {
+		'Pending': [__('Changes will be applied to users shortly'), 'orange'],
+		'Running': [__('Applying changes to users...'), 'blue'],
+		'Applied': [__('Changes applied to users on {0}', [frappe.datetime.str_to_user(frm.doc.last_synced_on)]), 'green'],
+		'Failed': [__('Applying changes to users failed, see the Error Log'), 'red']
+	};
+	var message = messages[frm.doc.sync_status];
+	if (message) {
+		frm.dashboard.set_headline_alert(message[0], message[1]);
+	}
+}
@@ -4,6 +4,28 @@
 import frappe
 from frappe.model.document import Document
 from frappe import _
+from frappe.utils import getdate
+
+from duplicate.api.permission_cache import (
+	clear_manager_active_cache,
+	is_manager_active,
+)
+from duplicate.api.permission_jobs import request_manager_sync
+from duplicate.api.permission_locks import lock_users
+from duplicate.api.permission_targets import (
+	bind_users,
+	clear_target_user_cache,
+	get_saved_user_filters,
+	has_target_users,
+	iter_target_user_batches,
+	unbind_users,
+)
+from duplicate.api.permission_writer import (
+	apply_manager_to_users,
+	execute_permission_changes,
+	get_permission_changes,
+	release_manager_permissions,
+)
 
 
 class UserPermissionManager(Document):
@@ -21,116 +43,150 @@ class UserPermissionManager(Document):
 					detail.allow, detail.for_value
 				))
 			seen_combinations.add(combination)
+			
+			if detail.valid_from and detail.valid_until and getdate(detail.valid_from) > getdate(detail.valid_until):
+				frappe.throw(_("Row #{0}: Valid From cannot be after Valid Until").format(detail.idx))
+		
+		if self.is_template and (self.user_field or self.apply_to_all_users or self.target_role or self.target_user_filter):
+			frappe.throw(_("A template targets the users it is instantiated for, please clear its target users"))
+		
+		if self.target_user_filter:
+			# Raises if the saved filter does not filter Users
+			get_saved_user_filters(self.target_user_filter)
+	
+	def _validate_links(self):
+		"""Validate the manager's own links as usual, and the details rows in batches"""
+		if self.flags.ignore_links or self._action == "cancel":
+			return
+		
+		invalid_links, cancelled_links = self.get_invalid_links()
+		if invalid_links:
+			frappe.throw(
+				_("Could not find {0}").format(", ".join(link[2] for link in invalid_links)),
+				frappe.LinkValidationError
+			)
+		
+		self.validate_detail_links()
+	
+	def validate_detail_links(self):
+		"""Check the links of all User Permission Details rows with one query per DocType
+		
+		All invalid rows are reported at once.
+		"""
+		details = [d for d in self.user_permission_details if d.allow]
+		doctypes = {d.allow for d in details} | {d.applicable_for for d in details if d.applicable_for}
+		
+		# Names are matched case-insensitively like the database does, keeping the stored casing
+		existing_doctypes = {
+			name.lower(): name
+			for name in frappe.get_all("DocType", filters={"name": ["in", list(doctypes)]}, pluck="name")
+		}
+		for d in details:
+			d.allow = existing_doctypes.get(d.allow.lower(), d.allow)
+			if d.applicable_for:
+				d.applicable_for = existing_doctypes.get(d.applicable_for.lower(), d.applicable_for)
+		
+		values_by_doctype = {}
+		for d in details:
+			if d.allow.lower() in existing_doctypes and d.for_value:
+				values_by_doctype.setdefault(d.allow, set()).add(d.for_value)
+		
+		existing_values = {}
+		for doctype, values in values_by_doctype.items():
+			names = [doctype] if frappe.get_meta(doctype).issingle else frappe.get_all(
+				doctype, filters={"name": ["in", list(values)]}, pluck="name"
+			)
+			existing_values[doctype] = {name.lower(): name for name in names}
+		
+		errors = []
+		for d in details:
+			if d.allow.lower() not in existing_doctypes:
+				errors.append(_("Row #{0}: DocType {1} not found").format(d.idx, frappe.bold(d.allow)))
+			elif d.for_value:
+				value = existing_values[d.allow].get(d.for_value.lower())
+				if value:
+					d.for_value = value
+				else:
+					errors.append(_("Row #{0}: {1} {2} not found").format(d.idx, _(d.allow), frappe.bold(d.for_value)))
+			
+			if d.applicable_for and d.applicable_for.lower() not in existing_doctypes:
+				errors.append(_("Row #{0}: DocType {1} not found").format(d.idx, frappe.bold(d.applicable_for)))
 		
-		# Check for missing permissions if manager is active
-		if self.is_active and not self.is_new():
-			self.check_and_recreate_missing_permissions()
+		if errors:
+			frappe.throw("<br>".join(errors), frappe.LinkValidationError, title=_("Invalid Permission Details"))
 	
 	def on_update(self):
 		"""Handle updates to User Permission Manager"""
-		if self.has_value_changed('user_field') or self.has_value_changed('user_permission_details'):
-			self.sync_user_permissions()
+		clear_manager_active_cache(self.name)
+		clear_target_user_cache(self.name)
+		
+		if self.is_active and not self.flags.skip_sync:
+			# Every save reconciles the target users, recreating missing permissions too;
+			# rapid edits are collapsed into one debounced background sync
+			request_manager_sync(self.name)
+			self.sync_status, self.last_synced_on = frappe.db.get_value(
+				"User Permission Manager", self.name, ["sync_status", "last_synced_on"]
+			)
 	
-	def sync_user_permissions(self):
-		"""Sync user permissions based on the manager configuration"""
+	def sync_user_permissions(self, resume=False):
+		"""Sync user permissions based on the manager configuration
+		
+		Target users are applied chunk by chunk. After each chunk is committed the
+		last user is stored in `sync_checkpoint`, so an interrupted sync can be
+		resumed from there with `resume=True`.
+		"""
 		if not self.is_active:
 			return
 		
-		# Get target users
-		target_users = self.get_target_users()
+		self.ensure_user_permission_custom_field()
 		
-		if not target_users:
-			return
+		after = self.sync_checkpoint if resume else None
+		for users in self.iter_target_user_batches(after=after):
+			self.apply_to_users(users)
+			self.set_sync_checkpoint(users[-1])
+			frappe.db.commit()
 		
-		for user in target_users:
-			self.create_user_permissions_for_user(user)
+		self.set_sync_checkpoint(None)
+		frappe.db.commit()
+	
+	def set_sync_checkpoint(self, user):
+		"""Store the last user applied by the running sync"""
+		self.db_set("sync_checkpoint", user, update_modified=False)
 	
 	def get_target_users(self):
 		"""Get list of users to apply permissions to"""
-		target_users = []
-		
-		if self.user_field:
-			target_users.append(self.user_field)
-		
-		return target_users
+		return [user for users in self.iter_target_user_batches() for user in users]
+	
+	def iter_target_user_batches(self, batch_size=None, after=None):
+		"""Yield target users in name order, one chunk at a time"""
+		return iter_target_user_batches(self, batch_size=batch_size, after=after)
+	
+	def apply_to_users(self, users):
+		"""Apply the permission details to a chunk of users with bulk writes, without committing"""
+		return apply_manager_to_users(self, users)
 	
 	def create_user_permissions_for_user(self, user):
 		"""Create user permissions for a specific user"""
-		# Remove existing permissions managed by this manager
-		self.remove_existing_managed_permissions(user)
-		
-		# Create new permissions
-		for detail in self.user_permission_details:
-			if detail.allow and detail.for_value:
-				try:
-					self.create_user_permission(user, detail)
-				except Exception as e:
-					frappe.log_error(
-						title="User Permission Creation Failed",
-						message=f"Failed to create permission for user {user}: {str(e)}"
-					)
-	
-	def create_user_permission(self, user, detail):
-		"""Create a single user permission"""
-		# Check if permission already exists
-		existing = frappe.db.exists("User Permission", {
-			"user": user,
-			"allow": detail.allow,
-			"for_value": detail.for_value,
-			"applicable_for": detail.applicable_for or None
-		})
-		
-		if existing:
-			# Update existing permission
-			perm_doc = frappe.get_doc("User Permission", existing)
-			perm_doc.apply_to_all = 1 if detail.apply_to_all_doctypes else 0
-			perm_doc.is_default = 1 if detail.is_default else 0
-			perm_doc.hide_descendants = 1 if detail.hide_descendants else 0
-			
-			# Only set custom field if it exists
-			if frappe.db.has_column("User Permission", "user_permission_manager"):
-				perm_doc.user_permission_manager = self.name
-			
-			perm_doc.save(ignore_permissions=True)
-		else:
-			# Create new permission
-			perm_doc = frappe.new_doc("User Permission")
-			perm_doc.user = user
-			perm_doc.allow = detail.allow
-			perm_doc.for_value = detail.for_value
-			
-			if detail.applicable_for:
-				perm_doc.applicable_for = detail.applicable_for
-			
-			perm_doc.apply_to_all = 1 if detail.apply_to_all_doctypes else 0
-			perm_doc.is_default = 1 if detail.is_default else 0
-			perm_doc.hide_descendants = 1 if detail.hide_descendants else 0
-			
-			# Only set custom field if it exists
-			if frappe.db.has_column("User Permission", "user_permission_manager"):
-				perm_doc.user_permission_manager = self.name
-			
-			perm_doc.insert(ignore_permissions=True)
-		
+		self.add_user(user)
 		frappe.db.commit()
 	
-	def remove_existing_managed_permissions(self, user):
-		"""Remove existing permissions managed by this manager"""
-		# First, add custom field to User Permission if it doesn't exist
+	def add_user(self, user):
+		"""Bind a user to this manager and grant them its permissions, without committing"""
 		self.ensure_user_permission_custom_field()
+		if user != self.user_field:
+			# Users applied by hand stay targets of the manager
+			bind_users(self.name, [user])
+		return self.apply_to_users([user])
+	
+	def remove_existing_managed_permissions(self, user):
+		"""Release the permissions this manager grants to a user, without committing
 		
-		# Only query for managed permissions if the custom field exists
-		if frappe.db.has_column("User Permission", "user_permission_manager"):
-			existing_permissions = frappe.get_all("User Permission", 
-				filters={
-					"user": user,
-					"user_permission_manager": self.name
-				},
-				pluck="name"
-			)
-			
-			for perm_name in existing_permissions:
-				frappe.delete_doc("User Permission", perm_name, ignore_permissions=True)
+		Permissions also granted by another manager are kept for that manager.
+		Returns the number of released rows.
+		"""
+		self.ensure_user_permission_custom_field()
+		unbind_users(self.name, [user])
+		return release_manager_permissions(self.name, users=[user])
 	
 	def ensure_user_permission_custom_field(self):
 		"""Ensure User Permission DocType has the custom field for tracking"""
@@ -157,54 +213,51 @@ class UserPermissionManager(Document):
 	
 	def on_trash(self):
 		"""Clean up user permissions when manager is deleted"""
+		clear_manager_active_cache(self.name)
 		self.ensure_user_permission_custom_field()
 		
-		# Remove all permissions created by this manager
-		permissions_to_delete = frappe.get_all("User Permission",
-			filters={"user_permission_manager": self.name},
-			pluck="name"
-		)
-		
-		for perm_name in permissions_to_delete:
-			frappe.delete_doc("User Permission", perm_name, ignore_permissions=True)
+		# Release all permissions owned by this manager; shared ones stay with their other managers
+		release_manager_permissions(self.name)
+		frappe.db.delete("User Permission Ownership", {"user_permission_manager": self.name})
+		unbind_users(self.name)
+	
+	def after_rename(self, old_name, new_name, merge=False):
+		"""Drop cached flags stored under the previous name"""
+		for name in (old_name, new_name):
+			clear_manager_active_cache(name)
+			clear_target_user_cache(name)
 
 	def check_and_recreate_missing_permissions(self):
 		"""Check for manually deleted permissions and recreate them if manager is active"""
-		if not self.is_active or not self.user_field:
+		if not self.is_active or not has_target_users(self):
 			return
 
-		missing_permissions = []
-		users = self.get_target_users()
+		self.ensure_user_permission_custom_field()
+		missing_count = 0
 		
-		for user in users:
-			for detail in self.user_permission_details:
-				# Check if permission exists
-				existing = frappe.db.exists("User Permission", {
-					"user": user,
-					"allow": detail.allow,
-					"for_value": detail.for_value,
-					"applicable_for": detail.applicable_for or None,
-					"user_permission_manager": self.name
-				})
-				
-				if not existing:
-					missing_permissions.append({
-						"user": user,
-						"allow": detail.allow,
-						"for_value": detail.for_value,
-						"applicable_for": detail.applicable_for
-					})
+		# Only chunks with missing permissions are reconciled again
+		for users in self.iter_target_user_batches():
+			changes = get_permission_changes(self, users, for_update=False)
+			if changes["insert"]:
+				lock_users(users)
+				changes = get_permission_changes(self, users)
+				execute_permission_changes(self.name, changes)
+				missing_count += len(changes["insert"])
 		
-		# Recreate missing permissions
-		if missing_permissions:
-			for user in users:
-				self.create_user_permissions_for_user(user)
-			
+		if missing_count:
 			frappe.msgprint(
-				_("Detected {0} missing permissions and recreated them").format(len(missing_permissions)),
+				_("Detected {0} missing permissions and recreated them").format(missing_count),
 				indicator="orange"
 			)
 
+	def count_missing_permissions(self):
+		"""Count the permissions of target users that do not exist"""
+		self.ensure_user_permission_custom_field()
+		return sum(
+			len(get_permission_changes(self, users, for_update=False)["insert"])
+			for users in self.iter_target_user_batches()
+		)
+
 
 @frappe.whitelist()
 def apply_permission_manager_to_user(manager_name, user_email):
@@ -226,6 +279,26 @@ def apply_permission_manager_to_user(manager_name, user_email):
 		}
 
 
+@frappe.whitelist()
+def resume_user_permission_sync(manager_name):
+	"""Resume an interrupted sync of a permission manager in the background"""
+	if not frappe.has_permission("User Permission Manager", "write"):
+		frappe.throw(_("Insufficient permissions"))
+	
+	frappe.enqueue(
+		"duplicate.duplicate.doctype.user_permission_manager.user_permission_manager.run_user_permission_sync",
+		queue="long",
+		manager_name=manager_name,
+		resume=True
+	)
+	return {"success": True, "message": _("Sync resumed in the background")}
+
+
+def run_user_permission_sync(manager_name, resume=False):
+	"""Background job syncing all target users of a permission manager"""
+	frappe.get_doc("User Permission Manager", manager_name).sync_user_permissions(resume=resume)
+
+
 @frappe.whitelist()
 def get_user_permission_managers_for_user(user_email):
 	"""Get all permission managers applied to a user"""
@@ -234,10 +307,11 @@ def get_user_permission_managers_for_user(user_email):
 	doc.ensure_user_permission_custom_field()
 	
 	managers = frappe.db.sql("""
-		SELECT DISTINCT up.user_permission_manager, upm.manager_name, upm.description
-		FROM `tabUser Permission` up
-		LEFT JOIN `tabUser Permission Manager` upm ON up.user_permission_manager = upm.name
-		WHERE up.user = %s AND up.user_permission_manager IS NOT NULL
+		SELECT DISTINCT o.user_permission_manager, upm.manager_name, upm.description
+		FROM `tabUser Permission Ownership` o
+		INNER JOIN `tabUser Permission` up ON up.name = o.user_permission
+		LEFT JOIN `tabUser Permission Manager` upm ON o.user_permission_manager = upm.name
+		WHERE o.user = %s
 	""", (user_email,), as_dict=True)
 	
 	return managers
@@ -250,25 +324,10 @@ def check_missing_permissions(manager_name):
 		frappe.throw(_("Insufficient permissions"))
 	
 	manager_doc = frappe.get_doc("User Permission Manager", manager_name)
-	if not manager_doc.is_active or not manager_doc.user_field:
+	if not manager_doc.is_active or not has_target_users(manager_doc):
 		return {"missing_count": 0, "message": _("Manager is not active or no user assigned")}
 	
-	missing_count = 0
-	users = manager_doc.get_target_users()
-	
-	for user in users:
-		for detail in manager_doc.user_permission_details:
-			# Check if permission exists
-			existing = frappe.db.exists("User Permission", {
-				"user": user,
-				"allow": detail.allow,
-				"for_value": detail.for_value,
-				"applicable_for": detail.applicable_for or None,
-				"user_permission_manager": manager_name
-			})
-			
-			if not existing:
-				missing_count += 1
+	missing_count = manager_doc.count_missing_permissions()
 	
 	return {
 		"missing_count": missing_count,
@@ -283,7 +342,7 @@ def recreate_missing_permissions(manager_name):
 		frappe.throw(_("Insufficient permissions"))
 	
 	manager_doc = frappe.get_doc("User Permission Manager", manager_name)
-	if manager_doc.is_active and manager_doc.user_field:
+	if manager_doc.is_active and has_target_users(manager_doc):
 		manager_doc.check_and_recreate_missing_permissions()
 		return {"success": True, "message": _("Missing permissions recreated successfully")}
 	else:
@@ -291,14 +350,39 @@ def recreate_missing_permissions(manager_name):
 
 
 def prevent_managed_permission_deletion(doc, method):
-	"""Prevent deletion of User Permissions that are managed by a Permission Manager"""
-	if doc.user_permission_manager:
-		# Check if the manager is still active
-		manager_doc = frappe.get_doc("User Permission Manager", doc.user_permission_manager)
-		if manager_doc.is_active:
-			frappe.throw(
-				_("This User Permission is managed by '{0}' and cannot be deleted manually. Please deactivate or modify the Permission Manager instead.").format(
-					manager_doc.alias_name or manager_doc.name
-				),
-				title=_("Managed Permission")
-			)
+	"""Prevent deletion of User Permissions that are managed by a Permission Manager
+	
+	Managers release their own permissions with bulk deletes, which run no doc events.
+	"""
+	manager_name = doc.get("user_permission_manager")
+	if not manager_name:
+		# Manual permissions have no owners to protect them
+		return
+	
+	if not is_manager_active(manager_name):
+		# A shared permission stays protected while any of its other managers is active
+		manager_name = next(
+			(
+				owner
+				for owner in frappe.get_all(
+					"User Permission Ownership",
+					filters={"user_permission": doc.name},
+					pluck="user_permission_manager",
+				)
+				if is_manager_active(owner)
+			),
+			None,
+		)
+	
+	if manager_name:
+		frappe.throw(
+			_("This User Permission is managed by '{0}' and cannot be deleted manually. Please deactivate or modify the Permission Manager instead.").format(
+				frappe.db.get_value("User Permission Manager", manager_name, "manager_name") or manager_name
+			),
+			title=_("Managed Permission")
+		)
+
+
+def delete_permission_ownerships(doc, method):
+	"""Drop the ownership rows of a deleted User Permission"""
+	frappe.db.delete("User Permission Ownership", {"user_permission": doc.name})
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, sammish and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on('User Permission Manager Binding', {
+// 	refresh: function(frm) {
+
+// 	}
+// });
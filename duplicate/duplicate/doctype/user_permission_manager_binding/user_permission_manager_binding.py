@@ -0,0 +1,16 @@
+# Copyright (c) 2026, sammish and contributors
+# For license information, please see license.txt
+
+import hashlib
+
+from frappe.model.document import Document
+
+
+class UserPermissionManagerBinding(Document):
+	def autoname(self):
+		self.name = get_binding_name(self.user_permission_manager, self.user)
+
+
+def get_binding_name(user_permission_manager, user):
+	"""Get the deterministic name of the binding of a manager to a user"""
+	return hashlib.md5(f"{user_permission_manager}:{user}".encode()).hexdigest()
@@ -0,0 +1,20 @@
+# Copyright (c) 2026, sammish and contributors
+# For license information, please see license.txt
+
+import hashlib
+
+from frappe.model.document import Document
+
+
+class UserPermissionOwnership(Document):
+	def autoname(self):
+		self.name = get_ownership_name(self.user_permission, self.user_permission_manager)
+
+
+def get_ownership_name(user_permission, user_permission_manager):
+	"""Get the deterministic name of the ownership of a User Permission by a manager
+
+	Using the pair as primary key makes each ownership unique and lets bulk
+	inserts skip ownerships that already exist.
+	"""
+	return hashlib.md5(f"{user_permission}:{user_permission_manager}".encode()).hexdigest()
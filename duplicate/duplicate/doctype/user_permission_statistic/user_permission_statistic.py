@@ -0,0 +1,22 @@
+# Copyright (c) 2026, sammish and contributors
+# For license information, please see license.txt
+
+import hashlib
+
+from frappe.model.document import Document
+
+
+class UserPermissionStatistic(Document):
+	def autoname(self):
+		self.name = get_statistic_name(self.statistic_type, self.reference)
+
+
+def get_statistic_name(statistic_type, reference=None):
+	"""Get the name of a statistic row, e.g. `Total` or `Allow:<hash of Company>`
+
+	References are hashed so that long user ids or DocType names always fit
+	the name column; the reference itself is kept in its own field.
+	"""
+	if not reference:
+		return statistic_type
+	return f"{statistic_type}:{hashlib.md5(reference.encode()).hexdigest()}"
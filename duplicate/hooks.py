@@ -141,14 +141,69 @@ doctype_js = {
 # Hook on document methods and events
 
 doc_events = {
+	"User Permission Manager": {
+		"on_update": [
+			"duplicate.api.page_cache.clear_manager_page_data",
+			"duplicate.api.permission_cache.clear_all_user_sidebar_caches",
+			"duplicate.api.response_versions.bump_manager_version"
+		],
+		"on_trash": [
+			"duplicate.api.page_cache.clear_manager_page_data",
+			"duplicate.api.permission_cache.clear_all_user_sidebar_caches",
+			"duplicate.api.response_versions.bump_manager_version"
+		],
+		"after_rename": [
+			"duplicate.api.page_cache.clear_manager_page_data",
+			"duplicate.api.permission_cache.clear_all_user_sidebar_caches",
+			"duplicate.api.response_versions.bump_manager_version"
+		]
+	},
 	"User Permission": {
-		"before_delete": "duplicate.duplicate.doctype.user_permission_manager.user_permission_manager.prevent_managed_permission_deletion"
+		"before_delete": "duplicate.duplicate.doctype.user_permission_manager.user_permission_manager.prevent_managed_permission_deletion",
+		"on_update": [
+			"duplicate.api.permission_statistics.update_permission_statistics",
+			"duplicate.api.permission_cache.clear_permission_user_sidebar_cache",
+			"duplicate.api.response_versions.bump_permission_user_version"
+		],
+		"on_trash": [
+			"duplicate.duplicate.doctype.user_permission_manager.user_permission_manager.delete_permission_ownerships",
+			"duplicate.api.permission_statistics.remove_permission_statistics",
+			"duplicate.api.permission_cache.clear_permission_user_sidebar_cache",
+			"duplicate.api.response_versions.bump_permission_user_version"
+		]
+	},
+	"Role": {
+		"on_update": "duplicate.api.response_versions.bump_role_version",
+		"on_trash": "duplicate.api.response_versions.bump_role_version"
+	},
+	"Custom DocPerm": {
+		"on_update": "duplicate.api.response_versions.bump_permission_role_version",
+		"on_trash": "duplicate.api.response_versions.bump_permission_role_version"
+	},
+	"DocType": {
+		"on_update": "duplicate.api.response_versions.bump_doctype_role_versions"
 	}
 }
 
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"cron": {
+		"* * * * *": [
+			"duplicate.api.permission_jobs.enqueue_due_manager_syncs"
+		]
+	},
+	"hourly_long": [
+		"duplicate.api.permission_drift.repair_permission_drift",
+		"duplicate.api.permission_reconciliation.resume_stalled_reconciliations"
+	],
+	"daily_long": [
+		"duplicate.api.permission_validity.sweep_permission_validity",
+		"duplicate.api.permission_statistics.recount_permission_statistics"
+	]
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"duplicate.tasks.all"
@@ -246,5 +301,5 @@ doc_events = {
 # Custom CLI Commands
 # -------------------
 # Add custom commands to bench
-# Commands are automatically discovered by Frappe from the commands directory
+# Bench discovers them from the `commands` list in duplicate/commands.py
 
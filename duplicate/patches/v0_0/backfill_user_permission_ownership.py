@@ -0,0 +1,35 @@
+import frappe
+
+from duplicate.api.permission_writer import WRITE_CHUNK_SIZE, insert_ownerships
+
+
+def execute():
+	"""Record the manager stamped on existing managed User Permissions as their owner"""
+	if not frappe.db.has_column("User Permission", "user_permission_manager"):
+		return
+
+	after = ""
+	while True:
+		rows = frappe.db.sql(
+			"""
+			SELECT name, user, user_permission_manager
+			FROM `tabUser Permission`
+			WHERE name > %(after)s AND user_permission_manager IS NOT NULL AND user_permission_manager != ''
+			ORDER BY name
+			LIMIT %(limit)s
+		""",
+			{"after": after, "limit": WRITE_CHUNK_SIZE},
+			as_dict=True,
+		)
+		if not rows:
+			break
+
+		by_manager = {}
+		for row in rows:
+			by_manager.setdefault(row.user_permission_manager, []).append((row.name, row.user))
+
+		for manager_name, permissions in by_manager.items():
+			insert_ownerships(manager_name, permissions)
+
+		frappe.db.commit()
+		after = rows[-1].name
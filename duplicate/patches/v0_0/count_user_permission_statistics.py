@@ -0,0 +1,6 @@
+from duplicate.api.permission_statistics import recount_permission_statistics
+
+
+def execute():
+	"""Fill the User Permission Statistic rows from the existing User Permissions"""
+	recount_permission_statistics()
@@ -0,0 +1,6 @@
+from duplicate.api.permission_statistics import recount_permission_statistics
+
+
+def execute():
+	"""Recreate the User Permission Statistic rows under their hashed names"""
+	recount_permission_statistics()
@@ -100,20 +100,42 @@ function duplicate_role(source_role, new_role_name, copy_permissions, dialog) {
 }
 
 function view_permissions_summary(frm) {
+	// Decoded details are kept per role and reused while the server answers "not modified"
+	let cached = frm.role_details && frm.role_details.role.role_name === frm.doc.role_name ? frm.role_details : null;
 	frappe.call({
 		method: 'duplicate.api.role_utils.get_role_details',
 		args: {
-			role_name: frm.doc.role_name
+			role_name: frm.doc.role_name,
+			compact: 1,
+			version: cached ? cached.version : null
 		},
 		callback: function(r) {
-			if (r.message) {
-				const data = r.message;
-				show_permissions_dialog(data);
+			if (!r.message) return;
+			if (r.message.not_modified && cached) {
+				show_permissions_dialog(cached);
+				return;
 			}
+			
+			const data = r.message;
+			data.doctype_permissions = decode_permissions(data.doctype_permissions, data.bits);
+			data.custom_permissions = decode_permissions(data.custom_permissions, data.bits);
+			frm.role_details = data;
+			show_permissions_dialog(data);
 		}
 	});
 }
 
+function decode_permissions(packed, bits) {
+	// Rows are [doctype index, permlevel, mask], with bit i set for bits[i]
+	return packed.rows.map(function(row) {
+		let perm = {parent: packed.doctypes[row[0]], permlevel: row[1]};
+		bits.forEach(function(bit, i) {
+			perm[bit] = (row[2] >> i) & 1;
+		});
+		return perm;
+	});
+}
+
 function show_permissions_dialog(data) {
 	let html = `
 		<div class="permission-summary">
@@ -11,6 +11,10 @@ frappe.ui.form.on('User', {
 			frm.add_custom_button(__('View Applied Managers'), function() {
 				show_applied_managers(frm);
 			}, __('Permissions'));
+			
+			frm.add_custom_button(__('Clone Permissions to Users'), function() {
+				show_clone_permissions_dialog(frm);
+			}, __('Permissions'));
 		}
 		
 		// Show current permission managers
@@ -31,11 +35,12 @@ function show_user_permission_manager_dialog(frm) {
 				options: 'User Permission Manager',
 				reqd: 1,
 				get_query: function() {
-					return {
-						filters: {
-							'is_active': 1
-						}
-					};
+					let filters = { 'is_active': 1 };
+					if (frm.permission_sidebar) {
+						// Only managers not applied to this user yet
+						filters.name = ['in', frm.permission_sidebar.available_managers.map(m => m.name)];
+					}
+					return { filters: filters };
 				}
 			},
 			{
@@ -100,6 +105,66 @@ function show_user_permission_manager_dialog(frm) {
 	d.show();
 }
 
+function show_clone_permissions_dialog(frm) {
+	let d = new frappe.ui.Dialog({
+		title: __('Clone User Permissions of {0}', [frm.doc.name]),
+		fields: [
+			{
+				fieldname: 'target_users',
+				fieldtype: 'MultiSelectList',
+				label: __('Target Users'),
+				reqd: 1,
+				get_data: function(txt) {
+					return frappe.db.get_link_options('User', txt, {
+						enabled: 1,
+						user_type: 'System User',
+						name: ['!=', frm.doc.name]
+					});
+				}
+			},
+			{
+				fieldname: 'create_manager',
+				fieldtype: 'Check',
+				label: __('Create a Permission Manager'),
+				description: __('One template manager bound to every target user keeps the copies managed, so they can be synced or removed together')
+			},
+			{
+				fieldname: 'manager_name',
+				fieldtype: 'Data',
+				label: __('Manager Name'),
+				depends_on: 'create_manager'
+			}
+		],
+		primary_action_label: __('Clone'),
+		primary_action: function(values) {
+			frappe.call({
+				method: 'duplicate.api.user_permission_utils.clone_user_permissions',
+				args: {
+					source_user: frm.doc.name,
+					target_users: values.target_users,
+					create_manager: values.create_manager,
+					manager_name: values.manager_name
+				},
+				freeze: true,
+				freeze_message: __('Cloning User Permissions...'),
+				callback: function(r) {
+					if (r.message) {
+						frappe.show_alert({
+							message: __('Copied {0} permissions to {1} users ({2} rows created)', [
+								r.message.source_permissions, r.message.target_users, r.message.inserted
+							]),
+							indicator: 'green'
+						});
+						d.hide();
+					}
+				}
+			});
+		}
+	});
+	
+	d.show();
+}
+
 function show_manager_preview(manager_doc) {
 	let html = '<div class="manager-preview">';
 	html += '<h6>' + __('Manager Details') + '</h6>';
@@ -136,54 +201,63 @@ function show_manager_preview(manager_doc) {
 }
 
 function show_applied_managers(frm) {
-	frappe.call({
-		method: 'duplicate.duplicate.doctype.user_permission_manager.user_permission_manager.get_user_permission_managers_for_user',
-		args: {
-			user_email: frm.doc.name
-		},
-		callback: function(r) {
-			if (r.message && r.message.length > 0) {
-				let html = '<div class="applied-managers">';
-				html += '<h6>' + __('Applied Permission Managers') + '</h6>';
-				html += '<table class="table table-bordered table-sm">';
-				html += '<thead><tr>';
-				html += '<th>' + __('Manager Name') + '</th>';
-				html += '<th>' + __('Description') + '</th>';
-				html += '<th>' + __('Action') + '</th>';
-				html += '</tr></thead><tbody>';
-				
-				r.message.forEach(function(manager) {
-					html += '<tr>';
-					html += '<td>' + (manager.manager_name || 'Unknown') + '</td>';
-					html += '<td>' + (manager.description || 'No description') + '</td>';
-					html += '<td><a href="/app/user-permission-manager/' + manager.user_permission_manager + '" target="_blank">View</a></td>';
-					html += '</tr>';
-				});
-				
-				html += '</tbody></table></div>';
-				
-				frappe.msgprint({
-					title: __('Applied Permission Managers'),
-					message: html,
-					wide: true
-				});
-			} else {
-				frappe.msgprint(__('No permission managers applied to this user'));
-			}
+	load_permission_managers_info(frm, function(sidebar) {
+		if (sidebar.managers.length > 0) {
+			let html = '<div class="applied-managers">';
+			html += '<h6>' + __('Applied Permission Managers') + '</h6>';
+			html += '<table class="table table-bordered table-sm">';
+			html += '<thead><tr>';
+			html += '<th>' + __('Manager Name') + '</th>';
+			html += '<th>' + __('Description') + '</th>';
+			html += '<th>' + __('Permissions') + '</th>';
+			html += '<th>' + __('Action') + '</th>';
+			html += '</tr></thead><tbody>';
+			
+			sidebar.managers.forEach(function(manager) {
+				html += '<tr>';
+				html += '<td>' + (manager.manager_name || 'Unknown') + '</td>';
+				html += '<td>' + (manager.description || 'No description') + '</td>';
+				html += '<td>' + manager.permission_count + '</td>';
+				html += '<td><a href="/app/user-permission-manager/' + manager.user_permission_manager + '" target="_blank">View</a></td>';
+				html += '</tr>';
+			});
+			
+			html += '</tbody></table>';
+			html += '<p class="text-muted">' + __('{0} managed and {1} manual User Permissions', [
+				sidebar.managed_permissions, sidebar.manual_permissions
+			]) + '</p></div>';
+			
+			frappe.msgprint({
+				title: __('Applied Permission Managers'),
+				message: html,
+				wide: true
+			});
+		} else {
+			frappe.msgprint(__('No permission managers applied to this user'));
 		}
 	});
 }
 
-function load_permission_managers_info(frm) {
-	// Add info section to show applied managers
+function load_permission_managers_info(frm, callback) {
+	// One call returns the applied managers, counts and available managers;
+	// the server answers "not modified" while the loaded data is still current
+	let cached = frm.permission_sidebar_user === frm.doc.name ? frm.permission_sidebar : null;
 	frappe.call({
-		method: 'duplicate.duplicate.doctype.user_permission_manager.user_permission_manager.get_user_permission_managers_for_user',
+		method: 'duplicate.api.user_permission_utils.get_user_permission_sidebar',
 		args: {
-			user_email: frm.doc.name
+			user_email: frm.doc.name,
+			version: cached ? cached.version : null
 		},
 		callback: function(r) {
-			if (r.message && r.message.length > 0) {
-				let manager_names = r.message.map(m => m.manager_name || 'Unknown').join(', ');
+			if (!r.message) return;
+			
+			let sidebar = r.message.not_modified && cached ? cached : r.message;
+			frm.permission_sidebar = sidebar;
+			frm.permission_sidebar_user = frm.doc.name;
+			if (callback) {
+				callback(sidebar);
+			} else if (sidebar.managers.length > 0) {
+				let manager_names = sidebar.managers.map(m => m.manager_name || 'Unknown').join(', ');
 				frm.dashboard.add_comment(
 					__('Applied Permission Managers: ') + manager_names,
 					'blue'